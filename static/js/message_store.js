@@ -286,8 +286,10 @@ exports.update_messages = function update_messages(events) {
             msg.content = event.rendered_content;
         }
 
+        // Events with rendering_only set just bring in content the
+        // server rendered later (e.g. link previews); they aren't edits.
         var row = current_msg_list.get_row(event.message_id);
-        if (row.length > 0) {
+        if (row.length > 0 && !event.rendering_only) {
             message_edit.end(row);
         }
 
@@ -353,8 +355,10 @@ exports.update_messages = function update_messages(events) {
             });
         }
 
-        msg.last_edit_timestamp = event.edit_timestamp;
-        delete msg.last_edit_timestr;
+        if (!event.rendering_only) {
+            msg.last_edit_timestamp = event.edit_timestamp;
+            delete msg.last_edit_timestr;
+        }
 
         notifications.received_messages([msg]);
         alert_words.process_message(msg);
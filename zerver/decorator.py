@@ -16,8 +16,7 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.utils import statsd
 from zerver.exceptions import RateLimited
-from zerver.lib.rate_limiter import incr_ratelimit, is_ratelimited, \
-     api_calls_left
+from zerver.lib.rate_limiter import rate_limit_request
 from zerver.lib.request import REQ, has_request_variables, JsonableError, RequestVariableMissingError
 from django.core.handlers import base
 
@@ -525,7 +524,7 @@ def rate_limit_user(request, user, domain):
     if the user has been rate limited, otherwise returns and modifies request to contain
     the rate limit information"""
 
-    ratelimited, time = is_ratelimited(user, domain)
+    ratelimited, time, calls_remaining = rate_limit_request(user, domain)
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -534,11 +533,7 @@ def rate_limit_user(request, user, domain):
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    incr_ratelimit(user, domain)
-    calls_remaining, time_reset = api_calls_left(user, domain)
-
     request._ratelimit_remaining = calls_remaining
-    request._ratelimit_secs_to_freedom = time_reset
 
 def rate_limit(domain='all'):
     # type: (text_type) -> Callable[[Callable[..., HttpResponse]], Callable[..., HttpResponse]]
@@ -16,17 +16,17 @@ from zerver.models import Realm, RealmEmoji, Stream, UserProfile, UserActivity,
     Client, DefaultStream, UserPresence, Referral, PushDeviceToken, MAX_SUBJECT_LENGTH, \
     MAX_MESSAGE_LENGTH, get_client, get_stream, get_recipient, get_huddle, \
     get_user_profile_by_id, PreregistrationUser, get_display_recipient, \
-    to_dict_cache_key, get_realm, bulk_get_recipients, \
+    to_dict_cache_key, get_realm, bulk_get_recipients, MESSAGE_DICT_CACHE_TIMEOUT, \
     email_allowed_for_realm, email_to_username, display_recipient_cache_key, \
     get_user_profile_by_email, get_stream_cache_key, to_dict_cache_key_id, \
     UserActivityInterval, get_active_user_dicts_in_realm, get_active_streams, \
     realm_filters_for_domain, RealmFilter, receives_offline_notifications, \
     ScheduledJob, realm_filters_for_domain, get_owned_bot_dicts, \
-    get_old_unclaimed_attachments, get_cross_realm_users
+    get_old_unclaimed_attachments, get_cross_realm_users, stringify_message_dict
 
 from zerver.lib.avatar import get_avatar_url, avatar_url
 
-from django.db import transaction, IntegrityError
+from django.db import connection, transaction, IntegrityError
 from django.db.models import F, Q
 from django.db.models.query import QuerySet
 from django.core.exceptions import ValidationError
@@ -36,7 +36,7 @@ from django.utils.timezone import now
 
 from confirmation.models import Confirmation
 import six
-from six import text_type
+from six import text_type, binary_type
 from six.moves import filter
 from six.moves import map
 from six.moves import range
@@ -50,11 +50,13 @@ from zerver.lib.queue import queue_json_publish
 from django.utils import timezone
 from zerver.lib.create_user import create_user
 from zerver.lib import bugdown
+from zerver.lib.link_preview import fetch_link_previews
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, cache_set_many, \
-    cache_delete, cache_delete_many
+    cache_delete, cache_delete_many, search_generation_cache_key, expiring_cache_item
 from zerver.decorator import statsd_increment
-from zerver.lib.event_queue import request_event_queue, get_user_events, send_event
+from zerver.lib.event_queue import request_event_queue, get_user_events, send_event, \
+    send_events
 from zerver.lib.utils import log_statsd_event, statsd
 from zerver.lib.html_diff import highlight_html_differences
 from zerver.lib.alert_words import user_alert_words, add_user_alert_words, \
@@ -592,6 +594,59 @@ def always_push_notify(user):
     # messages, regardless of idle status
     return user.realm.domain in ['robinhood.io']
 
+def get_subscribers_for_recipients(recipients):
+    # type: (Iterable[Recipient]) -> Dict[int, List[UserProfile]]
+    """Fetch the subscribers of all the non-personal recipients in a batch
+    of messages with a single query, returning a map from recipient id
+    to the list of subscribed UserProfile objects."""
+    recipient_ids = set(recipient.id for recipient in recipients
+                        if recipient.type != Recipient.PERSONAL)
+    subscribers = dict((recipient_id, []) for recipient_id in recipient_ids) # type: Dict[int, List[UserProfile]]
+    if not recipient_ids:
+        return subscribers
+
+    # We use select_related()/only() here, while the PERSONAL case in
+    # do_send_messages uses get_user_profile_by_id() to get UserProfile
+    # objects from cache.  Streams will typically have more recipients
+    # than PMs, so get_user_profile_by_id() would be a bit more
+    # expensive here, given that we need to hit the DB anyway and only
+    # care about the email from the user profile.
+    fields = [
+        'recipient',
+        'user_profile__id',
+        'user_profile__email',
+        'user_profile__is_active',
+        'user_profile__realm__domain'
+    ]
+    query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
+        recipient_id__in=recipient_ids, active=True)
+    for sub in query:
+        subscribers[sub.recipient_id].append(sub.user_profile)
+    return subscribers
+
+def prime_message_dict_caches(messages):
+    # type: (Sequence[Message]) -> Dict[Tuple[int, bool], Dict[str, Any]]
+    """Build both the markdown and non-markdown message dicts for a batch
+    of freshly sent messages and store them in the remote cache with a
+    single cache_set_many call.  Returns the dicts, keyed by
+    (message_id, apply_markdown)."""
+    message_dicts = {} # type: Dict[Tuple[int, bool], Dict[str, Any]]
+    encoded = {} # type: Dict[text_type, binary_type]
+    start = time.time()
+    for message in messages:
+        for apply_markdown in (True, False):
+            message_dict = message.to_dict_uncached_helper(apply_markdown)
+            message_dicts[(message.id, apply_markdown)] = message_dict
+            encoded[to_dict_cache_key(message, apply_markdown)] = stringify_message_dict(message_dict)
+    if encoded:
+        # As get_old_messages caches them, so that they're refreshed
+        # early there too
+        fetch_time = (time.time() - start) / len(messages)
+        cache_set_many(dict((key, expiring_cache_item(val, MESSAGE_DICT_CACHE_TIMEOUT, fetch_time))
+                            for (key, val) in encoded.items()),
+                       timeout=MESSAGE_DICT_CACHE_TIMEOUT)
+    return message_dicts
+
 # Helper function. Defaults here are overriden by those set in do_send_messages
 def do_send_message(message, rendered_content = None, no_log = False, stream = None, local_id = None):
     # type: (Union[int, Message], Optional[text_type], bool, Optional[Stream], Optional[int]) -> int
@@ -630,6 +685,9 @@ def do_send_messages(messages):
         if not message['no_log']:
             log_message(message['message'])
 
+    subscribers_by_recipient_id = get_subscribers_for_recipients(
+        [message['message'].recipient for message in messages])
+
     for message in messages:
         if message['message'].recipient.type == Recipient.PERSONAL:
             message['recipients'] = list(set([get_user_profile_by_id(message['message'].recipient.type_id),
@@ -641,27 +699,14 @@ def do_send_messages(messages):
               message['message'].recipient.type == Recipient.HUDDLE or
               # add by yicong : group message
               message['message'].recipient.type == Recipient.GROUP):
-            # We use select_related()/only() here, while the PERSONAL case above uses
-            # get_user_profile_by_id() to get UserProfile objects from cache.  Streams will
-            # typically have more recipients than PMs, so get_user_profile_by_id() would be
-            # a bit more expensive here, given that we need to hit the DB anyway and only
-            # care about the email from the user profile.
-            fields = [
-                'user_profile__id',
-                'user_profile__email',
-                'user_profile__is_active',
-                'user_profile__realm__domain'
-            ]
-            query = Subscription.objects.select_related("user_profile", "user_profile__realm").only(*fields).filter(
-                recipient=message['message'].recipient, active=True)
-            message['recipients'] = [s.user_profile for s in query]
+            message['recipients'] = subscribers_by_recipient_id[message['message'].recipient_id]
         else:
             raise ValueError('Bad recipient type')
 
         # Only deliver the message to active user recipients
         message['active_recipients'] = [user_profile for user_profile in message['recipients']
                                         if user_profile.is_active]
-        message['message'].maybe_render_content(None)
+        message['message'].maybe_render_content(None, defer_link_previews=True)
         message['message'].update_calculated_fields()
 
     # Save the message receipts in the database
@@ -701,23 +746,45 @@ def do_send_messages(messages):
             if Message.content_has_attachment(message['message'].content):
                 do_claim_attachments(message)
 
+    # Render the message dicts here and store them in the remote cache
+    # with a single round trip, so that neither the single-threaded
+    # Tornado server nor the first get_old_messages call has to.
+    message_dicts = prime_message_dict_caches([message['message'] for message in messages])
+
+    # Fetch presence information for all the recipients in the batch
+    # at once.  We don't have presence information for recipients
+    # outside the sender's realm (see receiver_is_idle), nor for MIT.
+    presence_user_ids = set() # type: Set[int]
+    for message in messages:
+        sender = message['message'].sender
+        if sender.realm.domain == 'mit.edu':
+            continue
+        presence_user_ids.update(user_profile.id for user_profile in message['active_recipients']
+                                 if user_profile.realm_id == sender.realm_id)
+    user_presences = UserPresence.get_status_dicts_for_users(presence_user_ids)
+
+    # Look up all the streams we don't already have in one query.
+    missing_stream_ids = set(message['message'].recipient.type_id for message in messages
+                             if message['message'].recipient.type == Recipient.STREAM and
+                             message['stream'] is None)
+    streams_by_id = {} # type: Dict[int, Stream]
+    if missing_stream_ids:
+        streams_by_id = Stream.objects.select_related("realm").in_bulk(list(missing_stream_ids))
+
+    events_and_users = [] # type: List[Tuple[Dict[str, Any], List[Dict[str, Any]]]]
     for message in messages:
-        # Render Markdown etc. here and store (automatically) in
-        # remote cache, so that the single-threaded Tornado server
-        # doesn't have to.
         user_flags = user_message_flags.get(message['message'].id, {})
         sender = message['message'].sender
-        user_presences = get_status_dict(sender)
         presences = {}
         for user_profile in message['active_recipients']:
-            if user_profile.email in user_presences:
-                presences[user_profile.id] = user_presences[user_profile.email]
+            if user_profile.realm_id == sender.realm_id and user_presences.get(user_profile.id):
+                presences[user_profile.id] = user_presences[user_profile.id]
 
         event = dict(
             type         = 'message',
             message      = message['message'].id,
-            message_dict_markdown = message['message'].to_dict(apply_markdown=True),
-            message_dict_no_markdown = message['message'].to_dict(apply_markdown=False),
+            message_dict_markdown = message_dicts[(message['message'].id, True)],
+            message_dict_no_markdown = message_dicts[(message['message'].id, False)],
             presences    = presences)
         users = [{'id': user.id,
                   'flags': user_flags.get(user.id, []),
@@ -730,7 +797,7 @@ def do_send_messages(messages):
             # ensuring that in the tornado server, non-public stream
             # messages are only associated to their subscribed users.
             if message['stream'] is None:
-                message['stream'] = Stream.objects.select_related("realm").get(id=message['message'].recipient.type_id)
+                message['stream'] = streams_by_id[message['message'].recipient.type_id]
             if message['stream'].is_public():
                 event['realm_id'] = message['stream'].realm.id
                 event['stream_name'] = message['stream'].name
@@ -740,7 +807,7 @@ def do_send_messages(messages):
             event['local_id'] = message['local_id']
         if message['sender_queue_id'] is not None:
             event['sender_queue_id'] = message['sender_queue_id']
-        send_event(event, users)
+        events_and_users.append((event, users))
         if (settings.ENABLE_FEEDBACK and
             message['message'].recipient.type == Recipient.PERSONAL and
             settings.FEEDBACK_BOT in [up.email for up in message['recipients']]):
@@ -750,6 +817,12 @@ def do_send_messages(messages):
                     lambda x: None
             )
 
+    # Notify Tornado about the whole batch with a single publish.
+    send_events(events_and_users)
+
+    for message in messages:
+        queue_link_previews(message['message'])
+
     # Note that this does not preserve the order of message ids
     # returned.  In practice, this shouldn't matter, as we only
     # mirror single zephyr messages at a time and don't otherwise
@@ -1031,7 +1104,7 @@ def check_message(sender, client, message_type_name, message_to,
         message.pub_date = timezone.now()
     message.sending_client = client
 
-    if not message.maybe_render_content(realm.domain):
+    if not message.maybe_render_content(realm.domain, defer_link_previews=True):
         raise JsonableError(_("Unable to render message"))
 
     if client.name == "zephyr_mirror":
@@ -2155,6 +2228,96 @@ def do_update_user_activity(user_profile, client, query, log_time):
     activity.last_visit = log_time
     activity.save(update_fields=["last_visit", "count"])
 
+def do_update_user_activity_intervals(visits):
+    # type: (Sequence[Tuple[int, datetime.datetime]]) -> None
+    """Batch version of do_update_user_activity_interval, for a list of
+    (user_profile_id, log_time) pairs: applies the same logic to each
+    visit in order, but with one query to fetch each user's latest
+    interval and two to save the results."""
+    log_times = defaultdict(list) # type: Dict[int, List[datetime.datetime]]
+    for (user_profile_id, log_time) in visits:
+        log_times[user_profile_id].append(log_time)
+
+    last_intervals = dict((interval.user_profile_id, interval) for interval in
+                          UserActivityInterval.objects.filter(user_profile_id__in=list(log_times.keys()))
+                                                      .order_by("user_profile_id", "-end")
+                                                      .distinct("user_profile_id"))
+    changed = {} # type: Dict[int, UserActivityInterval]
+    new_intervals = [] # type: List[UserActivityInterval]
+    for (user_profile_id, user_log_times) in log_times.items():
+        last = last_intervals.get(user_profile_id)
+        for log_time in sorted(user_log_times):
+            effective_end = log_time + datetime.timedelta(minutes=15)
+            if last is not None and ((log_time <= last.end and log_time >= last.start) or
+                                     (effective_end <= last.end and effective_end >= last.start)):
+                last.end = max(last.end, effective_end)
+                last.start = min(last.start, log_time)
+                if last.id is not None:
+                    changed[last.id] = last
+                continue
+            interval = UserActivityInterval(user_profile_id=user_profile_id, start=log_time,
+                                            end=effective_end)
+            new_intervals.append(interval)
+            if last is None or interval.end >= last.end:
+                last = interval
+
+    if changed:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE zerver_useractivityinterval"
+                       " SET start = v.start, \"end\" = v.\"end\""
+                       " FROM (VALUES " + ", ".join(["(%s, %s::timestamptz, %s::timestamptz)"] * len(changed)) + ")"
+                       " AS v(id, start, \"end\") WHERE zerver_useractivityinterval.id = v.id",
+                       [param for changed_interval in changed.values()
+                        for param in (changed_interval.id, changed_interval.start,
+                                      changed_interval.end)])
+    UserActivityInterval.objects.bulk_create(new_intervals)
+
+def do_update_user_activities(visits):
+    # type: (Sequence[Tuple[int, int, text_type, datetime.datetime]]) -> None
+    """Batch version of do_update_user_activity, for a list of
+    (user_profile_id, client_id, query, log_time) tuples."""
+    counts = {} # type: Dict[Tuple[int, int, text_type], List[Any]]
+    for (user_profile_id, client_id, query, log_time) in visits:
+        key = (user_profile_id, client_id, query)
+        if key not in counts:
+            counts[key] = [0, log_time]
+        counts[key][0] += 1
+        counts[key][1] = max(counts[key][1], log_time)
+
+    existing = {} # type: Dict[Tuple[int, int, text_type], int]
+    for (activity_id, user_profile_id, client_id, query) in UserActivity.objects.filter(
+            user_profile_id__in=set(key[0] for key in counts)).values_list(
+            "id", "user_profile_id", "client_id", "query"):
+        if (user_profile_id, client_id, query) in counts:
+            existing[(user_profile_id, client_id, query)] = activity_id
+
+    if existing:
+        cursor = connection.cursor()
+        cursor.execute("UPDATE zerver_useractivity"
+                       " SET count = zerver_useractivity.count + v.count,"
+                       " last_visit = GREATEST(zerver_useractivity.last_visit, v.last_visit)"
+                       " FROM (VALUES " + ", ".join(["(%s, %s, %s::timestamptz)"] * len(existing)) + ")"
+                       " AS v(id, count, last_visit) WHERE zerver_useractivity.id = v.id",
+                       [param for (activity_key, activity_id) in existing.items()
+                        for param in (activity_id, counts[activity_key][0], counts[activity_key][1])])
+
+    new_keys = [new_key for new_key in counts if new_key not in existing]
+    try:
+        with transaction.atomic():
+            UserActivity.objects.bulk_create([
+                UserActivity(user_profile_id=new_key[0], client_id=new_key[1], query=new_key[2],
+                             count=counts[new_key][0], last_visit=counts[new_key][1])
+                for new_key in new_keys])
+    except IntegrityError:
+        # Another worker created some of them concurrently
+        for key in new_keys:
+            (activity, created) = UserActivity.objects.get_or_create(
+                user_profile_id=key[0], client_id=key[1], query=key[2],
+                defaults={'last_visit': counts[key][1], 'count': 0})
+            UserActivity.objects.filter(id=activity.id).update(count=F('count') + counts[key][0],
+                                                               last_visit=counts[key][1])
+    statsd.incr('user_activity', len(visits))
+
 def send_presence_changed(user_profile, presence):
     # type: (UserProfile, UserPresence) -> None
     presence_dict = presence.to_dict()
@@ -2503,6 +2666,8 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
         items_for_remote_cache[to_dict_cache_key(changed_message, False)] = \
             (changed_message.to_dict_uncached(apply_markdown=False),)
     cache_set_many(items_for_remote_cache)
+    # Cached search results may include the old content or subject
+    cache_delete(search_generation_cache_key(user_profile.realm_id))
 
     def user_info(um):
         # type: (UserMessage) -> Dict[str, Any]
@@ -2512,6 +2677,59 @@ def do_update_message(user_profile, message, subject, propagate_mode, content, r
         }
     send_event(event, list(map(user_info, ums)))
 
+    if content is not None:
+        queue_link_previews(message)
+
+def queue_link_previews(message):
+    # type: (Message) -> None
+    """Queues the fetches of the link previews that rendering the message
+    with defer_link_previews left pending; see do_fetch_link_previews."""
+    previews = getattr(message, 'link_previews_pending', None)
+    if not previews:
+        return
+    event = {'message_id': message.id,
+             'previews': sorted(previews)}
+    queue_json_publish("link_previews", event, do_fetch_link_previews)
+
+def do_fetch_link_previews(event):
+    # type: (Mapping[str, Any]) -> None
+    fetch_link_previews([(kind, key) for (kind, key) in event['previews']])
+    try:
+        message = Message.objects.select_related().get(id=event['message_id'])
+    except Message.DoesNotExist:
+        return
+    do_update_link_previews(message)
+
+def do_update_link_previews(message):
+    # type: (Message) -> None
+    """Re-renders a message once the link previews it was waiting for
+    have been fetched, and sends the new rendering to its recipients.
+    Unlike an edit, this isn't recorded in the message's edit history,
+    and the event is marked rendering_only so that clients don't treat
+    it as one."""
+    rendered_content = message.render_markdown(message.content)
+    if rendered_content is None or rendered_content == message.rendered_content:
+        return
+    message.set_rendered_content(rendered_content)
+    # If the message was edited since we loaded it, leave the edit's
+    # rendering (whose own previews are queued) alone.
+    if Message.objects.filter(id=message.id, content=message.content).update(
+            rendered_content=message.rendered_content,
+            rendered_content_version=message.rendered_content_version) == 0:
+        return
+    # Deleted rather than refilled, in case an edit lands meanwhile.
+    cache_delete(to_dict_cache_key(message, True))
+    # Cached search results may include the old rendering
+    cache_delete(search_generation_cache_key(message.sender.realm_id))
+
+    event = {'type': 'update_message',
+             'message_id': message.id,
+             'message_ids': [message.id],
+             'rendering_only': True,
+             'rendered_content': rendered_content} # type: Dict[str, Any]
+    ums = UserMessage.objects.filter(message=message.id)
+    send_event(event, [{'id': um.user_profile_id, 'flags': um.flags_list()} for um in ums])
+
 def encode_email_address(stream):
     # type: (Stream) -> text_type
     return encode_email_address_helper(stream.name, stream.email_token)
@@ -2678,7 +2896,13 @@ def get_status_dict(requesting_user_profile):
     if requesting_user_profile.realm.domain == 'mit.edu':
         return defaultdict(dict)
 
-    return UserPresence.get_status_dict_by_realm(requesting_user_profile.realm_id)
+    # Only human users have presence information
+    user_dicts = [userdict for userdict in get_active_user_dicts_in_realm(requesting_user_profile.realm)
+                  if not userdict['is_bot']]
+    user_presences = UserPresence.get_status_dicts_for_users(
+        [userdict['id'] for userdict in user_dicts])
+    return dict((userdict['email'], user_presences[userdict['id']])
+                for userdict in user_dicts if user_presences.get(userdict['id']))
 
 
 def get_realm_user_dicts(user_profile):
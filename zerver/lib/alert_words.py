@@ -2,11 +2,14 @@ from __future__ import absolute_import
 
 from django.db.models import Q
 from zerver.models import UserProfile, Realm
-from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key
+from zerver.lib.cache import cache_get, cache_set, cache_with_key, \
+    realm_alert_words_cache_key, realm_alert_words_generation_cache_key
+import random
+import re
 import ujson
 import six
 from six import text_type
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm):
@@ -17,6 +20,107 @@ def alert_words_in_realm(realm):
     user_ids_with_words = dict((user_id, w) for (user_id, w) in six.iteritems(all_user_words) if len(w))
     return user_ids_with_words
 
+# An alert word only matches on its own: after the start of the message,
+# whitespace or one of these characters, and before the end, whitespace
+# or one of the others.
+_alert_word_before_re = re.compile(r'\s|[\(\".,\';\[\*`>]')
+_alert_word_after_re = re.compile(r'\s|[\)\"\?:.,\';\]!\*`]')
+
+class AlertWordMatcher(object):
+    """An Aho-Corasick automaton over all of a realm's alert words, which
+    finds the users with alert words in a message in a single pass over
+    its text, however many words there are."""
+    def __init__(self, realm_words):
+        # type: (Dict[int, List[text_type]]) -> None
+        # The trie: each node's transitions, failure link, the length of
+        # the word it completes (or 0) and that word's users.  Node 0 is
+        # the root.
+        self.transitions = [{}] # type: List[Dict[text_type, int]]
+        self.fail = [0]
+        self.lengths = [0]
+        self.user_ids = [set()] # type: List[Set[int]]
+        # The nearest node along the failure links that completes a word
+        self.output = [0]
+
+        for (user_id, words) in six.iteritems(realm_words):
+            for word in words:
+                word = word.lower()
+                if not word:
+                    continue
+                node = 0
+                for char in word:
+                    next_node = self.transitions[node].get(char)
+                    if next_node is None:
+                        next_node = len(self.transitions)
+                        self.transitions[node][char] = next_node
+                        self.transitions.append({})
+                        self.fail.append(0)
+                        self.lengths.append(0)
+                        self.user_ids.append(set())
+                        self.output.append(0)
+                    node = next_node
+                self.lengths[node] = len(word)
+                self.user_ids[node].add(user_id)
+
+        # Breadth-first, so each node's failure link is set before its children's
+        queue = list(self.transitions[0].values())
+        for node in queue:
+            for (char, child) in six.iteritems(self.transitions[node]):
+                fail = self.fail[node]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                fail = self.transitions[fail].get(char, 0)
+                self.fail[child] = fail
+                self.output[child] = fail if self.lengths[fail] else self.output[fail]
+                queue.append(child)
+
+    def user_ids_with_alert_words(self, content):
+        # type: (text_type) -> Set[int]
+        content = content.lower()
+        user_ids = set() # type: Set[int]
+        node = 0
+        for (i, char) in enumerate(content):
+            while node and char not in self.transitions[node]:
+                node = self.fail[node]
+            node = self.transitions[node].get(char, 0)
+            match = node if self.lengths[node] else self.output[node]
+            while match:
+                start = i + 1 - self.lengths[match]
+                if (start == 0 or _alert_word_before_re.match(content[start - 1])) and \
+                        (i + 1 == len(content) or _alert_word_after_re.match(content[i + 1])):
+                    user_ids |= self.user_ids[match]
+                match = self.output[match]
+        return user_ids
+
+# The matchers built in this process, by realm id, with the generation
+# of the realm's alert words they were built from.
+realm_alert_word_matchers = {} # type: Dict[int, Tuple[str, AlertWordMatcher]]
+MAX_REALM_ALERT_WORD_MATCHERS = 1000
+
+def realm_alert_words_generation(realm):
+    # type: (Realm) -> str
+    generation_key = realm_alert_words_generation_cache_key(realm)
+    generation = cache_get(generation_key)
+    if generation is None:
+        # Random, since two processes may both start a new generation
+        generation = ("%x" % (random.getrandbits(64),),)
+        cache_set(generation_key, generation[0])
+    return generation[0]
+
+def alert_word_matcher(realm):
+    # type: (Realm) -> AlertWordMatcher
+    """The matcher for the realm's alert words, rebuilt only when they
+    change (which deletes the realm's generation key)."""
+    # Get the generation first, so that the words are at least as new
+    generation = realm_alert_words_generation(realm)
+    cached = realm_alert_word_matchers.get(realm.id)
+    if cached is None or cached[0] != generation:
+        if len(realm_alert_word_matchers) >= MAX_REALM_ALERT_WORD_MATCHERS:
+            realm_alert_word_matchers.clear()
+        cached = (generation, AlertWordMatcher(alert_words_in_realm(realm)))
+        realm_alert_word_matchers[realm.id] = cached
+    return cached[1]
+
 def user_alert_words(user_profile):
     # type: (UserProfile) -> List[text_type]
     return ujson.loads(user_profile.alert_words)
@@ -16,11 +16,13 @@ import platform
 import time
 import httplib2
 import itertools
+import hashlib
+import random
 from six.moves import urllib
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element, SubElement
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 import requests
 
@@ -33,11 +35,13 @@ from zerver.lib.bugdown import fenced_code
 from zerver.lib.bugdown.fenced_code import FENCE_RE
 from zerver.lib.camo import get_camo_url
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, cache_get_many, cache_set_many
-from zerver.models import Message
+from zerver.lib.cache import cache_get, cache_set, cache_get_many, cache_set_many, \
+    realm_users_generation_cache_key
+from zerver.models import Message, Realm
 import zerver.lib.alert_words as alert_words
 import zerver.lib.mention as mention
-from zerver.lib.str_utils import force_text, force_str
+from zerver.lib.str_utils import force_bytes, force_text, force_str
+from zerver.lib.utils import statsd, make_safe_digest
 import six
 from six.moves import range, html_parser
 from six import text_type
@@ -119,7 +123,6 @@ def add_a(root, url, link, height="", title=None, desc=None,
         desc_div = markdown.util.etree.SubElement(summary_div, "desc")
         desc_div.set("class", "message_inline_image_desc")
 
-@cache_with_key(lambda tweet_id: tweet_id, cache_name="database", with_statsd_key="tweet_data")
 def fetch_tweet_data(tweet_id):
     # type: (text_type) -> Optional[Dict[text_type, Any]]
     if settings.TEST_SUITE:
@@ -149,9 +152,10 @@ def fetch_tweet_data(tweet_id):
                           'library installed, see https://github.com/zulip/zulip/issues/86')
             return None
         except TimeoutExpired as e:
-            # We'd like to try again later and not cache the bad result,
-            # so we need to re-raise the exception (just as though
-            # we were being rate-limited)
+            # We'd like to try again soon rather than cache the bad
+            # result for as long as a missing tweet, so we need to
+            # re-raise the exception (just as though we were being
+            # rate-limited)
             raise
         except twitter.TwitterError as e:
             t = e.args[0]
@@ -163,8 +167,8 @@ def fetch_tweet_data(tweet_id):
                                                        t[0]['code'] == 130):
                 # Code 88 means that we were rate-limited and 130
                 # means Twitter is having capacity issues; either way
-                # just raise the error so we don't cache None and will
-                # try again later.
+                # just raise the error so that fetch_link_preview only
+                # caches the failure briefly and we try again later.
                 raise
             else:
                 # It's not clear what to do in cases of other errors,
@@ -188,10 +192,9 @@ def fetch_open_graph_image(url):
     head = []
 
     # TODO: What if response content is huge? Should we get headers first?
-    try:
-        content = requests.get(url, timeout=1).text
-    except:
-        return None
+    # A failed fetch raises, so that it is cached only briefly (see
+    # fetch_link_preview); a page without an image returns None.
+    content = requests.get(url, timeout=1).text
 
     # Extract the head and meta tags
     # All meta tags are self closing, have no children or are closed
@@ -246,6 +249,86 @@ def fetch_open_graph_image(url):
         desc = og_desc.get('content')
     return {'image': image, 'title': title, 'desc': desc}
 
+# Previews that need data from another site (a Dropbox page's Open
+# Graph tags, or a tweet) are cached in the database cache, keyed by
+# URL or tweet id.  That a link has no preview is cached too, and a
+# fetch that failed (e.g. timed out) is cached for a shorter time, so
+# that a slow or broken site isn't fetched again for every message
+# linking to it.
+#
+# A message rendered with defer_link_previews (as new and edited
+# messages are, with INLINE_PREVIEWS_IN_BACKGROUND) doesn't wait for
+# these fetches.  Uncached previews are left out, with a placeholder,
+# and recorded in message.link_previews_pending; the link_previews
+# queue worker fetches them and sends the message's new rendering
+# (see zerver/lib/link_preview.py).
+#
+# A rendering that left out a preview because its fetch failed is
+# marked with message.link_preview_failed, so that it isn't
+# render-cached for longer than the failure is.
+LINK_PREVIEW_NEGATIVE_TIMEOUT = 3600*24
+LINK_PREVIEW_FAILURE_TIMEOUT = 300
+# Cached in place of the preview when its fetch failed.
+LINK_PREVIEW_FAILED = u"failed"
+
+def link_preview_cache_key(kind, key):
+    # type: (text_type, text_type) -> text_type
+    return u"link_preview:%s:%s" % (kind, make_safe_digest(key))
+
+def fetch_link_preview(kind, key):
+    # type: (text_type, text_type) -> Optional[Dict[text_type, Any]]
+    """Fetches and caches a preview: kind "tweet", with a tweet id as the
+    key, or "open_graph", with a URL.  Returns None if there is none,
+    or if the fetch failed."""
+    timeout = None # type: Optional[int]
+    status = "fetched"
+    try:
+        if kind == "tweet":
+            data = fetch_tweet_data(key)
+        else:
+            data = fetch_open_graph_image(key)
+        if data is None:
+            timeout = LINK_PREVIEW_NEGATIVE_TIMEOUT
+            status = "none"
+    except Exception:
+        logging.warning(traceback.format_exc())
+        data = None
+        timeout = LINK_PREVIEW_FAILURE_TIMEOUT
+        status = "failed"
+        note_link_preview_failure()
+    statsd.incr("link_preview.%s.%s" % (kind, status))
+    # Filling the database cache, which has no local tier to invalidate.
+    cache_set(link_preview_cache_key(kind, key), LINK_PREVIEW_FAILED if status == "failed" else data,
+              cache_name="database", timeout=timeout, invalidate=False)
+    return data
+
+# Set whenever a link preview fails during a rendering, so that
+# renderings without a message to flag aren't cached either.
+render_link_preview_failed = False
+
+def note_link_preview_failure():
+    # type: () -> None
+    global render_link_preview_failed
+    render_link_preview_failed = True
+    if current_message is not None:
+        current_message.link_preview_failed = True
+
+def link_preview(kind, key):
+    # type: (text_type, text_type) -> Optional[Dict[text_type, Any]]
+    cached = cache_get(link_preview_cache_key(kind, key), cache_name="database")
+    if cached is not None:
+        statsd.incr("link_preview.%s.hit" % (kind,))
+        if cached[0] == LINK_PREVIEW_FAILED:
+            note_link_preview_failure()
+            return None
+        return cached[0]
+    pending = getattr(current_message, 'link_previews_pending', None)
+    if settings.INLINE_PREVIEWS_IN_BACKGROUND and pending is not None:
+        pending.add((kind, key))
+        statsd.incr("link_preview.%s.deferred" % (kind,))
+        return None
+    return fetch_link_preview(kind, key)
+
 def get_tweet_id(url):
     # type: (text_type) -> Optional[text_type]
     parsed_url = urllib.parse.urlparse(url)
@@ -311,7 +394,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             # However, we might want to make use of title and description
             # in the future. If the actual image is too big, we might also
             # want to use the open graph image.
-            image_info = fetch_open_graph_image(url)
+            image_info = link_preview("open_graph", url)
 
             is_image = is_album or self.is_image(url)
 
@@ -447,7 +530,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             return None
 
         try:
-            res = fetch_tweet_data(tweet_id)
+            res = link_preview("tweet", tweet_id)
             if res is None:
                 return None
             user = res['user'] # type: Dict[text_type, Any]
@@ -519,6 +602,8 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             return
 
         rendered_tweet_count = 0
+        pending = getattr(current_message, 'link_previews_pending', None)
+        num_pending = len(pending) if pending is not None else 0
 
         for url in found_urls:
             dropbox_image = self.dropbox_image(url)
@@ -554,6 +639,11 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
                 add_a(root, youtube, url)
                 continue
 
+        if pending is not None and len(pending) > num_pending:
+            # Stands in for the previews still being fetched
+            div = markdown.util.etree.SubElement(root, "div")
+            div.set("class", "message_inline_preview_pending")
+
 class Avatar(markdown.inlinepatterns.Pattern):
     def handleMatch(self, match):
         # type: (Match[text_type]) -> Optional[Element]
@@ -885,21 +975,9 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
         if current_message and db_data is not None:
             # We check for a user's custom notifications here, as we want
             # to check for plaintext words that depend on the recipient.
-            realm_words = db_data['realm_alert_words']
-            content = '\n'.join(lines).lower()
-
-            allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
-            allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
-
-            for user_id, words in six.iteritems(realm_words):
-                for word in words:
-                    escaped = re.escape(word.lower())
-                    match_re = re.compile(u'(?:%s)%s(?:%s)' %
-                                            (allowed_before_punctuation,
-                                             escaped,
-                                             allowed_after_punctuation))
-                    if re.search(match_re, content):
-                        current_message.user_ids_with_alert_words.add(user_id)
+            content = '\n'.join(lines)
+            current_message.user_ids_with_alert_words.update(
+                db_data['alert_word_matcher'].user_ids_with_alert_words(content))
 
         return lines
 
@@ -1050,18 +1128,72 @@ def make_md_engine(key, opts):
                          fenced_code.makeExtension(),
                          Bugdown(opts)])
 
+class CompiledRealmFilters(object):
+    """A realm's filters, compiled once for subject_links.
+
+    The filters can't be combined into one regex that finds all their
+    matches, since they may overlap and reuse group names.  But with
+    the groups made non-capturing, an alternation of them matches a
+    subject exactly when some filter does, which rules out most
+    subjects with a single search."""
+    def __init__(self, filters):
+        # type: (List[Tuple[text_type, text_type]]) -> None
+        self.filters = filters
+        sources = [prepare_realm_pattern(pattern) for (pattern, _) in filters]
+        self.patterns = [(re.compile(source), format_string)
+                         for (source, (_, format_string)) in zip(sources, filters)]
+        self.any_match = None # type: Optional[Any]
+        # Group numbers change in the alternation, so backreferences
+        # would too, and inline flags would apply to every filter.
+        if sources and not any(_uncombinable_re.search(source) for source in sources):
+            try:
+                self.any_match = re.compile(u'|'.join(u'(?:%s)' % (_named_group_re.sub(u'(?:', source),)
+                                                      for source in sources))
+            except re.error:
+                pass
+
+    def subject_links(self, subject):
+        # type: (text_type) -> List[text_type]
+        if not self.patterns or (self.any_match is not None and
+                                 self.any_match.search(subject) is None):
+            return []
+        matches = [] # type: List[text_type]
+        for (pattern, format_string) in self.patterns:
+            for m in pattern.finditer(subject):
+                matches.append(format_string % m.groupdict())
+        return matches
+
+_named_group_re = re.compile(r'(?<!\\)\(\?P<\w+>')
+_uncombinable_re = re.compile(r'\\[1-9]|\(\?P=|\(\?[aiLmsux]')
+
+# Compiled filters by (lowercase) domain, rebuilt when the filters change
+compiled_realm_filters = {} # type: Dict[text_type, CompiledRealmFilters]
+# Recent results of subject_links: (domain, subject) => (the filters
+# used, links), oldest first.
+subject_links_cache = OrderedDict() # type: Dict[Tuple[text_type, text_type], Tuple[CompiledRealmFilters, List[text_type]]]
+SUBJECT_LINKS_CACHE_SIZE = 10000
+
+def get_compiled_realm_filters(domain):
+    # type: (text_type) -> CompiledRealmFilters
+    from zerver.models import realm_filters_for_domain
+    filters = realm_filters_for_domain(domain)
+    compiled = compiled_realm_filters.get(domain)
+    if compiled is None or compiled.filters != filters:
+        compiled = CompiledRealmFilters(filters)
+        compiled_realm_filters[domain] = compiled
+    return compiled
+
 def subject_links(domain, subject):
     # type: (text_type, text_type) -> List[text_type]
-    from zerver.models import get_realm, RealmFilter, realm_filters_for_domain
-    matches = [] # type: List[text_type]
-
-    realm_filters = realm_filters_for_domain(domain)
-
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, subject):
-            matches += [realm_filter[1] % m.groupdict()]
-    return matches
+    compiled = get_compiled_realm_filters(domain)
+    key = (domain, subject)
+    cached = subject_links_cache.pop(key, None)
+    if cached is None or cached[0] is not compiled:
+        cached = (compiled, compiled.subject_links(subject))
+    subject_links_cache[key] = cached
+    while len(subject_links_cache) > SUBJECT_LINKS_CACHE_SIZE:
+        subject_links_cache.popitem(last=False)
+    return list(cached[1])
 
 def make_realm_filters(domain, filters):
     # type: (text_type, List[Tuple[text_type, text_type]]) -> None
@@ -1111,6 +1243,10 @@ def _sanitize_for_log(md):
 # provides no way to pass extra params through to a pattern. Thus, a global.
 current_message = None # type: Optional[Message]
 
+# How renderings are limited to 5 seconds; render pool workers (see
+# zerver.lib.rerender) use alarm_timeout, to avoid a thread per render.
+render_timeout = timeout # type: Callable[..., Optional[text_type]]
+
 # We avoid doing DB queries in our markdown thread to avoid the overhead of
 # opening a new DB connection. These connections tend to live longer than the
 # threads themselves, as well.
@@ -1137,9 +1273,13 @@ def do_convert(md, realm_domain=None, message=None):
     # Pre-fetch data from the DB that is used in the bugdown thread
     global db_data
     if message:
-        realm_users = get_active_user_dicts_in_realm(message.get_realm())
+        # Only messages with an @ can mention anyone
+        if u'@' in md:
+            realm_users = get_active_user_dicts_in_realm(message.get_realm())
+        else:
+            realm_users = []
 
-        db_data = {'realm_alert_words': alert_words.alert_words_in_realm(message.get_realm()),
+        db_data = {'alert_word_matcher': alert_words.alert_word_matcher(message.get_realm()),
                    'full_names':        dict((user['full_name'].lower(), user) for user in realm_users),
                    'short_names':       dict((user['short_name'].lower(), user) for user in realm_users),
                    'emoji':             message.get_realm().get_emoji()}
@@ -1148,7 +1288,7 @@ def do_convert(md, realm_domain=None, message=None):
         # Spend at most 5 seconds rendering.
         # Sometimes Python-Markdown is really slow; see
         # https://trac.zulip.net/ticket/345
-        return timeout(5, _md_engine.convert, md)
+        return render_timeout(5, _md_engine.convert, md)
     except:
         from zerver.lib.actions import internal_send_message
 
@@ -1194,9 +1334,119 @@ def bugdown_stats_finish():
     bugdown_total_requests += 1
     bugdown_total_time += (time.time() - bugdown_time_start)
 
-def convert(md, realm_domain=None, message=None):
-    # type: (markdown.Markdown, Optional[text_type], Optional[Message]) -> Optional[text_type]
+# Rendering a message depends on more than its content: on the realm's
+# filters, its custom emoji, and, for @-mentions, its users.  The
+# render cache keys each rendering on the content and a version (a
+# hash, or for the users a generation) of each of these it could
+# depend on, and stores the mentions found
+# along with the HTML, so a cache hit can set mentions_user_ids just
+# as a render would.  Alert words don't change the HTML, so they're
+# matched afresh on every hit.
+#
+# That's only exact when the alert words processor sees the original
+# content, so content with fenced code or HTML blocks, which earlier
+# preprocessors set aside, isn't cached.
+_uncacheable_re = re.compile(u'```|~~~|<')
+def render_cacheable(md):
+    # type: (text_type) -> bool
+    return _uncacheable_re.search(md) is None
+
+def _version(data):
+    # type: (Any) -> str
+    return hashlib.sha1(force_bytes(repr(data))).hexdigest()
+
+def realm_filters_version(realm_domain):
+    # type: (text_type) -> str
+    return _version(realm_filter_data.get(realm_domain))
+
+def realm_emoji_version(realm):
+    # type: (Any) -> str
+    return _version(sorted(six.iteritems(realm.get_emoji())))
+
+def realm_users_version(realm):
+    # type: (Any) -> str
+    # A generation rather than a hash of the users, which would mean
+    # fetching all of them for every message with an '@' in it.
+    generation_key = realm_users_generation_cache_key(realm)
+    generation = cache_get(generation_key)
+    if generation is None:
+        # Random, since two processes may both start a new generation
+        generation = ("%x" % (random.getrandbits(64),),)
+        cache_set(generation_key, generation[0])
+    return generation[0]
+
+def render_cache_key(md, realm_domain, realm, message=None):
+    # type: (text_type, Optional[text_type], Realm, Optional[Message]) -> str
+    maybe_update_realm_filters(realm.domain)
+    if realm_domain not in md_engines:
+        realm_domain = u"default"
+    versions = [str(version), realm_filters_version(realm_domain)]
+    if message is None:
+        # Renderings without a message (e.g. previews) don't look up
+        # emoji or users, so they get their own keys.
+        versions.append(u"preview")
+    else:
+        # Only emoji syntax and mentions look up emoji and users
+        if u':' in md:
+            versions.append(realm_emoji_version(realm))
+        if u'@' in md:
+            versions.append(realm_users_version(realm))
+    return u"bugdown_render:%d:%s:%s:%s" % (realm.id, _version(realm_domain), _version(md),
+                                            _version(versions))
+
+def render_from_cache(key, md, message=None):
+    # type: (str, text_type, Optional[Message]) -> Optional[text_type]
+    cached = cache_get(key)
+    if cached is None:
+        return None
+    (rendered_content, mentions_user_ids, mentions_wildcard) = cached[0]
+    if message is not None:
+        message.mentions_user_ids.update(mentions_user_ids)
+        message.mentions_wildcard = mentions_wildcard
+        message.user_ids_with_alert_words.update(
+            alert_words.alert_word_matcher(message.get_realm()).user_ids_with_alert_words(md))
+    return rendered_content
+
+bugdown_cache_hits = 0
+bugdown_cache_misses = 0
+
+def get_bugdown_cache_stats():
+    # type: () -> Tuple[int, int]
+    return (bugdown_cache_hits, bugdown_cache_misses)
+
+def convert(md, realm_domain=None, message=None, realm=None):
+    # type: (markdown.Markdown, Optional[text_type], Optional[Message], Optional[Realm]) -> Optional[text_type]
+    global bugdown_cache_hits
+    global bugdown_cache_misses
+    global render_link_preview_failed
     bugdown_stats_start()
-    ret = do_convert(md, realm_domain, message)
+    if realm is None and message is not None:
+        realm = message.get_realm()
+    key = None # type: Optional[str]
+    ret = None # type: Optional[text_type]
+    if settings.BUGDOWN_RENDER_CACHE and realm is not None and render_cacheable(md):
+        key = render_cache_key(md, realm_domain, realm, message)
+        ret = render_from_cache(key, md, message)
+        if ret is not None:
+            bugdown_cache_hits += 1
+            statsd.incr("bugdown.render_cache.hit")
+        else:
+            bugdown_cache_misses += 1
+            statsd.incr("bugdown.render_cache.miss")
+    if ret is None:
+        render_link_preview_failed = False
+        ret = do_convert(md, realm_domain, message)
+        if key is not None and ret is not None and not getattr(message, 'link_previews_pending', None) \
+                and not render_link_preview_failed:
+            # Keys are never reused for other content, so there's
+            # nothing to invalidate.  Renderings waiting for link
+            # previews, or missing ones that failed to fetch, aren't
+            # cached, since they'd be stale once the previews are
+            # fetched.
+            if message is None:
+                cached = (ret, [], False) # type: Tuple[text_type, List[int], bool]
+            else:
+                cached = (ret, sorted(message.mentions_user_ids), message.mentions_wildcard)
+            cache_set(key, cached, timeout=3600*24, invalidate=False)
     bugdown_stats_finish()
     return ret
@@ -9,19 +9,27 @@ from django.conf import settings
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 
-from typing import Any, Callable, Iterable, Optional, Union, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple, Union, TypeVar
 
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
+from collections import OrderedDict
 import subprocess
 import time
 import base64
+import logging
+import math
 import random
+import redis
 import sys
 import os
+import threading
 import os.path
 import hashlib
 import six
+import ujson
 from six import text_type
+from six.moves import cPickle as pickle
 
 if False:
     from zerver.models import UserProfile, Realm
@@ -97,6 +105,167 @@ def bounce_key_prefix_for_testing(test_name):
     global KEY_PREFIX
     KEY_PREFIX = test_name + u':' + text_type(os.getpid()) + u':'
 
+# The local cache is an optional process-local tier in front of the
+# remote cache, for small objects that are read many times per
+# request and rarely change.  Only keys in the families listed in
+# LOCAL_CACHE_TTLS (the part of the key before the first ':') are
+# cached locally, each for at most its family's TTL.
+#
+# Setting or deleting such a key through cache_set/cache_delete (and
+# the _many variants) publishes the key on a redis channel, which
+# every process drains before reading from its local cache, so
+# changes made via the flush_* signal handlers propagate promptly;
+# the TTLs bound the staleness if an invalidation is ever lost.
+#
+# Processes may run several threads (e.g. `process_queue --all`), so
+# the local cache and the invalidation listener are guarded by locks.
+LOCAL_CACHE_TTLS = {
+    u'user_profile_by_id': 60,
+    u'user_profile_by_email': 60,
+    u'stream_by_realm_and_name': 60,
+    u'get_recipient': 300,
+    u'get_client': 300,
+    u'all_realm_filters': 60,
+    u'realm_emoji': 60,
+    u'message_user': 60,
+    u'realm_alert_words_generation': 60,
+    u'realm_users_generation': 60,
+} # type: Dict[text_type, int]
+LOCAL_CACHE_INVALIDATION_CHANNEL = "local_cache_invalidation"
+
+class LocalCache(object):
+    """A size-limited LRU cache with a TTL per entry.  Values are stored
+    pickled, so that (like with the remote cache) every get returns a
+    fresh copy that the caller can safely modify.  Safe to use from
+    several threads."""
+    def __init__(self, max_entries):
+        # type: (int) -> None
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # type: Dict[text_type, Tuple[float, bytes]]
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # type: (text_type) -> Any
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            (expires, data) = entry
+            if expires < time.time():
+                return None
+            self.entries[key] = entry
+        return pickle.loads(data)
+
+    def set(self, key, val, ttl):
+        # type: (text_type, Any, int) -> None
+        data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, data)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        # type: (text_type) -> None
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        # type: () -> None
+        with self.lock:
+            self.entries.clear()
+
+local_cache = None # type: Optional[LocalCache]
+local_cache_pubsub = None # type: Optional[redis.client.PubSub]
+local_cache_redis_client = None # type: Optional[redis.StrictRedis]
+# The process the above belong to; they must not be shared with
+# processes forked after they were set up.
+local_cache_pid = None # type: Optional[int]
+# Identifies this process's invalidation messages, which it ignores
+local_cache_origin = None # type: Optional[text_type]
+# Guards the above, and reading from local_cache_pubsub, which isn't
+# thread-safe.
+local_cache_setup_lock = threading.RLock()
+
+def get_local_cache():
+    # type: () -> Optional[LocalCache]
+    """Returns the local cache, after applying any pending
+    invalidations, or None if it is disabled or unavailable."""
+    if settings.LOCAL_CACHE_MAX_ENTRIES == 0:
+        return None
+    with local_cache_setup_lock:
+        return _get_local_cache()
+
+def _get_local_cache():
+    # type: () -> Optional[LocalCache]
+    global local_cache
+    global local_cache_pubsub
+    global local_cache_redis_client
+    global local_cache_pid
+    global local_cache_origin
+    if local_cache_pid != os.getpid():
+        local_cache = None
+        local_cache_pubsub = None
+        local_cache_redis_client = None
+        local_cache_pid = os.getpid()
+        local_cache_origin = u"%s:%s" % (local_cache_pid, random.getrandbits(64))
+    if local_cache is None or local_cache.max_entries != settings.LOCAL_CACHE_MAX_ENTRIES:
+        local_cache = LocalCache(settings.LOCAL_CACHE_MAX_ENTRIES)
+    try:
+        if local_cache_pubsub is None:
+            pubsub = get_redis_client().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(LOCAL_CACHE_INVALIDATION_CHANNEL)
+            local_cache_pubsub = pubsub
+            local_cache.clear()
+        while True:
+            message = local_cache_pubsub.get_message()
+            if message is None:
+                break
+            (origin, keys) = ujson.loads(message['data'])
+            if origin == local_cache_origin:
+                continue
+            for key in keys:
+                local_cache.delete(key)
+    except redis.exceptions.ConnectionError:
+        # We may have missed invalidations, so start over once redis is back.
+        logging.warning("Could not read local cache invalidations; bypassing the local cache")
+        local_cache.clear()
+        local_cache_pubsub = None
+        return None
+    return local_cache
+
+def local_cache_ttl(key):
+    # type: (text_type) -> Optional[int]
+    return LOCAL_CACHE_TTLS.get(key.split(u':', 1)[0])
+
+def local_cache_update(items, publish):
+    # type: (Dict[text_type, Any], bool) -> None
+    """Stores the given (prefixed) keys and values in the local cache,
+    where their family is cached locally; a value of None deletes the
+    key.  If `publish` is set, other processes are told to drop their
+    copies of the keys."""
+    global local_cache_redis_client
+    keys = [key for key in items if local_cache_ttl(key[len(KEY_PREFIX):]) is not None]
+    if not keys or settings.LOCAL_CACHE_MAX_ENTRIES == 0:
+        return
+    local = get_local_cache()
+    if publish:
+        try:
+            with local_cache_setup_lock:
+                if local_cache_redis_client is None:
+                    local_cache_redis_client = get_redis_client()
+            local_cache_redis_client.publish(LOCAL_CACHE_INVALIDATION_CHANNEL,
+                                             ujson.dumps([local_cache_origin, keys]))
+        except redis.exceptions.ConnectionError:
+            logging.warning("Could not publish local cache invalidations for %s" % (keys,))
+    if local is None:
+        return
+    for key in keys:
+        if items[key] is None:
+            local.delete(key)
+        else:
+            local.set(key, items[key], local_cache_ttl(key[len(KEY_PREFIX):]))
+
 def get_cache_backend(cache_name):
     # type: (Optional[str]) -> BaseCache
     if cache_name is None:
@@ -142,7 +311,9 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
 
             val = func(*args, **kwargs)
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            # This is just filling the cache, so other processes'
+            # local caches needn't be invalidated.
+            cache_set(key, val, cache_name=cache_name, timeout=timeout, invalidate=False)
 
             return val
 
@@ -150,31 +321,84 @@ def cache_with_key(keyfunc, cache_name=None, timeout=None, with_statsd_key=None)
 
     return decorator
 
-def cache_set(key, val, cache_name=None, timeout=None):
-    # type: (text_type, Any, Optional[str], Optional[int]) -> None
+def cache_set(key, val, cache_name=None, timeout=None, invalidate=True):
+    # type: (text_type, Any, Optional[str], Optional[int], bool) -> None
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        local_cache_update({KEY_PREFIX + key: (val,)}, publish=invalidate)
+
+def cache_add(key, val, cache_name=None, timeout=None):
+    # type: (text_type, Any, Optional[str], Optional[int]) -> bool
+    """Sets the key only if it isn't already set, atomically.  Returns
+    whether it was set."""
+    remote_cache_stats_start()
+    cache_backend = get_cache_backend(cache_name)
+    ret = cache_backend.add(KEY_PREFIX + key, (val,), timeout=timeout)
+    remote_cache_stats_finish()
+    return ret
 
 def cache_get(key, cache_name=None):
     # type: (text_type, Optional[str]) -> Any
+    local = None
+    if cache_name is None and local_cache_ttl(key) is not None:
+        local = get_local_cache()
+    if local is not None:
+        ret = local.get(KEY_PREFIX + key)
+        if ret is not None:
+            statsd.incr("cache.local.hit")
+            return ret
+        statsd.incr("cache.local.miss")
+
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     ret = cache_backend.get(KEY_PREFIX + key)
     remote_cache_stats_finish()
+
+    if local is not None:
+        statsd.incr("cache.remote.%s" % ("hit" if ret is not None else "miss",))
+        if ret is not None:
+            local.set(KEY_PREFIX + key, ret, local_cache_ttl(key))
     return ret
 
 def cache_get_many(keys, cache_name=None):
     # type: (List[text_type], Optional[str]) -> Dict[text_type, Any]
     keys = [KEY_PREFIX + key for key in keys]
-    remote_cache_stats_start()
-    ret = get_cache_backend(cache_name).get_many(keys)
-    remote_cache_stats_finish()
+    local = None
+    local_keys = [] # type: List[text_type]
+    if cache_name is None:
+        local_keys = [key for key in keys if local_cache_ttl(key[len(KEY_PREFIX):]) is not None]
+        if local_keys:
+            local = get_local_cache()
+
+    ret = {} # type: Dict[text_type, Any]
+    if local is not None:
+        for key in local_keys:
+            val = local.get(key)
+            if val is not None:
+                ret[key] = val
+        statsd.incr("cache.local.hit", len(ret))
+        statsd.incr("cache.local.miss", len(local_keys) - len(ret))
+        keys = [key for key in keys if key not in ret]
+
+    if keys:
+        remote_cache_stats_start()
+        remote_ret = get_cache_backend(cache_name).get_many(keys)
+        remote_cache_stats_finish()
+        if local is not None:
+            remote_local_keys = [key for key in local_keys if key not in ret]
+            remote_hits = [key for key in remote_local_keys if key in remote_ret]
+            statsd.incr("cache.remote.hit", len(remote_hits))
+            statsd.incr("cache.remote.miss", len(remote_local_keys) - len(remote_hits))
+            for key in remote_hits:
+                local.set(key, remote_ret[key], local_cache_ttl(key[len(KEY_PREFIX):]))
+        ret.update(remote_ret)
     return dict([(key[len(KEY_PREFIX):], value) for key, value in ret.items()])
 
-def cache_set_many(items, cache_name=None, timeout=None):
-    # type: (Dict[text_type, Any], Optional[str], Optional[int]) -> None
+def cache_set_many(items, cache_name=None, timeout=None, invalidate=True):
+    # type: (Dict[text_type, Any], Optional[str], Optional[int], bool) -> None
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
@@ -182,19 +406,25 @@ def cache_set_many(items, cache_name=None, timeout=None):
     remote_cache_stats_start()
     get_cache_backend(cache_name).set_many(items, timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        local_cache_update(items, publish=invalidate)
 
 def cache_delete(key, cache_name=None):
     # type: (text_type, Optional[str]) -> None
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    if cache_name is None:
+        local_cache_update({KEY_PREFIX + key: None}, publish=True)
 
 def cache_delete_many(items, cache_name=None):
     # type: (Iterable[text_type], Optional[str]) -> None
+    keys = [KEY_PREFIX + item for item in items]
     remote_cache_stats_start()
-    get_cache_backend(cache_name).delete_many(
-        KEY_PREFIX + item for item in items)
+    get_cache_backend(cache_name).delete_many(keys)
     remote_cache_stats_finish()
+    if cache_name is None:
+        local_cache_update(dict((key, None) for key in keys), publish=True)
 
 # Required Arguments are as follows:
 # * object_ids: The list of object ids to look up
@@ -205,11 +435,22 @@ def cache_delete_many(items, cache_name=None):
 # * extractor: Function to call on items returned from cache
 #   (e.g. decompression).  Should be the inverse of the setter
 #   function.
+# * bulk_extractor: Alternative to extractor, called once with the
+#   list of all the items returned from cache, returning a list of
+#   the extracted items (e.g. to fetch what they refer to in bulk).
 # * id_fetcher: Function mapping an object from database => object_id
 #   (in case we're using a key more complex than obj.id)
 # * cache_transformer: Function mapping an object from database =>
 #   value for cache (in case the values that we're caching are some
 #   function of the objects, not the objects themselves)
+# * single_flight: If set, concurrent calls missing the same set of
+#   keys coordinate through a lease in the remote cache, so that only
+#   one of them queries the database while the others wait for it to
+#   fill the cache.  Hot items are also refreshed a little before they
+#   expire, by one caller, while the others keep using the cached
+#   values.  See bulk_fetch_lease_cache_key.
+# * timeout: How long to cache the items fetched for; by default they
+#   don't expire (though memcached may evict them).
 ObjKT = TypeVar('ObjKT', int, text_type)
 ItemT = Any # https://github.com/python/mypy/issues/1721
 CompressedItemT = Any # https://github.com/python/mypy/issues/1721
@@ -217,30 +458,127 @@ def generic_bulk_cached_fetch(cache_key_function, query_function, object_ids,
                               extractor=lambda obj: obj,
                               setter=lambda obj: obj,
                               id_fetcher=lambda obj: obj.id,
-                              cache_transformer=lambda obj: obj):
-    # type: (Callable[[ObjKT], text_type], Callable[[List[ObjKT]], Iterable[Any]], Iterable[ObjKT], Callable[[CompressedItemT], ItemT], Callable[[ItemT], CompressedItemT], Callable[[Any], ObjKT], Callable[[Any], ItemT]) -> Dict[ObjKT, Any]
+                              cache_transformer=lambda obj: obj,
+                              single_flight=False,
+                              timeout=None,
+                              bulk_extractor=None):
+    # type: (Callable[[ObjKT], text_type], Callable[[List[ObjKT]], Iterable[Any]], Iterable[ObjKT], Callable[[CompressedItemT], ItemT], Callable[[ItemT], CompressedItemT], Callable[[Any], ObjKT], Callable[[Any], ItemT], bool, Optional[int], Optional[Callable[[List[CompressedItemT]], List[ItemT]]]) -> Dict[ObjKT, Any]
+    if bulk_extractor is None:
+        bulk_extractor = lambda items: [extractor(item) for item in items]
     cache_keys = {} # type: Dict[ObjKT, text_type]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
     cached_objects = cache_get_many([cache_keys[object_id]
                                      for object_id in object_ids])
+    now = time.time()
+    refresh_keys = set() # type: Set[text_type]
     for (key, val) in cached_objects.items():
-        cached_objects[key] = extractor(cached_objects[key][0])
+        if single_flight and should_refresh_early(val, now):
+            refresh_keys.add(key)
+    cached_objects = extract_cached_items(cached_objects, bulk_extractor)
     needed_ids = [object_id for object_id in object_ids if
                   cache_keys[object_id] not in cached_objects]
-    db_objects = query_function(needed_ids)
-
-    items_for_remote_cache = {} # type: Dict[text_type, Any]
-    for obj in db_objects:
-        key = cache_keys[id_fetcher(obj)]
-        item = cache_transformer(obj)
-        items_for_remote_cache[key] = (setter(item),)
-        cached_objects[key] = item
-    if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+
+    lease_key = None # type: Optional[text_type]
+    if single_flight and (needed_ids or refresh_keys):
+        refresh_ids = [object_id for object_id in object_ids
+                       if cache_keys[object_id] in refresh_keys]
+        lease_key = bulk_fetch_lease_cache_key([cache_keys[object_id]
+                                                for object_id in needed_ids + refresh_ids])
+        if cache_add(lease_key, True, timeout=BULK_FETCH_LEASE_SECS):
+            needed_ids += refresh_ids
+        else:
+            # Someone else is already fetching these; serve the
+            # cached values of any we'd have refreshed, and give them
+            # a moment to fill in the missing ones.
+            lease_key = None
+            needed_ids = wait_for_bulk_fetch(cache_keys, needed_ids, cached_objects, bulk_extractor)
+
+    try:
+        query_start = time.time()
+        db_objects = query_function(needed_ids)
+
+        items_for_remote_cache = {} # type: Dict[text_type, Any]
+        for obj in db_objects:
+            key = cache_keys[id_fetcher(obj)]
+            item = cache_transformer(obj)
+            items_for_remote_cache[key] = (setter(item),)
+            cached_objects[key] = item
+        if single_flight:
+            query_time = time.time() - query_start
+            for key in items_for_remote_cache:
+                items_for_remote_cache[key] = expiring_cache_item(
+                    items_for_remote_cache[key][0], timeout, query_time)
+        if len(items_for_remote_cache) > 0:
+            cache_set_many(items_for_remote_cache, timeout=timeout, invalidate=False)
+    finally:
+        # Don't leave the others waiting out the lease if we failed.
+        if lease_key is not None:
+            cache_delete(lease_key)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
+# How long a lease on fetching a set of keys lasts, in case its
+# holder dies without releasing it...
+BULK_FETCH_LEASE_SECS = 5
+# ...and for how long others wait for the holder, before fetching the
+# keys themselves.
+BULK_FETCH_WAIT_SECS = 1.0
+BULK_FETCH_POLL_SECS = 0.05
+# Scales how early, relative to the time they took to fetch, items
+# are refreshed before they expire.
+EARLY_REFRESH_BETA = 1.0
+
+def extract_cached_items(cached, bulk_extractor):
+    # type: (Dict[text_type, Tuple[Any, ...]], Callable[[List[CompressedItemT]], List[ItemT]]) -> Dict[text_type, Any]
+    keys = list(cached.keys())
+    return dict(zip(keys, bulk_extractor([cached[key][0] for key in keys])))
+
+def bulk_fetch_lease_cache_key(keys):
+    # type: (Iterable[text_type]) -> text_type
+    return u"bulk_fetch_lease:%s" % (make_safe_digest(u",".join(sorted(keys))),)
+
+def expiring_cache_item(val, timeout, fetch_time):
+    # type: (Any, Optional[int], float) -> Tuple[Any, Optional[float], float]
+    """Wraps a value for the remote cache with when it expires and how
+    long it took to fetch, for should_refresh_early.  Code that
+    caches items read with generic_bulk_cached_fetch(single_flight=True)
+    should store them this way, so that they too are refreshed early."""
+    expires = None if timeout is None else time.time() + timeout
+    return (val, expires, fetch_time)
+
+def should_refresh_early(val, now):
+    # type: (Tuple[Any, ...], float) -> bool
+    """Probabilistic early expiration: decide to refresh an item with a
+    probability that grows as it nears expiry, and the sooner the
+    longer it took to fetch, so that a hot item is usually refreshed
+    by a single caller before it expires."""
+    if len(val) < 3:
+        return False
+    (_, expires, fetch_time) = val
+    if expires is None:
+        # It won't expire, so there's no need to refresh it.
+        return False
+    return now - fetch_time * EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= expires
+
+def wait_for_bulk_fetch(cache_keys, needed_ids, cached_objects, bulk_extractor):
+    # type: (Dict[ObjKT, text_type], List[ObjKT], Dict[text_type, Any], Callable[[List[CompressedItemT]], List[ItemT]]) -> List[ObjKT]
+    """Waits for another process to fill the cache with the needed
+    items, adding them to cached_objects as they appear.  Returns the
+    ids of those still missing after BULK_FETCH_WAIT_SECS."""
+    if settings.RUNNING_INSIDE_TORNADO:
+        # Never block the IOLoop
+        return needed_ids
+    deadline = time.time() + BULK_FETCH_WAIT_SECS
+    while needed_ids and time.time() < deadline:
+        time.sleep(BULK_FETCH_POLL_SECS)
+        found = cache_get_many([cache_keys[object_id] for object_id in needed_ids])
+        cached_objects.update(extract_cached_items(found, bulk_extractor))
+        needed_ids = [object_id for object_id in needed_ids
+                      if cache_keys[object_id] not in cached_objects]
+    statsd.incr("cache.bulk_fetch.%s" % ("coalesced" if not needed_ids else "wait_timeout",))
+    return needed_ids
+
 def cache(func):
     # type: (FuncT) -> FuncT
     """Decorator which applies Django caching to a function.
@@ -274,6 +612,15 @@ def user_profile_by_id_cache_key(user_profile_id):
     # type: (int) -> text_type
     return u"user_profile_by_id:%s" % (user_profile_id,)
 
+def message_user_cache_key(user_profile_id):
+    # type: (int) -> text_type
+    return u"message_user:%s" % (user_profile_id,)
+
+# The fields of a user that cached message dicts are filled in from;
+# see zerver.models.get_message_user_dict.
+message_user_fields = ['email', 'full_name', 'short_name', 'avatar_source',
+                       'is_mirror_dummy', 'realm'] # type: List[str]
+
 # TODO: Refactor these cache helpers into another file that can import
 # models.py so that python3-style type annotations can also work.
 
@@ -324,7 +671,14 @@ def flush_user_profile(sender, **kwargs):
     # the fields in the dict or become (in)active
     if kwargs.get('update_fields') is None or \
         len(set(active_user_dict_fields + ['is_active']) & set(kwargs['update_fields'])) > 0:
-        cache_delete(active_user_dicts_in_realm_cache_key(user_profile.realm))
+        cache_delete_many([active_user_dicts_in_realm_cache_key(user_profile.realm),
+                           realm_users_generation_cache_key(user_profile.realm)])
+
+    # Invalidate the sender and recipient info cached message dicts
+    # are filled in from
+    if kwargs.get('update_fields') is None or \
+            len(set(message_user_fields) & set(kwargs['update_fields'])) > 0:
+        cache_delete(message_user_cache_key(user_profile.id))
 
     # Invalidate our active_bots_in_realm info dict if any bot has
     # changed the fields in the dict or become (in)active
@@ -336,7 +690,14 @@ def flush_user_profile(sender, **kwargs):
     # Invalidate realm-wide alert words cache if any user in the realm has changed
     # alert words
     if kwargs.get('update_fields') is None or "alert_words" in kwargs['update_fields']:
-        cache_delete(realm_alert_words_cache_key(user_profile.realm))
+        cache_delete_many([realm_alert_words_cache_key(user_profile.realm),
+                           realm_alert_words_generation_cache_key(user_profile.realm)])
+
+    # Invalidate the user's cached presence, which includes whether
+    # they can be sent push notifications
+    if kwargs.get('update_fields') is None or \
+            len(set(['is_active', 'enable_offline_push_notifications']) & set(kwargs['update_fields'])) > 0:
+        cache_delete(user_presence_cache_key(user_profile.id))
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -346,16 +707,50 @@ def flush_realm(sender, **kwargs):
     realm = kwargs['instance']
     users = realm.get_active_users()
     update_user_profile_caches(users)
+    # They include the realm's domain
+    cache_delete_many([message_user_cache_key(user_profile.id) for user_profile in users])
 
     if realm.deactivated:
-        cache_delete(active_user_dicts_in_realm_cache_key(realm))
+        cache_delete_many([active_user_dicts_in_realm_cache_key(realm),
+                           realm_users_generation_cache_key(realm)])
         cache_delete(active_bot_dicts_in_realm_cache_key(realm))
-        cache_delete(realm_alert_words_cache_key(realm))
+        cache_delete_many([realm_alert_words_cache_key(realm),
+                           realm_alert_words_generation_cache_key(realm)])
+
+# Called by models.py to flush a user's cached presence whenever we
+# save one of their UserPresence rows
+def flush_user_presence(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    presence = kwargs['instance']
+    cache_delete(user_presence_cache_key(presence.user_profile_id))
+
+def user_presence_cache_key(user_profile_id):
+    # type: (int) -> text_type
+    return u"user_presence:%s" % (user_profile_id,)
+
+def search_generation_cache_key(realm_id):
+    # type: (int) -> text_type
+    # Part of the cache keys for search results in the realm; deleting
+    # it invalidates them.
+    return u"search_generation:%s" % (realm_id,)
 
 def realm_alert_words_cache_key(realm):
     # type: (Realm) -> text_type
     return u"realm_alert_words:%s" % (realm.domain,)
 
+def realm_alert_words_generation_cache_key(realm):
+    # type: (Realm) -> text_type
+    # Deleting it tells every process to rebuild its AlertWordMatcher
+    # for the realm.
+    return u"realm_alert_words_generation:%s" % (realm.id,)
+
+def realm_users_generation_cache_key(realm):
+    # type: (Realm) -> text_type
+    # Part of the render cache keys for messages that may mention
+    # users; deleting it, whenever the realm's active users or their
+    # names change, invalidates them.
+    return u"realm_users_generation:%s" % (realm.id,)
+
 # Called by models.py to flush the stream cache whenever we save a stream
 # object.
 def flush_stream(sender, **kwargs):
@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Dict, Callable, Tuple
+from typing import Any, Dict, Callable, List, Optional, Tuple
 
 # This file needs to be different from cache.py because cache.py
 # cannot import anything from zerver.models or we'd have an import
@@ -9,29 +9,58 @@ from typing import Any, Dict, Callable, Tuple
 from django.conf import settings
 from zerver.models import Message, UserProfile, Stream, get_stream_cache_key, \
     Recipient, get_recipient_cache_key, Client, get_client_cache_key, \
-    Huddle, huddle_hash_cache_key, to_dict_cache_key_id
+    Huddle, huddle_hash_cache_key, to_dict_cache_key_id, UserPresence, \
+    stringify_message_dict
 from zerver.lib.cache import cache_with_key, cache_set, \
     user_profile_by_email_cache_key, user_profile_by_id_cache_key, \
     get_remote_cache_time, get_remote_cache_requests, cache_set_many
 from django.utils.importlib import import_module
+from django.utils import timezone
 from django.contrib.sessions.models import Session
+from datetime import timedelta
 import logging
-from django.db.models import Q
+import time
+from django.db import connection
+from django.db.models import Q, Max, Min
+import multiprocessing
+import os
+import ujson
 
 MESSAGE_CACHE_SIZE = 75000
+# Users and streams active within this long are warmed up first.
+ACTIVE_WARMUP_SECS = 3600*24
 
-def message_fetch_objects():
-    # type: () -> List[Any]
+def recent_message_min_id():
+    # type: () -> int
     try:
         max_id = Message.objects.only('id').order_by("-id")[0].id
     except IndexError:
-        return []
-    return Message.objects.select_related().filter(~Q(sender__email='tabbott/extra@mit.edu'),
-                                                    id__gt=max_id - MESSAGE_CACHE_SIZE)
+        max_id = 0
+    return max_id - MESSAGE_CACHE_SIZE
+
+def message_fetch_objects():
+    # type: () -> Any
+    return Message.objects.filter(~Q(sender__email='tabbott/extra@mit.edu'),
+                                  id__gt=recent_message_min_id()) \
+                          .values(*Message.RAW_DB_ROW_FIELDS)
+
+def active_user_fetch_objects():
+    # type: () -> Any
+    cutoff = timezone.now() - timedelta(seconds=ACTIVE_WARMUP_SECS)
+    return UserProfile.objects.select_related().filter(
+        id__in=UserPresence.objects.filter(timestamp__gt=cutoff).values('user_profile_id'))
 
-def message_cache_items(items_for_remote_cache, message):
-    # type: (Dict[text_type, Tuple[Message]], Message) -> None
-    items_for_remote_cache[to_dict_cache_key_id(message.id, True)] = (message.to_dict_uncached(True),)
+def active_stream_fetch_objects():
+    # type: () -> Any
+    recent_recipient_ids = Message.objects.filter(id__gt=recent_message_min_id()).values('recipient_id')
+    return Stream.objects.select_related().filter(
+        id__in=Recipient.objects.filter(type=Recipient.STREAM,
+                                        id__in=recent_recipient_ids).values('type_id'))
+
+def message_cache_items(items_for_remote_cache, row):
+    # type: (Dict[text_type, Tuple[bytes]], Dict[str, Any]) -> None
+    message_dict = Message.build_dict_from_raw_db_row(row, True)
+    items_for_remote_cache[to_dict_cache_key_id(row['id'], True)] = (stringify_message_dict(message_dict),)
 
 def user_cache_items(items_for_remote_cache, user_profile):
     # type: (Dict[text_type, Tuple[UserProfile]], UserProfile) -> None
@@ -67,6 +96,8 @@ def session_cache_items(items_for_remote_cache, session):
 # wrapper the below adds an extra 3ms or so to startup time for
 # anything importing this file).
 cache_fillers = {
+    'active_user': (active_user_fetch_objects, user_cache_items, 3600*24*7, 10000),
+    'active_stream': (active_stream_fetch_objects, stream_cache_items, 3600*24*7, 10000),
     'user': (lambda: UserProfile.objects.select_related().all(), user_cache_items, 3600*24*7, 10000),
     'client': (lambda: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
     'recipient': (lambda: Recipient.objects.select_related().all(), recipient_cache_items, 3600*24*7, 10000),
@@ -76,20 +107,112 @@ cache_fillers = {
     'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
     } # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[text_type, Any], Any], None], int, int]]
 
-def fill_remote_cache(cache):
-    # type: (str) -> None
+# The order in which warm_remote_caches fills the caches: what the
+# recently active users will need first.
+cache_warmup_order = ['active_user', 'active_stream', 'client', 'recipient', 'stream',
+                      'message', 'user', 'huddle', 'session']
+
+# Caches whose objects aren't keyed by an integer id; these are filled
+# as a single shard.
+unsharded_caches = set(['session'])
+
+# A shard is (cache, min id, max id), covering min id <= id < max id.
+CacheShard = Tuple[str, Optional[int], Optional[int]]
+
+def fill_remote_cache(cache, min_id=None, max_id=None):
+    # type: (str, Optional[int], Optional[int]) -> int
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
     items_for_remote_cache = {} # type: Dict[text_type, Any]
     (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
+    query = objects()
+    if min_id is not None:
+        query = query.filter(id__gte=min_id, id__lt=max_id)
     count = 0
-    for obj in objects():
+    for obj in query.iterator():
         items_filler(items_for_remote_cache, obj)
         count += 1
         if (count % batch_size == 0):
-            cache_set_many(items_for_remote_cache, timeout=3600*24)
+            cache_set_many(items_for_remote_cache, timeout=timeout, invalidate=False)
             items_for_remote_cache = {}
-    cache_set_many(items_for_remote_cache, timeout=3600*24*7)
+    cache_set_many(items_for_remote_cache, timeout=timeout, invalidate=False)
     logging.info("Succesfully populated %s cache!  Consumed %s remote cache queries (%s time)" % \
                      (cache, get_remote_cache_requests() - remote_cache_requests_start,
                       round(get_remote_cache_time() - remote_cache_time_start, 2)))
+    return count
+
+def cache_shards(cache, shard_size):
+    # type: (str, int) -> List[CacheShard]
+    """Splits the objects for a cache into id ranges of shard_size ids,
+    newest first.  The ranges are aligned to multiples of shard_size,
+    so that they stay the same as new objects are created and a
+    checkpoint from an earlier run still matches them."""
+    if cache in unsharded_caches:
+        return [(cache, None, None)]
+    (objects, _, _, _) = cache_fillers[cache]
+    id_range = objects().aggregate(Min('id'), Max('id'))
+    if id_range['id__min'] is None:
+        return []
+    first_shard = id_range['id__min'] // shard_size
+    last_shard = id_range['id__max'] // shard_size
+    return [(cache, shard * shard_size, (shard + 1) * shard_size)
+            for shard in range(last_shard, first_shard - 1, -1)]
+
+def fill_remote_cache_shard(shard):
+    # type: (CacheShard) -> Tuple[CacheShard, int, float]
+    """Fills one shard; returns it with the number of objects cached
+    and the time taken.  Runs in a warm_remote_caches worker."""
+    start = time.time()
+    (cache, min_id, max_id) = shard
+    count = fill_remote_cache(cache, min_id, max_id)
+    return (shard, count, time.time() - start)
+
+def read_warmup_checkpoint(checkpoint_file):
+    # type: (Optional[str]) -> List[CacheShard]
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return []
+    with open(checkpoint_file) as f:
+        return [tuple(ujson.loads(line)) for line in f if line.strip()]
+
+def warm_remote_caches(caches, processes=1, shard_size=10000, checkpoint_file=None):
+    # type: (List[str], int, int, Optional[str]) -> Dict[str, Tuple[int, float]]
+    """Fills the given caches, in order, sharded by id range across a
+    pool of worker processes.  If checkpoint_file is given, each
+    completed shard is recorded there, and shards recorded by an
+    earlier, interrupted run are skipped; the file is removed once
+    everything is filled.  Returns the number of objects cached and
+    the time spent (summed over workers) for each cache."""
+    done = set(read_warmup_checkpoint(checkpoint_file))
+    shards = [shard for cache in caches for shard in cache_shards(cache, shard_size)
+              if shard not in done]
+    if done:
+        logging.info("Resuming cache warmup; skipping %d completed shards" % (len(done),))
+
+    stats = dict((cache, (0, 0.0)) for cache in caches) # type: Dict[str, Tuple[int, float]]
+    checkpoint = None # type: Optional[Any]
+    if checkpoint_file is not None:
+        checkpoint = open(checkpoint_file, "a")
+
+    pool = None # type: Optional[Any]
+    if processes > 1:
+        # The workers open their own database connections.
+        connection.close()
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(fill_remote_cache_shard, shards)
+    else:
+        results = (fill_remote_cache_shard(shard) for shard in shards)
+    try:
+        for (shard, count, elapsed) in results:
+            (total_count, total_elapsed) = stats[shard[0]]
+            stats[shard[0]] = (total_count + count, total_elapsed + elapsed)
+            if checkpoint is not None:
+                checkpoint.write(ujson.dumps(shard) + "\n")
+                checkpoint.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if checkpoint is not None:
+            checkpoint.close()
+    if checkpoint_file is not None:
+        os.remove(checkpoint_file)
+    return stats
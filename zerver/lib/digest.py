@@ -1,19 +1,21 @@
 from __future__ import absolute_import
-from typing import Any, Callable, Iterable, Tuple
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
 
 from collections import defaultdict
 import datetime
+import itertools
 import six
 from six import text_type
+from six.moves import range
 
-from django.db.models import Q, QuerySet
+from django.db.models import Count, F
 from django.template import loader
 from django.conf import settings
 
 from zerver.lib.notifications import build_message_list, hashchange_encode, \
     send_future_email, one_click_unsubscribe_link
-from zerver.models import UserProfile, UserMessage, Recipient, Stream, \
-    Subscription, get_active_streams
+from zerver.models import Client, Message, Realm, UserProfile, UserMessage, \
+    Recipient, Stream, Subscription, get_active_streams
 
 import logging
 
@@ -34,91 +36,198 @@ logger.addHandler(file_handler)
 # 3. New users
 # 4. Interesting stream traffic, as determined by the longest and most
 #    diversely comment upon topics.
-
-def gather_hot_conversations(user_profile, stream_messages):
-    # type: (UserProfile, QuerySet) -> List[Dict[str, Any]]
-    # Gather stream conversations of 2 types:
-    # 1. long conversations
-    # 2. conversations where many different people participated
-    #
-    # Returns a list of dictionaries containing the templating
-    # information for each hot conversation.
-
-    conversation_length = defaultdict(int) # type: Dict[Tuple[int, text_type], int]
-    conversation_diversity = defaultdict(set) # type: Dict[Tuple[int, text_type], Set[text_type]]
-    for user_message in stream_messages:
-        if not user_message.message.sent_by_human():
-            # Don't include automated messages in the count.
-            continue
-
-        key = (user_message.message.recipient.type_id,
-               user_message.message.subject)
-        conversation_diversity[key].add(
-            user_message.message.sender.full_name)
-        conversation_length[key] += 1
-
-    diversity_list = list(conversation_diversity.items())
-    diversity_list.sort(key=lambda entry: len(entry[1]), reverse=True)
-
-    length_list = list(conversation_length.items())
-    length_list.sort(key=lambda entry: entry[1], reverse=True)
-
-    # Get up to the 4 best conversations from the diversity list
-    # and length list, filtering out overlapping conversations.
-    hot_conversations = [elt[0] for elt in diversity_list[:2]]
-    for candidate, _ in length_list:
-        if candidate not in hot_conversations:
-            hot_conversations.append(candidate)
-        if len(hot_conversations) >= 4:
-            break
-
-    # There was so much overlap between the diversity and length lists that we
-    # still have < 4 conversations. Try to use remaining diversity items to pad
-    # out the hot conversations.
-    num_convos = len(hot_conversations)
-    if num_convos < 4:
-        hot_conversations.extend([elt[0] for elt in diversity_list[num_convos:4]])
-
-    hot_conversation_render_payloads = []
-    for h in hot_conversations:
-        stream_id, subject = h
-        users = list(conversation_diversity[h])
-        count = conversation_length[h]
+#
+# Public stream traffic and the new streams and users are the same for
+# everyone in a realm, so they're gathered once for all the realm's
+# users getting a digest, with a few aggregate queries.  Private stream
+# traffic is gathered from each user's own UserMessages, so that a
+# digest never shows messages its recipient didn't receive.  Each
+# user's hot conversations are then picked from those in the streams
+# they have in their home view.  The users are handled in batches of
+# DIGEST_BATCH_SIZE, with each batch's subscriptions, private stream
+# traffic and missed PMs loaded in one query apiece.
+
+DIGEST_BATCH_SIZE = 500
+
+# Show up to 4 missed PMs and 4 hot conversations.
+PMS_LIMIT = 4
+HOT_CONVERSATIONS_LIMIT = 4
+
+ConversationKey = Tuple[int, text_type]
+Conversations = Dict[ConversationKey, Tuple[int, List[text_type]]]
+
+def human_client_ids():
+    # type: () -> List[int]
+    return [client.id for client in Client.objects.all()
+            if Message.is_human_client(client)]
+
+def group_conversations(rows, prefix=''):
+    # type: (Iterable[Dict[str, Any]], str) -> Conversations
+    # Rows of message counts per conversation and sender, keyed by
+    # (recipient id, subject), to the number of messages in each
+    # conversation and the names of the people who took part.
+    conversation_length = defaultdict(int) # type: Dict[ConversationKey, int]
+    conversation_participants = defaultdict(list) # type: Dict[ConversationKey, List[text_type]]
+    for row in rows:
+        key = (row[prefix + 'recipient_id'], row[prefix + 'subject'])
+        conversation_length[key] += row['count']
+        conversation_participants[key].append(row[prefix + 'sender__full_name'])
+    return dict((key, (length, sorted(conversation_participants[key])))
+                for (key, length) in six.iteritems(conversation_length))
+
+def public_stream_recipient_ids(realm):
+    # type: (Realm) -> List[int]
+    # All streams are private at MIT (see Stream.is_public).
+    if realm.domain == "mit.edu":
+        return []
+    return list(Recipient.objects.filter(
+        type=Recipient.STREAM,
+        type_id__in=Stream.objects.filter(realm=realm, invite_only=False).values('id')).values_list(
+        'id', flat=True))
+
+def gather_realm_conversations(realm, threshold, recipient_ids):
+    # type: (Realm, datetime.datetime, List[int]) -> Conversations
+    """The conversations in the realm's public streams (given by their
+    recipient ids) since the threshold.  Automated messages aren't
+    counted."""
+    rows = Message.objects.filter(
+        recipient_id__in=recipient_ids,
+        pub_date__gt=threshold,
+        sending_client_id__in=human_client_ids()).values(
+        'recipient_id', 'subject', 'sender__full_name').annotate(count=Count('id'))
+    return group_conversations(rows)
+
+def gather_private_conversations(user_profiles, threshold, public_recipient_ids):
+    # type: (Sequence[UserProfile], datetime.datetime, List[int]) -> Dict[int, Conversations]
+    """Each user's conversations since the threshold in the streams that
+    aren't public, counting only the messages they received."""
+    rows = UserMessage.objects.filter(
+        user_profile__in=user_profiles,
+        message__recipient__type=Recipient.STREAM,
+        message__pub_date__gt=threshold,
+        message__sending_client_id__in=human_client_ids()).exclude(
+        message__recipient_id__in=public_recipient_ids).values(
+        'user_profile_id', 'message__recipient_id', 'message__subject',
+        'message__sender__full_name').annotate(count=Count('id'))
+
+    user_rows = defaultdict(list) # type: Dict[int, List[Dict[str, Any]]]
+    for row in rows:
+        user_rows[row['user_profile_id']].append(row)
+    return dict((user_profile_id, group_conversations(conversation_rows, prefix='message__'))
+                for (user_profile_id, conversation_rows) in six.iteritems(user_rows))
+
+def by_diversity(item):
+    # type: (Tuple[ConversationKey, Tuple[int, List[text_type]]]) -> Tuple[int, int, ConversationKey]
+    (key, (length, participants)) = item
+    return (-len(participants), -length, key)
+
+def by_length(item):
+    # type: (Tuple[ConversationKey, Tuple[int, List[text_type]]]) -> Tuple[int, int, ConversationKey]
+    (key, (length, participants)) = item
+    return (-length, -len(participants), key)
+
+class RealmDigest(object):
+    """The parts of a realm's digests that are the same for every user
+    (see the comment above), and the public stream conversation teasers
+    built so far, which only depend on the conversation."""
+    def __init__(self, realm, threshold):
+        # type: (Realm, datetime.datetime) -> None
+        self.realm = realm
+        self.threshold = threshold
+        self.public_recipient_ids = public_stream_recipient_ids(realm)
+        self.conversations = gather_realm_conversations(realm, threshold, self.public_recipient_ids)
+        self.new_streams_count, self.new_streams = gather_new_streams(realm, threshold)
+        self.new_users_count, self.new_users = gather_new_users(realm, threshold)
+        self.teasers = {} # type: Dict[ConversationKey, Dict[str, Any]]
+
+        # Each public stream's best conversations by each measure; a
+        # user's hot conversations are always among the best few in
+        # their streams.
+        stream_conversations = defaultdict(list) # type: Dict[int, List[Tuple[ConversationKey, Tuple[int, List[text_type]]]]]
+        for item in six.iteritems(self.conversations):
+            stream_conversations[item[0][0]].append(item)
+        self.most_diverse = {} # type: Dict[int, List[Tuple[ConversationKey, Tuple[int, List[text_type]]]]]
+        self.longest = {} # type: Dict[int, List[Tuple[ConversationKey, Tuple[int, List[text_type]]]]]
+        for (recipient_id, items) in six.iteritems(stream_conversations):
+            self.most_diverse[recipient_id] = sorted(items, key=by_diversity)[:HOT_CONVERSATIONS_LIMIT]
+            self.longest[recipient_id] = sorted(items, key=by_length)[:HOT_CONVERSATIONS_LIMIT]
+
+    def hot_conversations(self, recipient_ids, private_conversations={}):
+        # type: (Iterable[int], Conversations) -> List[Tuple[ConversationKey, Tuple[int, List[text_type]]]]
+        # Gather stream conversations of 2 types:
+        # 1. long conversations
+        # 2. conversations where many different people participated
+        #
+        # Up to the 2 best conversations from the diversity list, and
+        # the best from the length list, filtering out overlapping
+        # conversations, up to 4 in all.  Returns them with their
+        # lengths and participants.
+        recipient_ids = set(recipient_ids)
+        private_items = [item for item in six.iteritems(private_conversations)
+                         if item[0][0] in recipient_ids]
+        public_recipient_ids = [recipient_id for recipient_id in recipient_ids
+                                if recipient_id in self.most_diverse]
+        most_diverse = sorted(itertools.chain(private_items, *[
+            self.most_diverse[recipient_id] for recipient_id in public_recipient_ids]), key=by_diversity)
+        longest = sorted(itertools.chain(private_items, *[
+            self.longest[recipient_id] for recipient_id in public_recipient_ids]), key=by_length)
+
+        hot_conversations = most_diverse[:2]
+        for candidate in longest:
+            if len(hot_conversations) >= HOT_CONVERSATIONS_LIMIT:
+                break
+            if candidate not in hot_conversations:
+                hot_conversations.append(candidate)
+        return hot_conversations
+
+    def teaser(self, user_profile, item):
+        # type: (UserProfile, Tuple[ConversationKey, Tuple[int, List[text_type]]]) -> Dict[str, Any]
+        """The templating information for a hot conversation."""
+        (key, (count, participants)) = item
+        (recipient_id, subject) = key
+        if key in self.teasers:
+            return self.teasers[key]
 
         # We'll display up to 2 messages from the conversation.
-        first_few_messages = [user_message.message for user_message in \
-                                  stream_messages.filter(
-                message__recipient__type_id=stream_id,
-                message__subject=subject)[:2]]
-
-        teaser_data = {"participants": users,
-                       "count": count - len(first_few_messages),
-                       "first_few_messages": build_message_list(
-                user_profile, first_few_messages)}
-
-        hot_conversation_render_payloads.append(teaser_data)
-    return hot_conversation_render_payloads
-
-def gather_new_users(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, List[text_type]]
+        if key in self.conversations:
+            first_few_messages = list(Message.objects.filter(
+                recipient_id=recipient_id, subject=subject,
+                pub_date__gt=self.threshold).select_related(
+                'sender', 'recipient').order_by('pub_date')[:2])
+        else:
+            first_few_messages = [user_message.message for user_message in UserMessage.objects.filter(
+                user_profile=user_profile, message__recipient_id=recipient_id,
+                message__subject=subject, message__pub_date__gt=self.threshold).select_related(
+                'message__sender', 'message__recipient').order_by('message__pub_date')[:2]]
+
+        teaser = {"participants": participants,
+                  "count": count - len(first_few_messages),
+                  "first_few_messages": build_message_list(
+                      user_profile, first_few_messages)}
+        if key in self.conversations:
+            # Public stream message lists don't depend on the user.
+            self.teasers[key] = teaser
+        return teaser
+
+def gather_new_users(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, List[text_type]]
     # Gather information on users in the realm who have recently
     # joined.
-    if user_profile.realm.domain == "mit.edu":
-        new_users = [] # type: List[UserProfile]
+    if realm.domain == "mit.edu":
+        user_names = [] # type: List[text_type]
     else:
-        new_users = list(UserProfile.objects.filter(
-                realm=user_profile.realm, date_joined__gt=threshold,
-                is_bot=False))
-    user_names = [user.full_name for user in new_users]
+        user_names = list(UserProfile.objects.filter(
+                realm=realm, date_joined__gt=threshold,
+                is_bot=False).values_list('full_name', flat=True))
 
     return len(user_names), user_names
 
-def gather_new_streams(user_profile, threshold):
-    # type: (UserProfile, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
-    if user_profile.realm.domain == "mit.edu":
+def gather_new_streams(realm, threshold):
+    # type: (Realm, datetime.datetime) -> Tuple[int, Dict[str, List[text_type]]]
+    if realm.domain == "mit.edu":
         new_streams = [] # type: List[Stream]
     else:
-        new_streams = list(get_active_streams(user_profile.realm).filter(
+        new_streams = list(get_active_streams(realm).filter(
                 invite_only=False, date_created__gt=threshold))
 
     base_url = u"https://%s/#narrow/stream/" % (settings.EXTERNAL_HOST,)
@@ -134,6 +243,36 @@ def gather_new_streams(user_profile, threshold):
 
     return len(new_streams), {"html": streams_html, "plain": streams_plain}
 
+def gather_missed_pms(user_profiles, threshold):
+    # type: (Sequence[UserProfile], datetime.datetime) -> Dict[int, Tuple[List[Message], int]]
+    """The first PMS_LIMIT of each user's PMs since the threshold, and
+    how many there are.  You can't have an unread message that you
+    sent, but when testing this causes confusion so filter your
+    messages out."""
+    pm_ids = defaultdict(list) # type: Dict[int, List[int]]
+    for (user_profile_id, message_id) in UserMessage.objects.filter(
+            user_profile__in=user_profiles,
+            message__pub_date__gt=threshold).exclude(
+            message__recipient__type=Recipient.STREAM).exclude(
+            message__sender=F('user_profile')).order_by(
+            'message__pub_date').values_list('user_profile_id', 'message_id'):
+        pm_ids[user_profile_id].append(message_id)
+
+    messages = Message.objects.select_related('sender', 'recipient').in_bulk(
+        [message_id for message_ids in pm_ids.values() for message_id in message_ids[:PMS_LIMIT]])
+    return dict((user_profile_id, ([messages[message_id] for message_id in message_ids[:PMS_LIMIT]],
+                                   len(message_ids)))
+                for (user_profile_id, message_ids) in six.iteritems(pm_ids))
+
+def gather_home_view_recipient_ids(user_profiles):
+    # type: (Sequence[UserProfile]) -> Dict[int, List[int]]
+    recipient_ids = defaultdict(list) # type: Dict[int, List[int]]
+    for (user_profile_id, recipient_id) in Subscription.objects.filter(
+            user_profile__in=user_profiles, active=True, in_home_view=True,
+            recipient__type=Recipient.STREAM).values_list('user_profile_id', 'recipient_id'):
+        recipient_ids[user_profile_id].append(recipient_id)
+    return recipient_ids
+
 def enough_traffic(unread_pms, hot_conversations, new_streams, new_users):
     # type: (text_type, text_type, int, int) -> bool
     if unread_pms or hot_conversations:
@@ -158,14 +297,43 @@ def send_digest_email(user_profile, html_content, text_content):
 
 def handle_digest_email(user_profile_id, cutoff):
     # type: (int, int) -> None
-    user_profile=UserProfile.objects.get(id=user_profile_id)
+    handle_digest_emails([user_profile_id], cutoff)
+
+def handle_digest_emails(user_profile_ids, cutoff):
+    # type: (Iterable[int], int) -> None
     # Convert from epoch seconds to a datetime object.
     cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
 
-    all_messages = UserMessage.objects.filter(
-        user_profile=user_profile,
-        message__pub_date__gt=cutoff_date).order_by("message__pub_date")
-
+    users_by_realm = defaultdict(list) # type: Dict[int, List[UserProfile]]
+    for user_profile in UserProfile.objects.filter(id__in=user_profile_ids).select_related('realm'):
+        users_by_realm[user_profile.realm_id].append(user_profile)
+
+    for user_profiles in users_by_realm.values():
+        realm_digest = RealmDigest(user_profiles[0].realm, cutoff_date)
+        for i in range(0, len(user_profiles), DIGEST_BATCH_SIZE):
+            handle_digest_email_batch(realm_digest, user_profiles[i:i + DIGEST_BATCH_SIZE])
+
+def handle_digest_email_batch(realm_digest, user_profiles):
+    # type: (RealmDigest, Sequence[UserProfile]) -> None
+    missed_pms = gather_missed_pms(user_profiles, realm_digest.threshold)
+    home_view_recipient_ids = gather_home_view_recipient_ids(user_profiles)
+    private_conversations = gather_private_conversations(
+        user_profiles, realm_digest.threshold, realm_digest.public_recipient_ids)
+
+    for user_profile in user_profiles:
+        # A failure for one user shouldn't stop (or, when the event is
+        # retried, repeat) the emails to the rest of the batch.
+        try:
+            handle_user_digest_email(realm_digest, user_profile,
+                                     missed_pms.get(user_profile.id, ([], 0)),
+                                     home_view_recipient_ids.get(user_profile.id, []),
+                                     private_conversations.get(user_profile.id, {}))
+        except Exception:
+            logger.exception("Error building digest email for %s" % (user_profile.email,))
+
+def handle_user_digest_email(realm_digest, user_profile, missed_pms, home_view_recipient_ids,
+                             private_conversations):
+    # type: (RealmDigest, UserProfile, Tuple[List[Message], int], List[int], Conversations) -> None
     # Start building email template data.
     template_payload = {
         'name': user_profile.full_name,
@@ -174,50 +342,30 @@ def handle_digest_email(user_profile_id, cutoff):
         } # type: Dict[str, Any]
 
     # Gather recent missed PMs, re-using the missed PM email logic.
-    # You can't have an unread message that you sent, but when testing
-    # this causes confusion so filter your messages out.
-    pms = all_messages.filter(
-        ~Q(message__recipient__type=Recipient.STREAM) & \
-             ~Q(message__sender=user_profile))
-
-    # Show up to 4 missed PMs.
-    pms_limit = 4
-
-    template_payload['unread_pms'] = build_message_list(
-        user_profile, [pm.message for pm in pms[:pms_limit]])
-    template_payload['remaining_unread_pms_count'] = min(0, len(pms) - pms_limit)
-
-    home_view_recipients = [sub.recipient for sub in \
-                                Subscription.objects.filter(
-            user_profile=user_profile, active=True, in_home_view=True)]
-
-    stream_messages = all_messages.filter(
-        message__recipient__type=Recipient.STREAM,
-        message__recipient__in=home_view_recipients)
+    (pms, pms_count) = missed_pms
+    template_payload['unread_pms'] = build_message_list(user_profile, pms)
+    template_payload['remaining_unread_pms_count'] = min(0, pms_count - PMS_LIMIT)
 
     # Gather hot conversations.
-    template_payload["hot_conversations"] = gather_hot_conversations(
-        user_profile, stream_messages)
+    template_payload["hot_conversations"] = [
+        realm_digest.teaser(user_profile, item) for item in
+        realm_digest.hot_conversations(home_view_recipient_ids, private_conversations)]
 
-    # Gather new streams.
-    new_streams_count, new_streams = gather_new_streams(
-        user_profile, cutoff_date)
-    template_payload["new_streams"] = new_streams
-    template_payload["new_streams_count"] = new_streams_count
+    # Gather new streams and users who signed up recently.
+    template_payload["new_streams"] = realm_digest.new_streams
+    template_payload["new_streams_count"] = realm_digest.new_streams_count
+    template_payload["new_users"] = realm_digest.new_users
 
-    # Gather users who signed up recently.
-    new_users_count, new_users = gather_new_users(
-        user_profile, cutoff_date)
-    template_payload["new_users"] = new_users
+    # We don't want to send emails containing almost no information.
+    if not enough_traffic(template_payload["unread_pms"],
+                          template_payload["hot_conversations"],
+                          realm_digest.new_streams_count, realm_digest.new_users_count):
+        return
 
     text_content = loader.render_to_string(
         'zerver/emails/digest/digest_email.txt', template_payload)
     html_content = loader.render_to_string(
         'zerver/emails/digest/digest_email_html.txt', template_payload)
 
-    # We don't want to send emails containing almost no information.
-    if enough_traffic(template_payload["unread_pms"],
-                      template_payload["hot_conversations"],
-                      new_streams_count, new_users_count):
-        logger.info("Sending digest email for %s" % (user_profile.email,))
-        send_digest_email(user_profile, html_content, text_content)
+    logger.info("Sending digest email for %s" % (user_profile.email,))
+    send_digest_email(user_profile, html_content, text_content)
@@ -1,10 +1,10 @@
 from __future__ import absolute_import
-from typing import cast, AbstractSet, Any, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Union
+from typing import cast, AbstractSet, Any, Optional, Iterable, Sequence, Mapping, MutableMapping, Callable, Tuple, Union
 
 from django.utils.translation import ugettext as _
 from django.conf import settings
 from django.utils.timezone import now
-from collections import deque
+from collections import deque, OrderedDict
 import datetime
 import os
 import time
@@ -19,12 +19,13 @@ import tornado
 import tornado.autoreload
 import random
 import traceback
-from zerver.models import UserProfile, Client
+from zerver.models import UserProfile, Client, flush_per_request_caches
 from zerver.decorator import RespondAsynchronously
 from zerver.lib.cache import cache_get_many, \
     user_profile_by_id_cache_key, cache_save_user_profile, cache_with_key
 from zerver.lib.handlers import clear_handler_by_id, get_handler_by_id, \
     finish_handler, handler_stats_string
+from zerver.lib import event_queue_journal
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_restart
 from zerver.lib.narrow import build_narrow_filter
@@ -34,6 +35,7 @@ from zerver.lib.timestamp import timestamp_to_datetime
 import copy
 import six
 from six import text_type
+from six.moves import range, urllib
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
@@ -41,6 +43,24 @@ from six import text_type
 IDLE_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 5
 
+# Limits on the events held in the queue of a client that isn't
+# connected.  A queue exceeding either is garbage collected, and the
+# client gets an error telling it to re-register; see
+# ClientDescriptor.add_event.  Sizes are measured as JSON bytes.
+MAX_QUEUE_EVENTS = 5000
+MAX_QUEUE_BYTES = 4 * 1024 * 1024
+# Allowance for the fields of a message event other than the message
+MESSAGE_EVENT_OVERHEAD_BYTES = 100
+# How long we remember queues removed for exceeding those limits, so
+# that we can say so when their client comes back.
+OVERFLOWED_QUEUE_MEMORY_SECS = 60 * 60 * 24
+
+# How often buffered changes to the event queues are written to the
+# journal, and how far to advance event ids when restoring queues from
+# a journal that wasn't shut down cleanly.
+EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS = 1000
+EVENT_ID_GAP_AFTER_CRASH = 10000
+
 # Capped limit for how long a client can request an event queue
 # to live
 MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
@@ -52,6 +72,68 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# The event system can be partitioned across settings.TORNADO_PROCESSES
+# Tornado processes ("shards"), listening on consecutive ports starting
+# with the one in settings.TORNADO_SERVER.  Each user's event queues
+# live on the shard given by get_tornado_shard; this is the shard the
+# current Tornado process serves (set by runtornado).
+current_tornado_shard = 0
+
+def set_current_tornado_shard(shard):
+    # type: (int) -> None
+    global current_tornado_shard
+    current_tornado_shard = shard
+
+def get_tornado_shard(user_profile_id):
+    # type: (int) -> int
+    return user_profile_id % settings.TORNADO_PROCESSES
+
+def get_tornado_port(shard):
+    # type: (int) -> int
+    return urllib.parse.urlsplit(settings.TORNADO_SERVER).port + shard
+
+def get_tornado_uri(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return settings.TORNADO_SERVER
+    parts = urllib.parse.urlsplit(settings.TORNADO_SERVER)
+    return "%s://%s:%d" % (parts.scheme, parts.hostname, get_tornado_port(shard))
+
+def get_shard_for_queue_id(queue_id):
+    # type: (str) -> int
+    """Queue ids are prefixed with their shard when sharding is enabled;
+    see allocate_client_descriptor.  Raises ValueError if the id names
+    a shard that doesn't exist."""
+    parts = queue_id.split(':')
+    if len(parts) < 3:
+        return 0
+    shard = int(parts[0])
+    if not 0 <= shard < settings.TORNADO_PROCESSES:
+        raise ValueError("No Tornado shard %d" % (shard,))
+    return shard
+
+def get_user_profile_id_for_queue_id(queue_id):
+    # type: (str) -> Optional[int]
+    """The id of the user owning the queue, if the queue id includes it
+    (as it does when sharding is enabled), so that other shards can
+    check who owns it.  Raises ValueError if that id isn't a number."""
+    parts = queue_id.split(':')
+    if len(parts) == 4:
+        return int(parts[1])
+    return None
+
+def notify_tornado_queue_name(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return "notify_tornado"
+    return "notify_tornado_shard%d" % (shard,)
+
+def tornado_return_queue_name(shard):
+    # type: (int) -> str
+    if shard == 0:
+        return "tornado_return"
+    return "tornado_return_shard%d" % (shard,)
+
 class ClientDescriptor(object):
     def __init__(self, user_profile_id, user_profile_email, realm_id, event_queue,
                  event_types, client_type_name, apply_markdown=True,
@@ -123,14 +205,24 @@ class ClientDescriptor(object):
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event):
-        # type: (Dict[str, Any]) -> None
+    def add_event(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_restart(handler._request)
 
-        self.event_queue.push(event)
-        self.finish_current_handler()
+        self.event_queue.push(event, size)
+        if not self.finish_current_handler() and self.event_queue.over_limit():
+            self.remove_overflowed_queue()
+
+    def remove_overflowed_queue(self):
+        # type: () -> None
+        logging.info("Removing event queue %s (%s) with %d events (%d bytes) queued"
+                     % (self.event_queue.id, self.user_profile_email,
+                        len(self.event_queue.queue), self.event_queue.queued_bytes))
+        statsd.incr('tornado.event_queue_overflows')
+        overflowed_queue_ids[self.event_queue.id] = time.time()
+        self.cleanup()
 
     def finish_current_handler(self, need_timeout=False):
         # type: (bool) -> bool
@@ -138,7 +230,8 @@ class ClientDescriptor(object):
             err_msg = "Got error finishing handler for queue %s" % (self.event_queue.id,)
             try:
                 finish_handler(self.current_handler_id, self.event_queue.id,
-                               self.event_queue.contents(), self.apply_markdown)
+                               encode_events(self.event_queue.contents(), self.apply_markdown),
+                               self.apply_markdown)
             except Exception:
                 logging.exception(err_msg)
             finally:
@@ -173,6 +266,7 @@ class ClientDescriptor(object):
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        journal_record(event_queue_journal.CONNECT, self.event_queue.id, self.last_connection_time)
         def timeout_callback():
             # type: () -> None
             self._timeout_handle = None
@@ -232,8 +326,18 @@ def compute_full_event_type(event):
             # Put the "all" case in its own category
             return "all_flags/%s/%s" % (event["flag"], event["operation"])
         return "flags/%s/%s" % (event["operation"], event["flag"])
+    if event["type"] == "presence":
+        return "presence/%s" % (event["email"],)
     return event["type"]
 
+def is_virtual_event_type(full_event_type):
+    # type: (str) -> bool
+    """Events of these types are coalesced with earlier events of the
+    same full type, rather than being queued separately."""
+    return (full_event_type in ["pointer", "restart"] or
+            full_event_type.startswith("flags/") or
+            full_event_type.startswith("presence/"))
+
 class EventQueue(object):
     def __init__(self, id):
         # type: (str) -> None
@@ -241,6 +345,10 @@ class EventQueue(object):
         self.next_event_id = 0 # type: int
         self.id = id # type: str
         self.virtual_events = {} # type: Dict[str, Dict[str, Any]]
+        # Sizes of the events in self.queue, by event id; virtual
+        # events are small and not counted.
+        self.event_sizes = {} # type: Dict[int, int]
+        self.queued_bytes = 0 # type: int
 
     def to_dict(self):
         # type: () -> Dict[str, Any]
@@ -250,7 +358,8 @@ class EventQueue(object):
         return dict(id=self.id,
                     next_event_id=self.next_event_id,
                     queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+                    virtual_events=self.virtual_events,
+                    event_sizes=list(self.event_sizes.items()))
 
     @classmethod
     def from_dict(cls, d):
@@ -259,15 +368,24 @@ class EventQueue(object):
         ret.next_event_id = d['next_event_id']
         ret.queue = deque(d['queue'])
         ret.virtual_events = d.get("virtual_events", {})
+        # Queues saved before we tracked sizes count as empty
+        ret.event_sizes = dict((event_id, size) for (event_id, size) in d.get("event_sizes", []))
+        ret.queued_bytes = sum(ret.event_sizes.values())
         return ret
 
-    def push(self, event):
-        # type: (Dict[str, Any]) -> None
+    def push(self, event, size=None):
+        # type: (Dict[str, Any], Optional[int]) -> None
+        """`size` is the size of the event encoded as JSON, if the caller
+        already knows it (e.g. when pushing one event to many queues)."""
+        full_event_type = compute_full_event_type(event)
+        virtual = is_virtual_event_type(full_event_type)
+        if not virtual and size is None:
+            size = len(ujson.dumps(event))
+        if journal is not None:
+            journal.record_event(self.id, event, size)
         event['id'] = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
-        if (full_event_type in ["pointer", "restart"] or
-            full_event_type.startswith("flags/")):
+        if virtual:
             if full_event_type not in self.virtual_events:
                 self.virtual_events[full_event_type] = copy.deepcopy(event)
                 return
@@ -281,16 +399,29 @@ class EventQueue(object):
             elif full_event_type == "restart":
                 virtual_event["server_generation"] = event["server_generation"]
             elif full_event_type.startswith("flags/"):
-                virtual_event["messages"] += event["messages"]
+                queued_messages = set(virtual_event["messages"])
+                virtual_event["messages"] += [message_id for message_id in event["messages"]
+                                              if message_id not in queued_messages]
+            elif full_event_type.startswith("presence/"):
+                virtual_event["server_timestamp"] = event["server_timestamp"]
+                virtual_event["presence"].update(event["presence"])
         else:
             self.queue.append(event)
+            self.event_sizes[event['id']] = size
+            self.queued_bytes += size
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self):
         # type: () -> Dict[str, Any]
-        return self.queue.popleft()
+        event = self.queue.popleft()
+        self.queued_bytes -= self.event_sizes.pop(event['id'], 0)
+        return event
+
+    def over_limit(self):
+        # type: () -> bool
+        return len(self.queue) > MAX_QUEUE_EVENTS or self.queued_bytes > MAX_QUEUE_BYTES
 
     def empty(self):
         # type: () -> bool
@@ -299,11 +430,15 @@ class EventQueue(object):
     # See the comment on pop; that applies here as well
     def prune(self, through_id):
         # type: (int) -> None
+        if len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
+            journal_record(event_queue_journal.PRUNE, self.id, through_id)
         while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
             self.pop()
 
     def contents(self):
         # type: () -> List[Dict[str, Any]]
+        if self.virtual_events:
+            journal_record(event_queue_journal.CONTENTS, self.id)
         contents = [] # type: List[Dict[str, Any]]
         virtual_id_map = {} # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
@@ -328,10 +463,19 @@ class EventQueue(object):
 
 # maps queue ids to client descriptors
 clients = {} # type: Dict[str, ClientDescriptor]
+# maps ids of queues removed for exceeding MAX_QUEUE_EVENTS or
+# MAX_QUEUE_BYTES to the time they were removed
+overflowed_queue_ids = {} # type: Dict[str, float]
 # maps user id to list of client descriptors
 user_clients = {} # type: Dict[int, List[ClientDescriptor]]
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams = {} # type: Dict[int, List[ClientDescriptor]]
+# Interest index over realm_clients_all_streams, used to route public
+# stream messages without scanning every such client in the realm.
+# Maps realm id to a dict from lowercased stream name to the client
+# descriptors whose narrow is limited to that stream; clients that
+# could want messages on any stream are stored under the key None.
+realm_stream_clients = {} # type: Dict[int, Dict[Optional[text_type], List[ClientDescriptor]]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -358,27 +502,67 @@ def get_client_descriptors_for_realm_all_streams(realm_id):
     # type: (int) -> List[ClientDescriptor]
     return realm_clients_all_streams.get(realm_id, [])
 
+def get_client_descriptors_for_realm_stream(realm_id, stream_name):
+    # type: (int, text_type) -> List[ClientDescriptor]
+    """Returns the clients from realm_clients_all_streams that could
+    accept a message sent to the given public stream.  The result is a
+    superset of the clients that want the message; accepts_event still
+    does the final check."""
+    stream_clients = realm_stream_clients.get(realm_id)
+    if stream_clients is None:
+        return []
+    return stream_clients.get(None, []) + stream_clients.get(stream_name.lower(), [])
+
+def stream_interest_key(client):
+    # type: (ClientDescriptor) -> Tuple[bool, Optional[text_type]]
+    """Returns a pair (interested, stream_name), where interested is
+    False if the client can never accept a stream message, and
+    stream_name is the lowercased stream its narrow is limited to (or
+    None if it isn't limited to a single stream)."""
+    if not client.accepts_messages():
+        return (False, None)
+    stream_name = None # type: Optional[text_type]
+    for element in client.narrow:
+        operator = element[0]
+        operand = element[1]
+        if operator == "is" and operand == "private":
+            return (False, None)
+        if operator == "stream":
+            if stream_name is not None and stream_name != operand.lower():
+                # Narrowed to two different streams; matches nothing
+                return (False, None)
+            stream_name = operand.lower()
+    return (True, stream_name)
+
 def add_to_client_dicts(client):
     # type: (ClientDescriptor) -> None
     user_clients.setdefault(client.user_profile_id, []).append(client)
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        (interested, stream_name) = stream_interest_key(client)
+        if interested:
+            realm_stream_clients.setdefault(client.realm_id, {}).setdefault(stream_name, []).append(client)
 
 def allocate_client_descriptor(new_queue_data):
     # type: (MutableMapping[str, Any]) -> ClientDescriptor
     global next_queue_id
     queue_id = str(settings.SERVER_GENERATION) + ':' + str(next_queue_id)
+    if settings.TORNADO_PROCESSES > 1:
+        # Lets nginx route requests for this queue to the right shard,
+        # and other shards check who owns it
+        queue_id = '%s:%s:%s' % (current_tornado_shard, new_queue_data["user_profile_id"], queue_id)
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    journal_record(event_queue_journal.QUEUE, queue_id, client.to_dict())
     return client
 
 def do_gc_event_queues(to_remove, affected_users, affected_realms):
     # type: (AbstractSet[str], AbstractSet[int], AbstractSet[int]) -> None
     def filter_client_dict(client_dict, key):
-        # type: (MutableMapping[int, List[ClientDescriptor]], int) -> None
+        # type: (MutableMapping[Any, List[ClientDescriptor]], Any) -> None
         if key not in client_dict:
             return
 
@@ -393,8 +577,15 @@ def do_gc_event_queues(to_remove, affected_users, affected_realms):
 
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_stream_clients:
+            stream_clients = realm_stream_clients[realm_id]
+            for stream_name in list(stream_clients.keys()):
+                filter_client_dict(stream_clients, stream_name)
+            if len(stream_clients) == 0:
+                del realm_stream_clients[realm_id]
 
     for id in to_remove:
+        journal_record(event_queue_journal.DELETE, id)
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
@@ -416,71 +607,203 @@ def gc_event_queues():
     # not have a current handler.
     do_gc_event_queues(to_remove, affected_users, affected_realms)
 
+    for (id, overflow_time) in list(overflowed_queue_ids.items()):
+        if start - overflow_time > OVERFLOWED_QUEUE_MEMORY_SECS:
+            del overflowed_queue_ids[id]
+
     logging.info(('Tornado removed %d idle event queues owned by %d users in %.3fs.'
                   + '  Now %d active queues, %s')
                  % (len(to_remove), len(affected_users), time.time() - start,
                     len(clients), handler_stats_string()))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
+    statsd.gauge('tornado.queued_bytes',
+                 sum(client.event_queue.queued_bytes for client in six.itervalues(clients)))
+
+def get_persistent_queue_filename(filename):
+    # type: (str) -> str
+    if settings.TORNADO_PROCESSES == 1:
+        return filename
+    (base, ext) = os.path.splitext(filename)
+    return "%s.%d%s" % (base, current_tornado_shard, ext)
+
+# The journal persisting changes to the event queues; see
+# zerver/lib/event_queue_journal.py.  None when not persisting (e.g. in
+# the test suite).
+journal = None # type: Optional[event_queue_journal.EventQueueJournal]
+
+def journal_record(*record):
+    # type: (*Any) -> None
+    if journal is not None:
+        journal.record(*record)
+
+def snapshot_records():
+    # type: () -> Iterable[Tuple[Any, ...]]
+    for (qid, client) in six.iteritems(clients):
+        yield (event_queue_journal.QUEUE, qid, client.to_dict())
+
+def compact_event_queue_journal():
+    # type: () -> None
+    start = time.time()
+    journal_bytes = journal.compact(snapshot_records())
+    elapsed = time.time() - start
+    logging.info('Tornado wrote a snapshot of %d event queues (%d bytes) in %.3fs'
+                 % (len(clients), journal_bytes, elapsed))
+    statsd.timing('tornado.event_queue_journal.snapshot_time', elapsed * 1000)
+    statsd.gauge('tornado.event_queue_journal.bytes', journal_bytes)
+
+def flush_event_queue_journal():
+    # type: () -> None
+    if journal is None:
+        return
+    journal.flush()
+    if journal.needs_compaction():
+        compact_event_queue_journal()
+
+def open_event_queue_journal(write_snapshot):
+    # type: (bool) -> None
+    global journal
+    journal = event_queue_journal.EventQueueJournal(
+        get_persistent_queue_filename(settings.EVENT_QUEUE_JOURNAL_FILENAME))
+    if write_snapshot:
+        compact_event_queue_journal()
+    else:
+        journal.open()
 
 def dump_event_queues():
     # type: () -> None
+    global journal
+    if journal is None:
+        return
     start = time.time()
 
-    with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in six.iteritems(clients)],
-                   stored_queues)
-
-    logging.info('Tornado dumped %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+    journal.close()
+
+    logging.info('Tornado flushed the journal of %d event queues (%d bytes) in %.3fs'
+                 % (len(clients), journal.journal_bytes, time.time() - start))
+    journal = None
+
+def read_event_queue_journal(filename):
+    # type: (str) -> Tuple[Dict[str, ClientDescriptor], bool]
+    """Replays the journal in `filename`, returning the restored client
+    descriptors and whether the journal ended with a clean shutdown."""
+    restored = {} # type: Dict[str, ClientDescriptor]
+    messages = {} # type: Dict[int, Dict[str, Any]]
+    clean = False
+    for record in event_queue_journal.read_journal(filename):
+        record_type = record[0]
+        clean = False
+        if record_type == event_queue_journal.QUEUE:
+            restored[record[1]] = ClientDescriptor.from_dict(record[2])
+        elif record_type == event_queue_journal.CLEAN_SHUTDOWN:
+            clean = True
+        elif record_type == event_queue_journal.MESSAGE:
+            messages[record[1]] = record[2]
+        elif record[1] in restored:
+            client = restored[record[1]]
+            if record_type == event_queue_journal.EVENT:
+                client.event_queue.push(*record[2:])
+            elif record_type == event_queue_journal.MESSAGE_EVENT:
+                (event, message_ref, size) = record[2:]
+                event['message'] = messages[message_ref]
+                client.event_queue.push(event, size)
+            elif record_type == event_queue_journal.SKIPPED:
+                client.event_queue.next_event_id += 1
+            elif record_type == event_queue_journal.PRUNE:
+                client.event_queue.prune(record[2])
+            elif record_type == event_queue_journal.CONTENTS:
+                client.event_queue.contents()
+            elif record_type == event_queue_journal.CONNECT:
+                client.last_connection_time = record[2]
+            elif record_type == event_queue_journal.DELETE:
+                del restored[record[1]]
+    return (restored, clean)
 
 def load_event_queues():
-    # type: () -> None
+    # type: () -> bool
+    """Restores the event queues from the journal (or from the JSON
+    file written by older versions).  Returns whether a fresh snapshot
+    should be written before journaling further changes."""
     global clients
     start = time.time()
+    write_snapshot = False
 
-    # ujson chokes on bad input pretty easily.  We separate out the actual
-    # file reading from the loading so that we don't silently fail if we get
-    # bad input.
-    try:
-        with open(settings.JSON_PERSISTENT_QUEUE_FILENAME, "r") as stored_queues:
-            json_data = stored_queues.read()
+    journal_filename = get_persistent_queue_filename(settings.EVENT_QUEUE_JOURNAL_FILENAME)
+    if os.path.exists(journal_filename):
         try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+            (clients, clean) = read_event_queue_journal(journal_filename)
         except Exception:
-            logging.exception("Could not deserialize event queues")
-    except (IOError, EOFError):
-        pass
+            logging.exception("Could not replay event queue journal")
+            clean = False
+        if not clean:
+            # Events pushed just before an unclean shutdown may not
+            # have been journaled, but may have been delivered; skip
+            # their ids so clients don't prune new events as old ones.
+            for client in six.itervalues(clients):
+                client.event_queue.next_event_id += EVENT_ID_GAP_AFTER_CRASH
+            logging.warning("Event queue journal was not shut down cleanly")
+            write_snapshot = True
+    else:
+        # ujson chokes on bad input pretty easily.  We separate out the actual
+        # file reading from the loading so that we don't silently fail if we get
+        # bad input.
+        try:
+            with open(get_persistent_queue_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME),
+                      "r") as stored_queues:
+                json_data = stored_queues.read()
+            try:
+                clients = dict((qid, ClientDescriptor.from_dict(client))
+                               for (qid, client) in ujson.loads(json_data))
+            except Exception:
+                logging.exception("Could not deserialize event queues")
+        except (IOError, EOFError):
+            pass
+        write_snapshot = True
+
+    if settings.TORNADO_PROCESSES > 1:
+        # If the number of shards changed, drop queues for users that
+        # now live on another shard; their clients will re-register.
+        num_clients = len(clients)
+        clients = dict((qid, client) for (qid, client) in six.iteritems(clients)
+                       if get_tornado_shard(client.user_profile_id) == current_tornado_shard)
+        if len(clients) != num_clients:
+            write_snapshot = True
 
     for client in six.itervalues(clients):
         # Put code for migrations due to event queue data format changes here
 
         add_to_client_dicts(client)
 
+    elapsed = time.time() - start
     logging.info('Tornado loaded %d event queues in %.3fs'
-                 % (len(clients), time.time() - start))
+                 % (len(clients), elapsed))
+    statsd.timing('tornado.event_queue_journal.load_time', elapsed * 1000)
+    return write_snapshot
 
 def send_restart_events(immediate=False):
     # type: (bool) -> None
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION) # type: Dict[str, Any]
     if immediate:
         event['immediate'] = True
-    for client in six.itervalues(clients):
+    # add_event may remove queues that are over their size limit
+    for client in list(clients.values()):
         if client.accepts_event(event):
             client.add_event(event.copy())
 
 def setup_event_queue():
     # type: () -> None
     if not settings.TEST_SUITE:
-        load_event_queues()
+        write_snapshot = load_event_queues()
+        open_event_queue_journal(write_snapshot)
         atexit.register(dump_event_queues)
         # Make sure we dump event queues even if we exit via signal
         signal.signal(signal.SIGTERM, lambda signum, stack: sys.exit(1))
         tornado.autoreload.add_reload_hook(dump_event_queues) # type: ignore # TODO: Fix missing tornado.autoreload stub
 
     try:
-        os.rename(settings.JSON_PERSISTENT_QUEUE_FILENAME, "/var/tmp/event_queues.json.last")
+        persistent_queue_filename = get_persistent_queue_filename(settings.JSON_PERSISTENT_QUEUE_FILENAME)
+        os.rename(persistent_queue_filename,
+                  "/var/tmp/%s.last" % (os.path.basename(persistent_queue_filename),))
     except OSError:
         pass
 
@@ -490,6 +813,11 @@ def setup_event_queue():
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    if journal is not None:
+        pc = tornado.ioloop.PeriodicCallback(flush_event_queue_journal,
+                                             EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS, ioloop)
+        pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query):
@@ -509,6 +837,8 @@ def fetch_events(query):
         extra_log_data = ""
         if queue_id is None:
             if dont_block:
+                if get_tornado_shard(user_profile_id) != current_tornado_shard:
+                    raise JsonableError(_("Event queues for this user are served by another server"))
                 client = allocate_client_descriptor(new_queue_data)
                 queue_id = client.event_queue.id
             else:
@@ -518,6 +848,10 @@ def fetch_events(query):
                 raise JsonableError(_("Missing 'last_event_id' argument"))
             client = get_client_descriptor(queue_id)
             if client is None:
+                if queue_id in overflowed_queue_ids:
+                    # Clients look for the "Bad event queue id" prefix
+                    # to know they need to re-register.
+                    raise JsonableError(_("Bad event queue id: %s (too many queued events)") % (queue_id,))
                 raise JsonableError(_("Bad event queue id: %s") % (queue_id,))
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
@@ -532,7 +866,8 @@ def fetch_events(query):
             extra_log_data = "[%s/%s]" % (queue_id, len(response["events"]))
             if was_connected:
                 extra_log_data += " [was connected]"
-            return dict(type="response", response=response, extra_log_data=extra_log_data)
+            return dict(type="response", response=response, extra_log_data=extra_log_data,
+                        apply_markdown=client.apply_markdown)
 
         # After this point, dont_block=False, the queue is empty, and we
         # have a pre-existing queue, so we wait for new events.
@@ -565,6 +900,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                         narrow=[]):
     # type: (UserProfile, Client, bool, int, Optional[Iterable[str]], bool, Iterable[Sequence[text_type]]) -> Optional[str]
     if settings.TORNADO_SERVER:
+        tornado_uri = get_tornado_uri(get_tornado_shard(user_profile.id))
         req = {'dont_block'    : 'true',
                'apply_markdown': ujson.dumps(apply_markdown),
                'all_public_streams': ujson.dumps(all_public_streams),
@@ -574,7 +910,7 @@ def request_event_queue(user_profile, user_client, apply_markdown,
                'lifespan_secs' : queue_lifespan_secs}
         if event_types is not None:
             req['event_types'] = ujson.dumps(event_types)
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+        resp = requests.get(tornado_uri + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params=req)
@@ -588,7 +924,8 @@ def request_event_queue(user_profile, user_client, apply_markdown,
 def get_user_events(user_profile, queue_id, last_event_id):
     # type: (UserProfile, str, int) -> List[Dict]
     if settings.TORNADO_SERVER:
-        resp = requests.get(settings.TORNADO_SERVER + '/api/v1/events',
+        tornado_uri = get_tornado_uri(get_tornado_shard(user_profile.id))
+        resp = requests.get(tornado_uri + '/api/v1/events',
                             auth=requests.auth.HTTPBasicAuth(user_profile.email,
                                                              user_profile.api_key),
                             params={'queue_id'     : queue_id,
@@ -601,6 +938,37 @@ def get_user_events(user_profile, queue_id, last_event_id):
         return extract_json_response(resp)['events']
 
 
+# Most message events in the queues share one message dict per
+# (message id, apply_markdown); see process_message_event.  We keep
+# the JSON encoding of the most recent ones, so that responses to
+# get_events can splice it in rather than encode each message again
+# for every client.  Values are (message dict, JSON), and are only
+# used for events whose message is that same dict object.
+encoded_messages = OrderedDict() # type: OrderedDict[Tuple[int, bool], Tuple[Dict[str, Any], str]]
+MAX_ENCODED_MESSAGES = 10000
+
+def cache_encoded_message(message_dict, apply_markdown, encoded):
+    # type: (Dict[str, Any], bool, str) -> None
+    encoded_messages[(message_dict['id'], apply_markdown)] = (message_dict, encoded)
+    if len(encoded_messages) > MAX_ENCODED_MESSAGES:
+        encoded_messages.popitem(last=False)
+
+def encode_event(event, apply_markdown):
+    # type: (Mapping[str, Any], bool) -> str
+    if event['type'] == 'message':
+        cached = encoded_messages.get((event['message']['id'], apply_markdown))
+        if cached is not None and cached[0] is event['message']:
+            rest = dict(event)
+            del rest['message']
+            return ujson.dumps(rest)[:-1] + ',"message":' + cached[1] + '}'
+    return ujson.dumps(event)
+
+def encode_events(events, apply_markdown):
+    # type: (Iterable[Mapping[str, Any]], bool) -> str
+    """Returns the JSON encoding of a list of events from a queue of a
+    client with the given apply_markdown setting."""
+    return '[' + ','.join(encode_event(event, apply_markdown) for event in events) + ']'
+
 # Send email notifications to idle users
 # after they are idle for 1 hour
 NOTIFY_AFTER_IDLE_HOURS = 1
@@ -691,12 +1059,31 @@ def process_message_event(event_template, users):
     # Extra user-specific data to include
     extra_user_data = {} # type: Dict[int, Any]
 
+    # Every queue shares these two message dicts; encode them once
+    # for responses to get_events, and for the queues' memory accounting.
+    event_sizes = {} # type: Dict[bool, int]
+    for (apply_markdown, message_dict) in [(True, message_dict_markdown),
+                                           (False, message_dict_no_markdown)]:
+        encoded = ujson.dumps(message_dict)
+        cache_encoded_message(message_dict, apply_markdown, encoded)
+        event_sizes[apply_markdown] = len(encoded) + MESSAGE_EVENT_OVERHEAD_BYTES
+
+    # Copies of the message dicts for Zephyr mirroring bots, shared
+    # between those bots' queues
+    mirror_message_dicts = {} # type: Dict[bool, Dict[str, Any]]
+
     if 'stream_name' in event_template and not event_template.get("invite_only"):
-        for client in get_client_descriptors_for_realm_all_streams(event_template['realm_id']):
+        for client in get_client_descriptors_for_realm_stream(event_template['realm_id'],
+                                                              event_template['stream_name']):
             send_to_clients[client.event_queue.id] = {'client': client, 'flags': None}
             if sender_queue_id is not None and client.event_queue.id == sender_queue_id:
                 send_to_clients[client.event_queue.id]['is_sender'] = True
 
+    # Recipients (of private stream messages and PMs, as well as public
+    # stream subscribers) are still looked up one at a time, rather
+    # than through an index like realm_stream_clients: each has their
+    # own flags, and offline ones may need notifying, so this loop is
+    # proportional to the number of recipients whatever we index.
     for user_data in users:
         user_profile_id = user_data['id'] # type: int
         flags = user_data.get('flags', []) # type: Iterable[str]
@@ -710,9 +1097,13 @@ def process_message_event(event_template, users):
         # or she was @-notified potentially notify more immediately
         received_pm = message_type == "private" and user_profile_id != sender_id
         mentioned = 'mentioned' in flags
+        if not (received_pm or mentioned):
+            # Skip the presence check, which is the expensive part
+            # of this loop for large streams.
+            continue
         idle = receiver_is_idle(user_profile_id, realm_presences)
         always_push_notify = user_data.get('always_push_notify', False)
-        if (received_pm or mentioned) and (idle or always_push_notify):
+        if idle or always_push_notify:
             notice = build_offline_notification(user_profile_id, message_id)
             queue_json_publish("missedmessage_mobile_notifications", notice, lambda notice: None)
             notified = dict(push_notified=True) # type: Dict[str, bool]
@@ -744,8 +1135,9 @@ def process_message_event(event_template, users):
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
         if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
-            message_dict["invite_only_stream"] = True
+            if client.apply_markdown not in mirror_message_dicts:
+                mirror_message_dicts[client.apply_markdown] = dict(message_dict, invite_only_stream=True)
+            message_dict = mirror_message_dicts[client.apply_markdown]
 
         user_event = dict(type='message', message=message_dict, flags=flags) # type: Dict[str, Any]
         if extra_data is not None:
@@ -763,14 +1155,15 @@ def process_message_event(event_template, users):
         if ('mirror' in sending_client and
             sending_client.lower() == client.client_type_name.lower()):
             continue
-        client.add_event(user_event)
+        client.add_event(user_event, event_sizes[client.apply_markdown])
 
 def process_event(event, users):
     # type: (Mapping[str, Any], Iterable[int]) -> None
+    event_size = len(ujson.dumps(event))
     for user_profile_id in users:
         for client in get_client_descriptors_for_user(user_profile_id):
             if client.accepts_event(event):
-                client.add_event(dict(event))
+                client.add_event(dict(event), event_size)
 
 def process_userdata_event(event_template, users):
     # type: (Mapping[str, Any], Iterable[Mapping[str, Any]]) -> None
@@ -787,6 +1180,17 @@ def process_userdata_event(event_template, users):
 
 def process_notification(notice):
     # type: (Mapping[str, Any]) -> None
+    if 'notices' in notice:
+        # A batch of notices, as sent by send_events
+        for single_notice in notice['notices']:
+            process_notification(single_notice)
+        return
+
+    # Notices consumed from the notify_tornado queue don't come in a
+    # Django request, whose middleware would flush the per-request
+    # caches, so flush them here, lest they grow and go stale in
+    # Tornado.
+    flush_per_request_caches()
     event = notice['event'] # type: Mapping[str, Any]
     users = notice['users'] # type: Union[Iterable[int], Iterable[Mapping[str, Any]]]
     if event['type'] in ["update_message"]:
@@ -801,24 +1205,80 @@ def process_notification(notice):
 # We use JSON rather than bare form parameters, so that we can represent
 # different types and for compatibility with non-HTTP transports.
 
-def send_notification_http(data):
-    # type: (Mapping[str, Any]) -> None
+def send_notification_http(data, shard=0):
+    # type: (Mapping[str, Any], int) -> None
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        requests.post(settings.TORNADO_SERVER + '/notify_tornado', data=dict(
+        requests.post(get_tornado_uri(shard) + '/notify_tornado', data=dict(
                 data   = ujson.dumps(data),
                 secret = settings.SHARED_SECRET))
     else:
         process_notification(data)
 
+def send_notification_to_shard(shard, data):
+    # type: (int, Mapping[str, Any]) -> None
+    queue_json_publish(notify_tornado_queue_name(shard), data,
+                       lambda data: send_notification_http(data, shard))
+
 def send_notification(data):
     # type: (Mapping[str, Any]) -> None
     queue_json_publish("notify_tornado", data, send_notification_http)
 
+def split_users_by_shard(event, users):
+    # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> Dict[int, List[Any]]
+    """Returns a dict mapping each Tornado shard that needs to see
+    `event` to the subset of `users` whose queues live on it."""
+    users_by_shard = {} # type: Dict[int, List[Any]]
+    if event['type'] == 'message' and 'stream_name' in event and not event.get('invite_only'):
+        # Clients with all_public_streams or a narrow can receive
+        # public stream messages without being a recipient, and
+        # those can be on any shard.
+        for shard in range(settings.TORNADO_PROCESSES):
+            users_by_shard[shard] = []
+    for user in users:
+        if isinstance(user, dict):
+            user_profile_id = user['id']
+        else:
+            user_profile_id = user
+        users_by_shard.setdefault(get_tornado_shard(user_profile_id), []).append(user)
+    return users_by_shard
+
 def send_event(event, users):
     # type: (Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]) -> None
     """`users` is a list of user IDs, or in the case of `message` type
     events, a list of dicts describing the users and metadata about
     the user/message pair."""
-    queue_json_publish("notify_tornado",
-                       dict(event=event, users=users),
-                       send_notification_http)
+    if settings.TORNADO_PROCESSES == 1:
+        queue_json_publish("notify_tornado",
+                           dict(event=event, users=users),
+                           send_notification_http)
+        return
+
+    for (shard, shard_users) in six.iteritems(split_users_by_shard(event, users)):
+        send_notification_to_shard(shard, dict(event=event, users=shard_users))
+
+def send_events(events_and_users):
+    # type: (Sequence[Tuple[Mapping[str, Any], Union[Iterable[int], Iterable[Mapping[str, Any]]]]]) -> None
+    """Like send_event, but for a batch of (event, users) pairs, which
+    are delivered to Tornado in order with a single publish per shard."""
+    if len(events_and_users) == 0:
+        return
+    if len(events_and_users) == 1:
+        (event, users) = events_and_users[0]
+        send_event(event, users)
+        return
+    if settings.TORNADO_PROCESSES == 1:
+        queue_json_publish("notify_tornado",
+                           dict(notices=[dict(event=notice_event, users=notice_users)
+                                         for (notice_event, notice_users) in events_and_users]),
+                           send_notification_http)
+        return
+
+    notices_by_shard = {} # type: Dict[int, List[Dict[str, Any]]]
+    for (event, users) in events_and_users:
+        for (shard, shard_users) in six.iteritems(split_users_by_shard(event, users)):
+            notices_by_shard.setdefault(shard, []).append(dict(event=event, users=shard_users))
+    for (shard, notices) in six.iteritems(notices_by_shard):
+        if len(notices) == 1:
+            send_notification_to_shard(shard, notices[0])
+        else:
+            send_notification_to_shard(shard, dict(notices=notices))
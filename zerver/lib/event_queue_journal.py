@@ -0,0 +1,169 @@
+from __future__ import absolute_import
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import logging
+import marshal
+import os
+import struct
+
+# The Tornado event queues are persisted as an append-only journal of
+# length-prefixed marshal records.  A journal starts with a snapshot
+# (one QUEUE record per event queue), followed by records describing
+# each change made to the queues since.  Replaying the records in
+# order reconstructs the queues.  When the journal grows too large
+# relative to the last snapshot, it is compacted by writing a fresh
+# snapshot to a new file and renaming it into place.
+#
+# A message is delivered to many queues at once, as events sharing one
+# message dict, so that dict is journaled once, in a MESSAGE record,
+# and each queue's event refers to it.
+
+# Record types
+QUEUE = 'q'           # (QUEUE, queue_id, client_dict): a new event queue
+EVENT = 'e'           # (EVENT, queue_id, event, size): EventQueue.push
+MESSAGE = 'm'         # (MESSAGE, message_ref, message_dict): shared by MESSAGE_EVENTs
+MESSAGE_EVENT = 'r'   # (MESSAGE_EVENT, queue_id, event, message_ref, size): EventQueue.push
+                      # of a message event, with its message dict left out
+SKIPPED = 'x'         # (SKIPPED, queue_id): EventQueue.push of an event we couldn't journal
+PRUNE = 'p'           # (PRUNE, queue_id, through_id): EventQueue.prune
+CONTENTS = 'c'        # (CONTENTS, queue_id): EventQueue.contents merged virtual events
+CONNECT = 't'         # (CONNECT, queue_id, last_connection_time)
+DELETE = 'd'          # (DELETE, queue_id): the queue was garbage collected
+CLEAN_SHUTDOWN = 's'  # (CLEAN_SHUTDOWN,): all changes before this were recorded
+
+# Version 2 is the newest marshal format both Python 2 and 3 can read.
+MARSHAL_VERSION = 2
+RECORD_HEADER = struct.Struct("!I")
+
+# Compact once the journal is this many times the size of the last snapshot...
+COMPACTION_FACTOR = 4
+# ...but never bother for journals smaller than this.
+COMPACTION_MIN_BYTES = 16 * 1024 * 1024
+
+def encode_record(record):
+    # type: (Tuple[Any, ...]) -> bytes
+    data = marshal.dumps(record, MARSHAL_VERSION)
+    return RECORD_HEADER.pack(len(data)) + data
+
+def read_journal(filename):
+    # type: (str) -> Iterator[Tuple[Any, ...]]
+    """Yields the records in the journal one at a time, without reading
+    the whole file into memory.  A truncated final record (e.g. from a
+    crash in the middle of a write) is ignored."""
+    with open(filename, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                if header:
+                    logging.warning("Ignoring truncated record at end of %s" % (filename,))
+                return
+            (length,) = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logging.warning("Ignoring truncated record at end of %s" % (filename,))
+                return
+            yield marshal.loads(data)
+
+class EventQueueJournal(object):
+    def __init__(self, filename):
+        # type: (str) -> None
+        self.filename = filename
+        self.buffer = [] # type: List[bytes]
+        self.file = None # type: Optional[Any]
+        # The message dicts journaled since the last flush, by id(), with
+        # their refs (holding on to them keeps their ids unique).
+        self.message_refs = {} # type: Dict[int, Tuple[int, Dict[str, Any]]]
+        self.next_message_ref = 0
+        # Size of the journal file, and of its initial snapshot
+        self.journal_bytes = 0
+        self.snapshot_bytes = 0
+
+    def open(self):
+        # type: () -> None
+        self.file = open(self.filename, "ab")
+        self.journal_bytes = os.path.getsize(self.filename)
+        if self.snapshot_bytes == 0:
+            self.snapshot_bytes = self.journal_bytes
+
+    def record(self, *record):
+        # type: (*Any) -> bool
+        """Buffers a record; it's written to disk on the next flush().
+        Returns whether it could be encoded."""
+        try:
+            self.buffer.append(encode_record(record))
+            return True
+        except ValueError:
+            # marshal only handles builtin types; events are built
+            # from JSON, so this shouldn't happen.
+            logging.exception("Could not journal event queue record of type %s" % (record[0],))
+            return False
+
+    def record_event(self, queue_id, event, size):
+        # type: (str, Dict[str, Any], Optional[int]) -> None
+        """Records an EventQueue.push; see MESSAGE_EVENT."""
+        if event.get('type') == 'message':
+            message = event['message']
+            if id(message) in self.message_refs:
+                message_ref = self.message_refs[id(message)][0]
+            else:
+                message_ref = self.next_message_ref
+                self.next_message_ref += 1
+                if self.record(MESSAGE, message_ref, message):
+                    self.message_refs[id(message)] = (message_ref, message)
+            event = dict(event)
+            del event['message']
+            recorded = (id(message) in self.message_refs and
+                        self.record(MESSAGE_EVENT, queue_id, event, message_ref, size))
+        else:
+            recorded = self.record(EVENT, queue_id, event, size)
+        if not recorded:
+            # Keep the queue's event ids in step when it's replayed.
+            self.record(SKIPPED, queue_id)
+
+    def flush(self):
+        # type: () -> int
+        """Writes out the buffered records, returning the number of bytes written."""
+        if not self.buffer:
+            return 0
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.message_refs = {}
+        self.file.write(data)
+        self.file.flush()
+        self.journal_bytes += len(data)
+        return len(data)
+
+    def needs_compaction(self):
+        # type: () -> bool
+        return self.journal_bytes > max(COMPACTION_MIN_BYTES,
+                                        COMPACTION_FACTOR * self.snapshot_bytes)
+
+    def compact(self, records):
+        # type: (Iterable[Tuple[Any, ...]]) -> int
+        """Replaces the journal with a snapshot consisting of `records`,
+        which must describe the complete current state of the queues.
+        Returns the size of the new journal."""
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            for record in records:
+                try:
+                    f.write(encode_record(record))
+                except ValueError:
+                    logging.exception("Could not snapshot event queue %s" % (record[1],))
+        if self.file is not None:
+            self.file.close()
+        os.rename(tmp_filename, self.filename)
+        # Anything buffered is already reflected in the snapshot.
+        self.buffer = []
+        self.message_refs = {}
+        self.snapshot_bytes = 0
+        self.open()
+        return self.journal_bytes
+
+    def close(self):
+        # type: () -> None
+        """Flushes the journal and marks it as cleanly shut down."""
+        self.record(CLEAN_SHUTDOWN)
+        self.flush()
+        self.file.close()
+        self.file = None
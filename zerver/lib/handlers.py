@@ -25,8 +25,10 @@ def handler_stats_string():
     # type: () -> str
     return "%s handlers, latest ID %s" % (len(handlers), current_handler_id)
 
-def finish_handler(handler_id, event_queue_id, contents, apply_markdown):
-    # type: (int, str, List[Dict[str, Any]], bool) -> None
+def finish_handler(handler_id, event_queue_id, encoded_contents, apply_markdown):
+    # type: (int, str, str, bool) -> None
+    """`encoded_contents` is the list of events to respond with, already
+    encoded as JSON."""
     err_msg = "Got error finishing handler for queue %s" % (event_queue_id,)
     try:
         # We call async_request_restart here in case we are
@@ -37,9 +39,9 @@ def finish_handler(handler_id, event_queue_id, contents, apply_markdown):
         async_request_restart(request)
         request._log_data['extra'] = "[%s/1]" % (event_queue_id,)
         handler.zulip_finish(dict(result='success', msg='',
-                                  events=contents,
                                   queue_id=event_queue_id),
-                             request, apply_markdown=apply_markdown)
+                             request, apply_markdown=apply_markdown,
+                             encoded_data=dict(events=encoded_contents))
     except IOError as e:
         if str(e) != 'Stream is closed':
             logging.exception(err_msg)
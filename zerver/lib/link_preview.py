@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+from six import text_type
+from typing import Iterable, Tuple
+
+from django.conf import settings
+from six.moves import urllib
+from zerver.lib import bugdown
+from zerver.lib.cache import cache_get, cache_set
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
+
+import logging
+import random
+import time
+
+# The link_previews queue worker's side of deferred link previews
+# (see link_preview in zerver/lib/bugdown/__init__.py): it fetches the
+# previews a message is waiting for, at most
+# LINK_PREVIEW_MAX_FETCHES_PER_HOST at a time per site across all the
+# worker processes, so that a burst of messages linking to one site
+# doesn't have us hammering it.
+
+client = get_redis_client()
+
+# How long a worker waits for one of a site's fetch slots before
+# giving up on (and briefly caching the failure of) the fetch.
+HOST_WAIT_SECS = 10
+# Slots held longer than this, by a worker that died mid-fetch, are
+# freed.  Fetches time out well before it.
+HOST_SLOT_SECS = 60
+
+# KEYS = [the host's slot set]; ARGV = [now, slot token, max fetches,
+# slot seconds].  The slot set holds a token per fetch in progress,
+# scored by when it started.  Returns whether a slot was taken.
+ACQUIRE_HOST_SLOT_LUA = """
+local now = tonumber(ARGV[1])
+local slot_secs = tonumber(ARGV[4])
+redis.call('zremrangebyscore', KEYS[1], '-inf', now - slot_secs)
+if redis.call('zcard', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('zadd', KEYS[1], now, ARGV[2])
+redis.call('expire', KEYS[1], slot_secs)
+return 1
+"""
+
+acquire_host_slot_script = client.register_script(ACQUIRE_HOST_SLOT_LUA)
+
+def link_preview_host(kind, key):
+    # type: (text_type, text_type) -> text_type
+    if kind == "tweet":
+        return u"api.twitter.com"
+    return urllib.parse.urlparse(key).netloc.lower()
+
+def host_slots_key(host):
+    # type: (text_type) -> text_type
+    return u"link_preview_host:%s" % (host,)
+
+def acquire_host_slot(host, token):
+    # type: (text_type, str) -> bool
+    """Takes one of the host's fetch slots, waiting at most HOST_WAIT_SECS
+    for one to be free.  Returns whether it got one."""
+    deadline = time.time() + HOST_WAIT_SECS
+    while True:
+        if acquire_host_slot_script(keys=[host_slots_key(host)],
+                                    args=[time.time(), token,
+                                          settings.LINK_PREVIEW_MAX_FETCHES_PER_HOST,
+                                          HOST_SLOT_SECS]):
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.1)
+
+def release_host_slot(host, token):
+    # type: (text_type, str) -> None
+    client.zrem(host_slots_key(host), token)
+
+def fetch_link_previews(previews):
+    # type: (Iterable[Tuple[text_type, text_type]]) -> None
+    """Fetches and caches the (kind, key) previews that aren't cached
+    already, e.g. by a worker handling another message."""
+    for (kind, key) in previews:
+        if cache_get(bugdown.link_preview_cache_key(kind, key), cache_name="database") is not None:
+            continue
+        host = link_preview_host(kind, key)
+        token = "%s:%s" % (time.time(), random.getrandbits(32))
+        if not acquire_host_slot(host, token):
+            logging.warning("Gave up waiting to fetch a link preview from %s" % (host,))
+            statsd.incr("link_preview.%s.host_busy" % (kind,))
+            cache_set(bugdown.link_preview_cache_key(kind, key), bugdown.LINK_PREVIEW_FAILED,
+                      cache_name="database", timeout=bugdown.LINK_PREVIEW_FAILURE_TIMEOUT,
+                      invalidate=False)
+            continue
+        try:
+            bugdown.fetch_link_preview(kind, key)
+        finally:
+            release_host_slot(host, token)
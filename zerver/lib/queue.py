@@ -5,6 +5,7 @@ import pika
 from pika.adapters.blocking_connection import BlockingChannel
 from pika.spec import Basic
 import logging
+import os
 import ujson
 import random
 import time
@@ -12,8 +13,9 @@ import threading
 import atexit
 from collections import defaultdict
 
+from zerver.lib.context_managers import lockfile
 from zerver.lib.utils import statsd
-from typing import Any, Callable, Dict, Mapping, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Mapping, Optional, Set, Tuple, Union
 
 Consumer = Callable[[BlockingChannel, Basic.Deliver, pika.BasicProperties, str], None]
 
@@ -27,16 +29,26 @@ class SimpleQueueClient(object):
         self.log = logging.getLogger('zulip.queue')
         self.queues = set() # type: Set[str]
         self.channel = None # type: Optional[BlockingChannel]
+        # A second channel, in transaction mode, for publish_many
+        self.batch_channel = None # type: Optional[BlockingChannel]
         self.consumers = defaultdict(set) # type: Dict[str, Set[Consumer]]
+        # The prefetch counts set for batch consumers' queues, which
+        # have to be set again on each new channel
+        self.prefetch_counts = {} # type: Dict[str, int]
+        # Called whenever the channel is replaced, to drop state (like
+        # unacknowledged delivery tags) that belongs to the old one
+        self.reset_callbacks = [] # type: List[Callable[[], None]]
         # Disable RabbitMQ heartbeats since BlockingConnection can't process them
         self.rabbitmq_heartbeat = 0
         self._connect()
 
     def _connect(self):
         # type: () -> None
+        self._reset_consumers()
         start = time.time()
         self.connection = pika.BlockingConnection(self._get_parameters())
         self.channel    = self.connection.channel()
+        self.batch_channel = None
         self.log.info('SimpleQueueClient connected (connecting took %.3fs)' % (time.time() - start,))
 
     def _reconnect(self):
@@ -46,6 +58,11 @@ class SimpleQueueClient(object):
         self.queues = set()
         self._connect()
 
+    def _reset_consumers(self):
+        # type: () -> None
+        for callback in self.reset_callbacks:
+            callback()
+
     def _get_parameters(self):
         # type: () -> pika.ConnectionParameters
         # We explicitly disable the RabbitMQ heartbeat feature, since
@@ -63,9 +80,13 @@ class SimpleQueueClient(object):
     def _reconnect_consumer_callback(self, queue, consumer):
         # type: (str, Consumer) -> None
         self.log.info("Queue reconnecting saved consumer %s to queue %s" % (consumer, queue))
-        self.ensure_queue(queue, lambda: self.channel.basic_consume(consumer,
-                                                                    queue=queue,
-                                                                    consumer_tag=self._generate_ctag(queue)))
+        def consume():
+            # type: () -> None
+            if queue in self.prefetch_counts:
+                self.channel.basic_qos(prefetch_count=self.prefetch_counts[queue])
+            self.channel.basic_consume(consumer, queue=queue,
+                                       consumer_tag=self._generate_ctag(queue))
+        self.ensure_queue(queue, consume)
 
     def _reconnect_consumer_callbacks(self):
         # type: () -> None
@@ -119,6 +140,48 @@ class SimpleQueueClient(object):
 
             self.publish(queue_name, ujson.dumps(body))
 
+    def publish_many(self, messages):
+        # type: (List[Tuple[str, str]]) -> None
+        """Publishes a list of (queue name, body) pairs in one burst.
+
+        They're sent as a single AMQP transaction, so RabbitMQ confirms
+        that it has all of them with one round trip.  (The blocking
+        channel's publisher confirms instead wait for each message
+        separately.)"""
+        for queue_name in set(queue_name for (queue_name, _) in messages):
+            self.ensure_queue(queue_name, lambda: None)
+        if self.batch_channel is None:
+            self.batch_channel = self.connection.channel()
+            self.batch_channel.tx_select()
+
+        counts = defaultdict(int) # type: Dict[str, int]
+        for (queue_name, body) in messages:
+            self.batch_channel.basic_publish(
+                            exchange='',
+                            routing_key=queue_name,
+                            properties=pika.BasicProperties(delivery_mode=2),
+                            body=body)
+            counts[queue_name] += 1
+        self.batch_channel.tx_commit()
+
+        for (queue_name, count) in counts.items():
+            statsd.incr("rabbitmq.publish.%s" % (queue_name,), count)
+
+    def json_publish_many(self, events):
+        # type: (List[Tuple[str, Union[Mapping[str, Any], str]]]) -> None
+        self.publish_many_reconnecting([(queue_name, ujson.dumps(event))
+                                        for (queue_name, event) in events])
+
+    def publish_many_reconnecting(self, messages):
+        # type: (List[Tuple[str, str]]) -> None
+        try:
+            self.publish_many(messages)
+        except (AttributeError, pika.exceptions.AMQPConnectionError):
+            self.log.warning("Failed to send to rabbitmq, trying to reconnect and send again")
+            self._reconnect()
+
+            self.publish_many(messages)
+
     def register_consumer(self, queue_name, consumer):
         # type: (str, Consumer) -> None
         def wrapped_consumer(ch, method, properties, body):
@@ -142,6 +205,70 @@ class SimpleQueueClient(object):
             callback(ujson.loads(body))
         self.register_consumer(queue_name, wrapped_callback)
 
+    def register_json_batch_consumer(self, queue_name, callback, prefetch_count,
+                                     max_batch_size, max_latency):
+        # type: (str, Callable[[List[Mapping[str, Any]]], None], int, int, float) -> None
+        """Calls callback with lists of up to max_batch_size events from the
+        queue, as soon as that many have arrived, or max_latency seconds
+        after the first of them did.  Each batch is acknowledged with a
+        single ack once the callback returns.  RabbitMQ sends at most
+        prefetch_count unacknowledged events at a time, so it should be
+        at least max_batch_size.
+
+        If the client reconnects, the pending batch is dropped (RabbitMQ
+        redelivers its events, since they were never acknowledged), as
+        are the acks for a batch whose callback was running at the
+        time; their delivery tags mean nothing to the new channel."""
+        batch = [] # type: List[Tuple[int, Mapping[str, Any]]]
+        timeout = [] # type: List[Any]
+
+        def reset():
+            # type: () -> None
+            # The timeout belonged to the old connection
+            del timeout[:]
+            del batch[:]
+
+        def flush():
+            # type: () -> None
+            if timeout:
+                self.connection.remove_timeout(timeout.pop())
+            if not batch:
+                return
+            events = [event for (_, event) in batch]
+            last_delivery_tag = batch[-1][0]
+            del batch[:]
+            channel = self.channel
+            try:
+                callback(events)
+            except Exception as e:
+                if self.channel is channel:
+                    self.channel.basic_nack(delivery_tag=last_delivery_tag, multiple=True)
+                raise e
+            if self.channel is channel:
+                self.channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+            else:
+                self.log.warning("Reconnected while consuming a batch from %s; it will be redelivered"
+                                 % (queue_name,))
+
+        def batching_consumer(ch, method, properties, body):
+            # type: (BlockingChannel, Basic.Deliver, pika.BasicProperties, str) -> None
+            batch.append((method.delivery_tag, ujson.loads(body)))
+            if len(batch) >= max_batch_size:
+                flush()
+            elif not timeout:
+                timeout.append(self.connection.add_timeout(max_latency, flush))
+
+        def consume():
+            # type: () -> None
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+            self.channel.basic_consume(batching_consumer, queue=queue_name,
+                                       consumer_tag=self._generate_ctag(queue_name))
+
+        self.consumers[queue_name].add(batching_consumer)
+        self.prefetch_counts[queue_name] = prefetch_count
+        self.reset_callbacks.append(reset)
+        self.ensure_queue(queue_name, consume)
+
     def drain_queue(self, queue_name, json=False):
         # type: (str, bool) -> List[Dict[str, Any]]
         "Returns all messages in the desired queue"
@@ -198,6 +325,7 @@ class TornadoQueueClient(SimpleQueueClient):
     def _connect(self, on_open_cb = None):
         # type: (Optional[Callable[[], None]]) -> None
         self.log.info("Beginning TornadoQueueClient connection")
+        self._reset_consumers()
         if on_open_cb is not None:
             self._on_open_cbs.append(on_open_cb)
         self.connection = ExceptionFreeTornadoConnection(
@@ -302,9 +430,97 @@ def setup_tornado_rabbitmq():
 # randomly close.
 queue_lock = threading.RLock()
 
+class BackgroundQueuePublisher(object):
+    """Publishes events to RabbitMQ from a background thread, so that
+    queue_json_publish returns without waiting on the network.
+
+    The thread waits a few milliseconds after the first event arrives,
+    so that the events a request publishes in quick succession (e.g. a
+    message's notifications and the user's activity) go out together
+    in one publish_many burst.  Events are serialized by publish, on
+    the calling thread, so later changes the caller makes to them
+    aren't published.
+
+    A burst is retried once, after reconnecting, if publishing it
+    fails.  If the retry fails too, its events are appended to the
+    queue error files in QUEUE_ERROR_DIR, which is where queue workers
+    save the events they fail to handle.  Events still waiting when the
+    process exits are published by an atexit handler; ones being
+    published when it crashes are lost."""
+    # How long to wait for more events before publishing
+    linger_secs = 0.005
+
+    def __init__(self):
+        # type: () -> None
+        # (queue name, serialized event) pairs
+        self.pending = [] # type: List[Tuple[str, str]]
+        self.condition = threading.Condition()
+        self.thread = None # type: Optional[threading.Thread]
+        atexit.register(self.flush)
+
+    def publish(self, queue_name, event):
+        # type: (str, Union[Mapping[str, Any], str]) -> None
+        body = ujson.dumps(event)
+        with self.condition:
+            self.pending.append((queue_name, body))
+            # Threads don't survive a fork, so check that it's alive
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="BackgroundQueuePublisher")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def flush(self):
+        # type: () -> None
+        with self.condition:
+            events = self.pending
+            self.pending = []
+        if not events:
+            return
+        try:
+            with queue_lock:
+                get_queue_client().publish_many_reconnecting(events)
+        except Exception:
+            logging.exception("Failed to publish %d events to rabbitmq; saving them in %s"
+                              % (len(events), settings.QUEUE_ERROR_DIR))
+            self.save_unpublished_events(events)
+
+    def save_unpublished_events(self, events):
+        # type: (List[Tuple[str, str]]) -> None
+        by_queue = defaultdict(list) # type: Dict[str, List[str]]
+        for (queue_name, body) in events:
+            by_queue[queue_name].append(body)
+        try:
+            if not os.path.exists(settings.QUEUE_ERROR_DIR):
+                os.mkdir(settings.QUEUE_ERROR_DIR)
+            for (queue_name, bodies) in by_queue.items():
+                fn = os.path.join(settings.QUEUE_ERROR_DIR, '%s.errors' % (queue_name,))
+                lines = u''.join(u'%s\t%s\n' % (time.asctime(), body) for body in bodies)
+                with lockfile(fn + '.lock'):
+                    with open(fn, 'ab') as f:
+                        f.write(lines.encode('utf-8'))
+        except Exception:
+            logging.exception("Failed to save %d unpublished events" % (len(events),))
+
+    def run(self):
+        # type: () -> None
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+            time.sleep(self.linger_secs)
+            self.flush()
+
+background_publisher = BackgroundQueuePublisher()
+
 def queue_json_publish(queue_name, event, processor):
     # type: (str, Union[Mapping[str, Any], str], Callable[[Any], None]) -> None
     # most events are dicts, but zerver.middleware.write_log_line uses a str
+    if settings.USING_RABBITMQ and settings.QUEUE_PUBLISH_IN_BACKGROUND and \
+            not settings.RUNNING_INSIDE_TORNADO:
+        background_publisher.publish(queue_name, event)
+        return
+
     with queue_lock:
         if settings.USING_RABBITMQ:
             get_queue_client().json_publish(queue_name, event)
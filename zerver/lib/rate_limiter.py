@@ -1,17 +1,16 @@
 from __future__ import absolute_import
 
 from six import text_type
-from typing import Any, Iterator, Tuple
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
 from six.moves import zip
 
 from zerver.models import UserProfile
 
-import redis
 import time
-import logging
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
 # http://blog.domaintools.com/2013/04/rate-limiting-with-redis/
@@ -31,7 +30,8 @@ def _rules_for_user(user):
 def redis_key(user, domain):
     # type: (UserProfile, text_type) -> List[text_type]
     """Return the redis keys for this user"""
-    return ["ratelimit:%s:%s:%s:%s" % (type(user), user.id, domain, keytype) for keytype in ['list', 'zset', 'block']]
+    return ["ratelimit:%s:%s:%s:%s" % (type(user), user.id, domain, keytype)
+            for keytype in ['list', 'zset', 'block', 'gcra']]
 
 def max_api_calls(user):
     # type: (UserProfile) -> int
@@ -59,7 +59,7 @@ def remove_ratelimit_rule(range_seconds, num_requests):
 def block_user(user, seconds, domain='all'):
     # type: (UserProfile, int, text_type) -> None
     "Manually blocks a user id for the desired number of seconds"
-    _, _, blocking_key = redis_key(user, domain)
+    _, _, blocking_key, _ = redis_key(user, domain)
     with client.pipeline() as pipe:
         pipe.set(blocking_key, 1)
         pipe.expire(blocking_key, seconds)
@@ -67,7 +67,7 @@ def block_user(user, seconds, domain='all'):
 
 def unblock_user(user, domain='all'):
     # type: (UserProfile, str) -> None
-    _, _, blocking_key = redis_key(user, domain)
+    _, _, blocking_key, _ = redis_key(user, domain)
     client.delete(blocking_key)
 
 def clear_user_history(user, domain='all'):
@@ -78,10 +78,11 @@ def clear_user_history(user, domain='all'):
     '''
     for key in redis_key(user, domain):
         client.delete(key)
+    local_rate_limiter.clear(user, domain)
 
 def _get_api_calls_left(user, domain, range_seconds, max_calls):
     # type: (UserProfile, text_type, int, int) -> Tuple[int, float]
-    list_key, set_key, _ = redis_key(user, domain)
+    list_key, set_key, _, _ = redis_key(user, domain)
     # Count the number of values in our sorted set
     # that are between now and the cutoff
     now = time.time()
@@ -118,7 +119,7 @@ def api_calls_left(user, domain='all'):
 def is_ratelimited(user, domain='all'):
     # type: (UserProfile, text_type) -> Tuple[bool, float]
     "Returns a tuple of (rate_limited, time_till_free)"
-    list_key, set_key, blocking_key = redis_key(user, domain)
+    list_key, set_key, blocking_key, _ = redis_key(user, domain)
 
     rules = _rules_for_user(user)
 
@@ -166,62 +167,214 @@ def is_ratelimited(user, domain='all'):
     # No api calls recorded yet
     return False, 0.0
 
+# The rate limiter's checks and updates are done by these scripts,
+# atomically and in a single round trip to redis.  Both take
+# KEYS = redis_key(user, domain) and ARGV = [now, check, calls, rule
+# seconds, rule requests, ...] with the rules sorted by seconds.  They
+# record up to `calls` calls, as many as the user has left under every
+# rule (see LocalRateLimiter), and return [rate limited, seconds till
+# free, calls left, calls recorded], with the seconds as a string
+# since redis truncates numbers returned from Lua to integers.  If
+# check is "0", they record the calls regardless of the limits.
+#
+# Manual blocks (block_user) apply to both.
+RATELIMIT_BLOCK_LUA = """
+local now = tonumber(ARGV[1])
+local check = ARGV[2] == '1'
+local calls = tonumber(ARGV[3])
+if check and redis.call('exists', KEYS[3]) == 1 then
+    local ttl = redis.call('ttl', KEYS[3])
+    if ttl < 0 then
+        ttl = 0.5
+    end
+    return {1, tostring(ttl), 0, 0}
+end
+"""
+
+# The sliding window keeps the timestamps of the user's most recent
+# calls (as many as the longest rule allows) in a list, newest first,
+# and the same timestamps in a sorted set for counting.  The user is
+# over a rule allowing n requests if the nth newest call is within it.
+SLIDING_WINDOW_LUA = RATELIMIT_BLOCK_LUA + """
+local max_window = tonumber(ARGV[#ARGV - 1])
+local max_calls = tonumber(ARGV[#ARGV])
+if check then
+    for i = 4, #ARGV, 2 do
+        local window = tonumber(ARGV[i])
+        local num_requests = tonumber(ARGV[i + 1])
+        local timestamp = redis.call('lindex', KEYS[1], num_requests - 1)
+        if timestamp then
+            local boundary = tonumber(timestamp) + window
+            if boundary > now then
+                return {1, tostring(boundary - now), 0, 0}
+            end
+        end
+        if calls > 1 then
+            local used = redis.call('zcount', KEYS[2], now - window, '+inf')
+            calls = math.max(math.min(calls, num_requests - used), 1)
+        end
+    end
+end
+calls = math.min(calls, max_calls)
+local trimmed = redis.call('lrange', KEYS[1], max_calls - calls, max_calls - 1)
+for i = 1, calls do
+    -- Timestamps must be distinct, for the sorted set
+    local timestamp = ARGV[1]
+    if i > 1 then
+        timestamp = string.format('%.6f', now - (i - 1) * 0.000001)
+    end
+    redis.call('lpush', KEYS[1], timestamp)
+    redis.call('zadd', KEYS[2], timestamp, timestamp)
+end
+redis.call('ltrim', KEYS[1], 0, max_calls - 1)
+for _, timestamp in ipairs(trimmed) do
+    redis.call('zrem', KEYS[2], timestamp)
+end
+redis.call('expire', KEYS[1], max_window)
+redis.call('expire', KEYS[2], max_window)
+local count = redis.call('zcount', KEYS[2], now - max_window, '+inf')
+return {0, tostring(max_window), math.max(max_calls - count, 0), calls}
+"""
+
+# GCRA (the generic cell rate algorithm) is a token bucket that stores
+# just one "theoretical arrival time" per rule, in a hash: for a rule
+# allowing n requests every t seconds, each call pushes it t/n seconds
+# further into the future, and a call is over the limit if that would
+# put it more than t seconds ahead of now.
+GCRA_LUA = RATELIMIT_BLOCK_LUA + """
+local tats = {}
+for i = 4, #ARGV, 2 do
+    local window = tonumber(ARGV[i])
+    local interval = window / tonumber(ARGV[i + 1])
+    local tat = math.max(tonumber(redis.call('hget', KEYS[4], ARGV[i]) or 0), now)
+    if check then
+        local available = math.floor((window - (tat - now)) / interval + 1e-9)
+        if available < 1 then
+            return {1, tostring(tat + interval - window - now), 0, 0}
+        end
+        calls = math.min(calls, available)
+    end
+    tats[i] = tat
+end
+local new_tats = {}
+local time_till_free = 0
+local calls_left = 0
+local max_window = 0
+for i = 4, #ARGV, 2 do
+    local window = tonumber(ARGV[i])
+    local interval = window / tonumber(ARGV[i + 1])
+    local new_tat = tats[i] + calls * interval
+    table.insert(new_tats, ARGV[i])
+    table.insert(new_tats, string.format('%.6f', new_tat))
+    time_till_free = new_tat - now
+    calls_left = math.max(math.floor((window - time_till_free) / interval + 1e-9), 0)
+    max_window = math.max(max_window, window)
+end
+redis.call('hmset', KEYS[4], unpack(new_tats))
+redis.call('expire', KEYS[4], math.ceil(max_window))
+return {0, tostring(time_till_free), calls_left, calls}
+"""
+
+ratelimit_scripts = {
+    'sliding_window': client.register_script(SLIDING_WINDOW_LUA),
+    'gcra': client.register_script(GCRA_LUA),
+}
+
+def _run_ratelimit_script(user, domain, check, calls=1):
+    # type: (UserProfile, text_type, bool, int) -> Tuple[bool, float, int, int]
+    args = [time.time(), "1" if check else "0", calls] # type: List[Any]
+    for (range_seconds, num_requests) in _rules_for_user(user):
+        args.extend([range_seconds, num_requests])
+    script = ratelimit_scripts[settings.RATE_LIMITING_ALGORITHM]
+    (ratelimited, time_till_free, calls_left, recorded) = script(keys=redis_key(user, domain), args=args)
+    return bool(ratelimited), float(time_till_free), int(calls_left), int(recorded)
+
+# How long a process may use calls leased from redis for
+RATE_LIMIT_LEASE_SECS = 1.0
+
+class LocalRateLimiter(object):
+    """With RATE_LIMITING_LEASE_SIZE > 1, each process records its users'
+    calls in redis in chunks of up to that many at a time (as many as
+    they have left under every rule), and hands them out locally until
+    they're used up or RATE_LIMIT_LEASE_SECS has passed, so most calls
+    don't need a round trip to redis.
+
+    Calls are recorded before they happen, so this never lets a user
+    exceed a limit by more than the calls that leases recorded just
+    before its window started and that were used after it started:
+    at most RATE_LIMITING_LEASE_SIZE - 1 per process, and only within
+    RATE_LIMIT_LEASE_SECS of the start.  Conversely, leased calls that
+    go unused still count against the user, so they may be limited up
+    to RATE_LIMITING_LEASE_SIZE - 1 calls per process early.  Manual
+    blocks take effect once any current lease runs out."""
+
+    # Stop tracking expired leases past this many users
+    MAX_LEASES = 10000
+
+    def __init__(self):
+        # type: () -> None
+        # (user type, user id, domain) => [calls left in the lease,
+        # expiry, seconds till free and calls left when it was taken]
+        self.leases = {} # type: Dict[Tuple[str, int, text_type], List[Any]]
+
+    def key(self, user, domain):
+        # type: (UserProfile, text_type) -> Tuple[str, int, text_type]
+        return (str(type(user)), user.id, domain)
+
+    def take(self, user, domain):
+        # type: (UserProfile, text_type) -> Optional[Tuple[bool, float, int]]
+        """Uses a call from the user's lease, if they have one."""
+        lease = self.leases.get(self.key(user, domain))
+        if lease is None or lease[0] == 0 or lease[1] < time.time():
+            return None
+        lease[0] -= 1
+        return False, lease[2], lease[3] + lease[0]
+
+    def lease(self, user, domain):
+        # type: (UserProfile, text_type) -> Tuple[bool, float, int]
+        """Leases calls from redis, using one of them."""
+        (ratelimited, time_till_free, calls_left, recorded) = \
+            _run_ratelimit_script(user, domain, True, settings.RATE_LIMITING_LEASE_SIZE)
+        statsd.incr("ratelimiter.lease")
+        if len(self.leases) >= self.MAX_LEASES:
+            now = time.time()
+            self.leases = dict((key, lease) for (key, lease) in self.leases.items()
+                               if lease[1] >= now and lease[0] > 0)
+        if ratelimited:
+            self.leases.pop(self.key(user, domain), None)
+            return True, time_till_free, calls_left
+        self.leases[self.key(user, domain)] = [recorded - 1, time.time() + RATE_LIMIT_LEASE_SECS,
+                                               time_till_free, calls_left]
+        return False, time_till_free, calls_left + recorded - 1
+
+    def clear(self, user, domain):
+        # type: (UserProfile, text_type) -> None
+        self.leases.pop(self.key(user, domain), None)
+
+local_rate_limiter = LocalRateLimiter()
+
+def rate_limit_request(user, domain='all'):
+    # type: (UserProfile, text_type) -> Tuple[bool, float, int]
+    """Checks the user against all of their rate limits and, if they
+    aren't over any of them, records this call.  Returns a tuple of
+    (rate_limited, time_till_free, calls_left), where calls_left is
+    for the longest rule, and time_till_free is how long until the
+    user is no longer limited, or else until their calls under the
+    longest rule are forgotten."""
+    if len(_rules_for_user(user)) == 0:
+        return False, 0.0, 0
+    if settings.RATE_LIMITING_LEASE_SIZE > 1:
+        result = local_rate_limiter.take(user, domain)
+        if result is not None:
+            return result
+        return local_rate_limiter.lease(user, domain)
+    (ratelimited, time_till_free, calls_left, _) = _run_ratelimit_script(user, domain, True)
+    return ratelimited, time_till_free, calls_left
+
 def incr_ratelimit(user, domain='all'):
     # type: (UserProfile, text_type) -> None
     """Increases the rate-limit for the specified user"""
-    list_key, set_key, _ = redis_key(user, domain)
-    now = time.time()
-
     # If we have no rules, we don't store anything
     if len(rules) == 0:
         return
-
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(user) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(user) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(user)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    logging.error("Failed to complete incr_ratelimit transaction without interference 10 times "
-                                  "in a row! Aborting rate-limit increment")
-                    break
-                count += 1
-
-                continue
+    _run_ratelimit_script(user, domain, False)
@@ -0,0 +1,194 @@
+from __future__ import absolute_import
+
+from six import text_type
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from django.db import connection
+from django.db.models import Q, Max, Min
+from zerver.lib.cache import cache_get_many, cache_set_many
+from zerver.lib.cache_helpers import message_cache_items
+from zerver.lib.timeout import alarm_timeout
+from zerver.models import Message, Realm, get_active_user_dicts_in_realm, to_dict_cache_key_id
+from zerver.lib import alert_words, bugdown
+
+import logging
+import multiprocessing
+import os
+import time
+
+# Re-rendering messages in bulk, for when bugdown.version changes.
+# Otherwise each stale message is re-rendered, one query and update
+# at a time, the first time someone fetches it.
+#
+# Also a pool of render worker processes, for rendering batches of
+# messages (e.g. bulk imports) concurrently; bugdown renders one
+# message at a time per process, since it keeps state in globals.
+
+IdRange = Tuple[int, int]
+
+def stale_messages():
+    # type: () -> Any
+    return Message.objects.filter(Q(rendered_content__isnull=True) |
+                                  Q(rendered_content_version__isnull=True) |
+                                  Q(rendered_content_version__lt=bugdown.version))
+
+def render_messages(messages):
+    # type: (Iterable[Message]) -> List[Dict[str, Any]]
+    """Renders the messages (which should have their sender's realm and
+    sending client selected), returning for each the rendered content
+    and what bugdown found in it.  Saves nothing."""
+    results = []
+    for message in messages:
+        rendered_content = message.render_markdown(message.content)
+        results.append(dict(
+            id                        = message.id,
+            rendered_content          = rendered_content,
+            mentions_user_ids         = message.mentions_user_ids,
+            mentions_wildcard         = message.mentions_wildcard,
+            user_ids_with_alert_words = message.user_ids_with_alert_words,
+            is_me_message             = message.is_me_message,
+        ))
+    return results
+
+def warm_render_worker(realm_ids):
+    # type: (Optional[List[int]]) -> None
+    """Initializes a render pool worker.  Renderings in the worker are
+    limited by SIGALRM rather than a thread each, and the Markdown
+    engines, alert word matchers, users and emoji of the realms with
+    ids realm_ids are loaded before the first batch arrives."""
+    bugdown.render_timeout = alarm_timeout
+    if realm_ids is None:
+        return
+    for realm in Realm.objects.filter(id__in=realm_ids):
+        bugdown.maybe_update_realm_filters(realm.domain)
+        alert_words.alert_word_matcher(realm)
+        get_active_user_dicts_in_realm(realm)
+        realm.get_emoji()
+
+def make_render_pool(processes, realm_ids=None):
+    # type: (int, Optional[List[int]]) -> Any
+    # The workers open their own database connections.
+    connection.close()
+    return multiprocessing.Pool(processes, warm_render_worker, (realm_ids,))
+
+def render_message_batches(pool, messages, batch_size=100):
+    # type: (Any, List[Message], int) -> List[Dict[str, Any]]
+    """Renders the messages as render_messages does, in batches of
+    batch_size across a make_render_pool pool, returning the results
+    in order.  Since nothing is saved, the messages needn't be saved
+    yet either."""
+    batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)]
+    return [result for results in pool.imap(render_messages, batches) for result in results]
+
+def bulk_update_rendered_content(rendered):
+    # type: (List[Tuple[int, text_type]]) -> None
+    """Saves (message id, rendered content) pairs with a single UPDATE."""
+    if not rendered:
+        return
+    cursor = connection.cursor()
+    cursor.execute("UPDATE zerver_message"
+                   " SET rendered_content = v.rendered_content, rendered_content_version = %s"
+                   " FROM (VALUES " + ", ".join(["(%s, %s)"] * len(rendered)) + ")"
+                   " AS v(id, rendered_content) WHERE zerver_message.id = v.id",
+                   [bugdown.version] + [param for pair in rendered for param in pair])
+
+def refresh_message_dict_cache(message_ids):
+    # type: (List[int]) -> None
+    """Replaces the cached (rendered) dicts of those of the messages that
+    are cached; the others will be fetched fresh when needed."""
+    keys = [to_dict_cache_key_id(message_id, True) for message_id in message_ids]
+    cached = cache_get_many(keys)
+    cached_ids = [message_id for (message_id, key) in zip(message_ids, keys) if key in cached]
+    if not cached_ids:
+        return
+    items_for_remote_cache = {} # type: Dict[text_type, Any]
+    for row in Message.get_raw_db_rows(cached_ids):
+        message_cache_items(items_for_remote_cache, row)
+    cache_set_many(items_for_remote_cache, timeout=3600*24)
+
+def database_load():
+    # type: () -> int
+    """The number of other database connections running a query."""
+    cursor = connection.cursor()
+    cursor.execute("SELECT count(*) FROM pg_stat_activity"
+                   " WHERE state = 'active' AND pid <> pg_backend_pid()")
+    return cursor.fetchone()[0]
+
+def wait_for_database_load(max_load, poll_secs=1.0):
+    # type: (Optional[int], float) -> None
+    if max_load is None:
+        return
+    while database_load() > max_load:
+        time.sleep(poll_secs)
+
+def rerender_message_range(task):
+    # type: (Tuple[IdRange, Optional[int]]) -> Tuple[IdRange, int, int]
+    """Re-renders the stale messages with ids in [min_id, max_id),
+    waiting first until the database load is at most max_load.
+    Returns the range, with the number of messages re-rendered and the
+    number that failed to render.  Runs in a rerender_messages worker."""
+    ((min_id, max_id), max_load) = task
+    wait_for_database_load(max_load)
+    messages = stale_messages().filter(id__gte=min_id, id__lt=max_id) \
+                               .select_related('sender__realm', 'sending_client')
+    rendered = [(result['id'], result['rendered_content']) for result in render_messages(messages)
+                if result['rendered_content'] is not None]
+    bulk_update_rendered_content(rendered)
+    refresh_message_dict_cache([message_id for (message_id, _) in rendered])
+    failed = len(messages) - len(rendered)
+    if failed:
+        logging.warning("Failed to render %d messages with ids in [%d, %d)" % (failed, min_id, max_id))
+    return ((min_id, max_id), len(rendered), failed)
+
+def stale_message_ranges(batch_size, after_id=None):
+    # type: (int, Optional[int]) -> List[IdRange]
+    """Splits the ids of the stale messages after after_id into ranges
+    of batch_size ids, oldest first."""
+    query = stale_messages()
+    if after_id is not None:
+        query = query.filter(id__gte=after_id)
+    id_range = query.aggregate(Min('id'), Max('id'))
+    if id_range['id__min'] is None:
+        return []
+    return [(min_id, min_id + batch_size)
+            for min_id in range(id_range['id__min'], id_range['id__max'] + 1, batch_size)]
+
+def read_rerender_checkpoint(checkpoint_file):
+    # type: (Optional[str]) -> Optional[int]
+    if checkpoint_file is None or not os.path.exists(checkpoint_file):
+        return None
+    with open(checkpoint_file) as f:
+        return int(f.read().strip())
+
+def rerender_messages(processes=1, batch_size=1000, checkpoint_file=None, max_load=None):
+    # type: (int, int, Optional[str], Optional[int]) -> Iterator[Tuple[IdRange, int, int]]
+    """Re-renders all stale messages, in batches of batch_size ids in id
+    order, across a pool of worker processes, yielding each batch's
+    result as it finishes.  Each batch waits until at most max_load
+    other queries are running in the database.  If checkpoint_file is
+    given, the end of the last finished batch is recorded there, and
+    a later run resumes from it; the file is removed once every
+    message is re-rendered."""
+    after_id = read_rerender_checkpoint(checkpoint_file)
+    if after_id is not None:
+        logging.info("Resuming re-rendering from message id %d" % (after_id,))
+    tasks = [(id_range, max_load) for id_range in stale_message_ranges(batch_size, after_id)]
+
+    pool = None # type: Optional[Any]
+    if processes > 1:
+        pool = make_render_pool(processes)
+        # In order, so that the checkpoint can advance past each result
+        results = pool.imap(rerender_message_range, tasks)
+    else:
+        results = (rerender_message_range(task) for task in tasks)
+    try:
+        for result in results:
+            if checkpoint_file is not None:
+                with open(checkpoint_file, "w") as f:
+                    f.write("%d\n" % (result[0][1],))
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if checkpoint_file is not None and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
@@ -36,12 +36,18 @@ def json_method_not_allowed(methods):
         "allowed_methods": methods}))
     return resp
 
-def json_response(res_type="success", msg="", data=None, status=200):
-    # type: (text_type, text_type, Optional[Dict[str, Any]], int) -> HttpResponse
+def json_response(res_type="success", msg="", data=None, status=200, encoded_data=None):
+    # type: (text_type, text_type, Optional[Dict[str, Any]], int, Optional[Dict[str, str]]) -> HttpResponse
+    """`encoded_data` maps additional keys to values that have already
+    been encoded as JSON; they are spliced into the response as is."""
     content = {"result": res_type, "msg": msg}
     if data is not None:
         content.update(data)
-    return HttpResponse(content=ujson.dumps(content) + "\n",
+    encoded_content = ujson.dumps(content)
+    if encoded_data:
+        encoded_content = encoded_content[:-1] + "".join(
+            ',%s:%s' % (ujson.dumps(key), value) for (key, value) in encoded_data.items()) + "}"
+    return HttpResponse(content=encoded_content + "\n",
                         content_type='application/json', status=status)
 
 def json_success(data=None):
@@ -20,7 +20,9 @@ from zerver.lib.queue import queue_json_publish
 from zerver.lib.actions import check_send_message, extract_recipients
 from zerver.decorator import JsonableError
 from zerver.lib.utils import statsd
-from zerver.lib.event_queue import get_client_descriptor
+from zerver.lib.event_queue import get_client_descriptor, get_shard_for_queue_id, \
+    get_user_profile_id_for_queue_id, tornado_return_queue_name
+from zerver.lib import event_queue
 from zerver.middleware import record_request_start_data, record_request_stop_data, \
     record_request_restart_data, write_log_line, format_timedelta
 from zerver.lib.redis_utils import get_redis_client
@@ -135,11 +137,21 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
             raise SocketAuthError("Missing 'queue_id' argument")
 
         queue_id = msg['request']['queue_id']
-        client = get_client_descriptor(queue_id)
-        if client is None:
+        try:
+            queue_shard = get_shard_for_queue_id(queue_id)
+            queue_owner_id = get_user_profile_id_for_queue_id(queue_id)
+        except ValueError:
             raise SocketAuthError('Bad event queue id: %s' % (queue_id,))
-
-        if user_profile.id != client.user_profile_id:
+        if queue_shard == event_queue.current_tornado_shard:
+            client = get_client_descriptor(queue_id)
+            if client is None:
+                raise SocketAuthError('Bad event queue id: %s' % (queue_id,))
+
+            if user_profile.id != client.user_profile_id:
+                raise SocketAuthError("You are not the owner of the queue with id '%s'" % (queue_id,))
+        elif queue_owner_id != user_profile.id:
+            # The queue lives in another Tornado process; its id says
+            # who owns it.
             raise SocketAuthError("You are not the owner of the queue with id '%s'" % (queue_id,))
 
         self.authenticated = True
@@ -219,7 +231,8 @@ class SocketConnection(sockjs.tornado.SockJSConnection):
                                 req_id=msg['req_id'],
                                 server_meta=dict(user_id=self.session.user_profile.id,
                                                  client_id=self.client_id,
-                                                 return_queue="tornado_return",
+                                                 return_queue=tornado_return_queue_name(
+                                                     event_queue.current_tornado_shard),
                                                  log_data=log_data,
                                                  request_environ=dict(REMOTE_ADDR=self.session.conn_info.ip))),
                            fake_message_sender)
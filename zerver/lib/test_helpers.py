@@ -79,7 +79,15 @@ def simulated_queue_client(client):
 def tornado_redirected_to_list(lst):
     # type: (List[Mapping[str, Any]]) -> Generator[None, None, None]
     real_event_queue_process_notification = event_queue.process_notification
-    event_queue.process_notification = lst.append
+    def process_notification(notice):
+        # type: (Mapping[str, Any]) -> None
+        # Unpack batches sent via send_events, so that tests see the
+        # same list of notices whether or not they were batched.
+        if 'notices' in notice:
+            lst.extend(notice['notices'])
+        else:
+            lst.append(notice)
+    event_queue.process_notification = process_notification
     yield
     event_queue.process_notification = real_event_queue_process_notification
 
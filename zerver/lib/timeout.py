@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from types import TracebackType
 from typing import Any, Callable, Optional, Tuple, TypeVar
 
+import signal
 import sys
 import time
 import ctypes
@@ -92,3 +93,22 @@ def timeout(timeout, func, *args, **kwargs):
         # from http://stackoverflow.com/a/4785766/90777
         six.reraise(thread.exc_info[0], thread.exc_info[1], thread.exc_info[2])
     return thread.result
+
+def alarm_timeout(timeout, func, *args, **kwargs):
+    # type: (float, Callable[..., ResultT], *Any, **Any) -> ResultT
+    '''Like timeout(), but calls the function in this thread and
+       interrupts it with SIGALRM, so no thread is started per call.
+       Only usable in the main thread of a process that has no other
+       use for SIGALRM, such as a worker process of a pool.'''
+
+    def handle_alarm(signum, frame):
+        # type: (int, Any) -> None
+        raise TimeoutExpired
+
+    old_handler = signal.signal(signal.SIGALRM, handle_alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
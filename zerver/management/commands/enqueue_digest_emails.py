@@ -3,13 +3,15 @@ import datetime
 import pytz
 import logging
 
-from typing import Any
+from typing import Any, Iterable, List
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
 
+from zerver.lib.digest import DIGEST_BATCH_SIZE
 from zerver.lib.queue import queue_json_publish
-from zerver.models import UserActivity, UserProfile, get_realm, Realm
+from six.moves import range
+from zerver.models import UserActivity, UserProfile, Realm
 
 ## Logging setup ##
 
@@ -26,19 +28,15 @@ logger.addHandler(file_handler)
 
 
 VALID_DIGEST_DAYS = (1, 2, 3, 4)
-def inactive_since(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> bool
-    # Hasn't used the app in the last 24 business-day hours.
-    most_recent_visit = [row.last_visit for row in \
-                             UserActivity.objects.filter(
-            user_profile=user_profile)]
-
-    if not most_recent_visit:
-        # This person has never used the app.
-        return True
-
-    last_visit = max(most_recent_visit)
-    return last_visit < cutoff
+def inactive_since(user_profiles, cutoff):
+    # type: (Iterable[UserProfile], datetime.datetime) -> List[UserProfile]
+    # Those who haven't used the app in the last 24 business-day
+    # hours, including those who have never used it.
+    active_user_ids = set(UserActivity.objects.filter(
+            user_profile__in=user_profiles,
+            last_visit__gte=cutoff).values_list('user_profile_id', flat=True))
+    return [user_profile for user_profile in user_profiles
+            if user_profile.id not in active_user_ids]
 
 def last_business_day():
     # type: () -> datetime.datetime
@@ -50,12 +48,18 @@ def last_business_day():
 
 # Changes to this should also be reflected in
 # zerver/worker/queue_processors.py:DigestWorker.consume()
-def queue_digest_recipient(user_profile, cutoff):
-    # type: (UserProfile, datetime.datetime) -> None
-    # Convert cutoff to epoch seconds for transit.
-    event = {"user_profile_id": user_profile.id,
-             "cutoff": cutoff.strftime('%s')}
-    queue_json_publish("digest_emails", event, lambda event: None)
+def queue_digest_recipients(user_profiles, cutoff):
+    # type: (List[UserProfile], datetime.datetime) -> None
+    # One event per batch of a realm's recipients, so that the parts
+    # of the digest shared by the realm are gathered once per batch,
+    # while an event that fails (and is retried) only affects its own
+    # batch.
+    for i in range(0, len(user_profiles), DIGEST_BATCH_SIZE):
+        # Convert cutoff to epoch seconds for transit.
+        event = {"user_profile_ids": [user_profile.id for user_profile in
+                                      user_profiles[i:i + DIGEST_BATCH_SIZE]],
+                 "cutoff": cutoff.strftime('%s')}
+        queue_json_publish("digest_emails", event, lambda event: None)
 
 def domains_for_this_deployment():
     # type: () -> List[str]
@@ -105,13 +109,15 @@ in a while.
             if not should_process_digest(domain, deployment_domains):
                 continue
 
-            user_profiles = UserProfile.objects.filter(
-                realm=get_realm(domain), is_active=True, is_bot=False,
-                enable_digest_emails=True)
+            user_profiles = list(UserProfile.objects.filter(
+                realm=realm, is_active=True, is_bot=False,
+                enable_digest_emails=True))
 
-            for user_profile in user_profiles:
-                cutoff = last_business_day()
-                if inactive_since(user_profile, cutoff):
-                    queue_digest_recipient(user_profile, cutoff)
-                    logger.info("%s is inactive, queuing for potential digest" % (
-                            user_profile.email,))
+            cutoff = last_business_day()
+            inactive_user_profiles = inactive_since(user_profiles, cutoff)
+            if not inactive_user_profiles:
+                continue
+            queue_digest_recipients(inactive_user_profiles, cutoff)
+            for user_profile in inactive_user_profiles:
+                logger.info("%s is inactive, queuing for potential digest" % (
+                        user_profile.email,))
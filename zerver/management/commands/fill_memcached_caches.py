@@ -1,22 +1,48 @@
 from __future__ import absolute_import
+from __future__ import print_function
 
 from typing import Any
 
 from optparse import make_option
 from django.core.management.base import BaseCommand
-from zerver.lib.cache_helpers import fill_remote_cache, cache_fillers
+from zerver.lib.cache_helpers import cache_fillers, cache_warmup_order, \
+    warm_remote_caches
+import time
 
 class Command(BaseCommand):
     option_list = BaseCommand.option_list + (
-        make_option('--cache', dest="cache", default=None),)
+        make_option('--cache', dest="cache", default=None),
+        make_option('--processes',
+                    dest='processes',
+                    type='int',
+                    default=1,
+                    help='Number of worker processes to fill the caches with.'),
+        make_option('--shard-size',
+                    dest='shard_size',
+                    type='int',
+                    default=10000,
+                    help='Number of ids in each unit of work.'),
+        make_option('--checkpoint',
+                    dest='checkpoint',
+                    default=None,
+                    help='File to record progress in, to resume an interrupted warmup from.'),
+        )
     help = "Populate the memcached cache of messages."
 
     def handle(self, *args, **options):
-        # type: (*Any, **str) -> None
+        # type: (*Any, **Any) -> None
         if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
-            return
-
-        for cache in cache_fillers.keys():
-            fill_remote_cache(cache)
+            caches = [options["cache"]]
+        else:
+            caches = [cache for cache in cache_warmup_order if cache in cache_fillers]
 
+        start = time.time()
+        stats = warm_remote_caches(caches,
+                                   processes=options["processes"],
+                                   shard_size=options["shard_size"],
+                                   checkpoint_file=options["checkpoint"])
+        for cache in caches:
+            (count, elapsed) = stats[cache]
+            print("%-14s %9d objects %8.1f s %10.0f objects/s per process" %
+                  (cache, count, elapsed, count / elapsed if elapsed else 0))
+        print("Filled in %.1f s" % (time.time() - start,))
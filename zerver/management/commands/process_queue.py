@@ -8,6 +8,7 @@ from django.core.management import CommandError
 from django.conf import settings
 from django.utils import autoreload
 from zerver.worker.queue_processors import get_worker, get_active_worker_queues
+from zerver.worker.supervisor import QueueSupervisor
 import sys
 import signal
 import logging
@@ -22,6 +23,8 @@ class Command(BaseCommand):
                             help="worker label")
         parser.add_argument('--all', dest="all", action="store_true", default=False,
                             help="run all queues")
+        parser.add_argument('--supervise', dest="supervise", action="store_true", default=False,
+                            help="run a pool of worker processes for each queue (or just --queue_name)")
 
     help = "Runs a queue processing worker"
     def handle(self, *args, **options):
@@ -39,7 +42,14 @@ class Command(BaseCommand):
                 td = Threaded_worker(queue_name)
                 td.start()
 
-        if options['all']:
+        if options['supervise']:
+            if options['queue_name']:
+                queue_names = [options['queue_name']]
+            else:
+                queue_names = get_active_worker_queues()
+            logger.info("Supervising workers for queues %s" % (", ".join(queue_names),))
+            QueueSupervisor(queue_names).run()
+        elif options['all']:
             autoreload.main(run_threaded_workers, (logger,))
         else:
             queue_name = options['queue_name']
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from zerver.lib.queue import queue_json_publish
+from zerver.lib.rerender import rerender_message_range, rerender_messages, \
+    stale_message_ranges
+import time
+
+class Command(BaseCommand):
+    help = """Re-render the messages rendered with an older bugdown version.
+
+Re-renders them in batches of ids, oldest first, across a pool of
+processes, saving each batch with one query and refreshing the cached
+message dicts it changes.  With --enqueue, the batches are instead
+queued for the message_rerender queue worker; that doesn't record
+progress, but running it again after an interruption only queues
+batches for the messages that are still stale."""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes',
+                    dest='processes',
+                    type='int',
+                    default=1,
+                    help='Number of worker processes to render with.'),
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=1000,
+                    help='Number of message ids in each batch.'),
+        make_option('--max-db-load',
+                    dest='max_load',
+                    type='int',
+                    default=None,
+                    help='Before each batch, wait until at most this many other database queries are running.'),
+        make_option('--checkpoint',
+                    dest='checkpoint',
+                    default=None,
+                    help='File to record progress in, to resume an interrupted run from.'),
+        make_option('--enqueue',
+                    dest='enqueue',
+                    action='store_true',
+                    default=False,
+                    help='Queue the batches for the message_rerender worker instead.'),
+        )
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options["enqueue"]:
+            if options["checkpoint"] is not None:
+                raise CommandError("--checkpoint can't be used with --enqueue, whose "
+                                   "batches are re-rendered by the queue worker")
+            id_ranges = stale_message_ranges(options["batch_size"])
+            for (min_id, max_id) in id_ranges:
+                event = {"min_id": min_id, "max_id": max_id, "max_load": options["max_load"]}
+                queue_json_publish("message_rerender", event,
+                                   lambda event: rerender_message_range(((event["min_id"], event["max_id"]),
+                                                                         event["max_load"])))
+            print("Queued %d batches" % (len(id_ranges),))
+            return
+
+        start = time.time()
+        total = 0
+        failed = 0
+        for ((min_id, max_id), count, batch_failed) in rerender_messages(
+                processes=options["processes"],
+                batch_size=options["batch_size"],
+                checkpoint_file=options["checkpoint"],
+                max_load=options["max_load"]):
+            total += count
+            failed += batch_failed
+            elapsed = time.time() - start
+            print("Re-rendered messages up to id %d: %d messages, %.0f messages/s" %
+                  (max_id - 1, total, total / elapsed if elapsed else 0))
+        print("Re-rendered %d messages (%d failed) in %.1f s" % (total, failed, time.time() - start))
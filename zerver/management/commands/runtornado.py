@@ -1,7 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from typing import Any
+from typing import Any, Dict, Optional
 
 from django.conf import settings
 settings.RUNNING_INSIDE_TORNADO = True
@@ -25,7 +25,8 @@ from zerver.lib.debug import interactive_debug_listen
 from zerver.lib.response import json_response
 from zerver.lib.event_queue import process_notification, missedmessage_hook
 from zerver.lib.event_queue import setup_event_queue, add_client_gc_hook, \
-    get_descriptor_by_handler_id, clear_handler_by_id
+    get_descriptor_by_handler_id, clear_handler_by_id, get_tornado_port, \
+    set_current_tornado_shard, notify_tornado_queue_name, tornado_return_queue_name
 from zerver.lib.handlers import allocate_handler_id
 from zerver.lib.queue import setup_tornado_rabbitmq
 from zerver.lib.socket import get_sockjs_router, respond_send_message
@@ -75,6 +76,16 @@ class Command(BaseCommand):
         if not port.isdigit():
             raise CommandError("%r is not a valid port number." % (port,))
 
+        # With multiple Tornado processes, each one serves the shard
+        # of the event system corresponding to its port.
+        shard = 0
+        if settings.TORNADO_PROCESSES > 1:
+            shard = int(port) - get_tornado_port(0)
+            if not 0 <= shard < settings.TORNADO_PROCESSES:
+                raise CommandError("Port %s does not correspond to any of the %d Tornado shards."
+                                   % (port, settings.TORNADO_PROCESSES))
+            set_current_tornado_shard(shard)
+
         xheaders = options.get('xheaders', True)
         no_keep_alive = options.get('no_keep_alive', False)
         quit_command = 'CTRL-C'
@@ -93,13 +104,17 @@ class Command(BaseCommand):
             self.validate(display_num_errors=True)
             print("\nDjango version %s" % (django.get_version()))
             print("Tornado server is running at http://%s:%s/" % (addr, port))
+            if settings.TORNADO_PROCESSES > 1:
+                print("Serving event queues for shard %d of %d." % (shard, settings.TORNADO_PROCESSES))
             print("Quit the server with %s." % (quit_command,))
 
             if settings.USING_RABBITMQ:
                 queue_client = get_queue_client()
                 # Process notifications received via RabbitMQ
-                queue_client.register_json_consumer('notify_tornado', process_notification)
-                queue_client.register_json_consumer('tornado_return', respond_send_message)
+                queue_client.register_json_consumer(notify_tornado_queue_name(shard),
+                                                    process_notification)
+                queue_client.register_json_consumer(tornado_return_queue_name(shard),
+                                                    respond_send_message)
 
             try:
                 urls = (r"/notify_tornado",
@@ -347,8 +362,8 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
 
         return response
 
-    def zulip_finish(self, response, request, apply_markdown):
-        # type: (HttpResponse, HttpRequest, bool) -> None
+    def zulip_finish(self, response, request, apply_markdown, encoded_data=None):
+        # type: (HttpResponse, HttpRequest, bool, Optional[Dict[str, str]]) -> None
         # Make sure that Markdown rendering really happened, if requested.
         # This is a security issue because it's where we escape HTML.
         # c.f. ticket #64
@@ -368,7 +383,8 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # tricky; instead just send the (already json-rendered)
         # content on to Tornado
         django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
+                                        data=response, status=self.get_status(),
+                                        encoded_data=encoded_data)
         django_response = self.apply_response_middleware(request, django_response,
                                                          request._resolver)
         # Pass through the content-type from Django, as json content should be
@@ -1,5 +1,5 @@
 from __future__ import absolute_import
-from typing import Any, List, Set, Tuple, TypeVar, \
+from typing import Any, Iterable, List, Set, Tuple, TypeVar, \
     Union, Optional, Sequence, AbstractSet
 from typing.re import Match
 from zerver.lib.str_utils import NonBinaryStr
@@ -12,13 +12,13 @@ from django.contrib.auth.models import AbstractBaseUser, UserManager, \
     PermissionsMixin
 from django.dispatch import receiver
 from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
-    user_profile_by_id_cache_key, user_profile_by_email_cache_key, \
+    flush_user_presence, user_profile_by_id_cache_key, user_profile_by_email_cache_key, \
     generic_bulk_cached_fetch, cache_set, flush_stream, \
-    display_recipient_cache_key, cache_delete, \
+    display_recipient_cache_key, cache_delete, cache_get, user_presence_cache_key, \
     get_stream_cache_key, active_user_dicts_in_realm_cache_key, \
     active_bot_dicts_in_realm_cache_key, active_user_dict_fields, \
-    active_bot_dict_fields
-from zerver.lib.utils import make_safe_digest, generate_random_token
+    active_bot_dict_fields, message_user_cache_key
+from zerver.lib.utils import make_safe_digest, generate_random_token, statsd
 from zerver.lib.str_utils import force_bytes, ModelReprMixin, dict_with_str_keys
 from django.db import transaction
 from zerver.lib.avatar import gravatar_hash, get_avatar_url
@@ -74,6 +74,8 @@ def flush_per_request_caches():
     per_request_display_recipient_cache = {}
     global per_request_realm_filters_cache
     per_request_realm_filters_cache = {}
+    global per_request_message_user_cache
+    per_request_message_user_cache = {}
 
 @cache_with_key(lambda *args: display_recipient_cache_key(args[0]),
                 timeout=3600*24*7)
@@ -539,6 +541,14 @@ class PushDeviceToken(models.Model):
     # [optional] Contains the app id of the device if it is an iOS device
     ios_app_id = models.TextField(null=True) # type: Optional[text_type]
 
+def flush_push_device_token(sender, **kwargs):
+    # type: (Any, **Any) -> None
+    # Cached presence info records whether the user has push devices
+    cache_delete(user_presence_cache_key(kwargs['instance'].user_id))
+
+post_save.connect(flush_push_device_token, sender=PushDeviceToken)
+post_delete.connect(flush_push_device_token, sender=PushDeviceToken)
+
 class MitUser(models.Model):
     email = models.EmailField(unique=True) # type: text_type
     # status: whether an object has been confirmed.
@@ -808,13 +818,121 @@ def linebreak(string):
     # type: (text_type) -> text_type
     return string.replace('\n\n', '<p/>').replace('\n', '<br/>')
 
+# Message dicts are cached in a compact form, which leaves out the
+# fields describing the sender, and replaces the users in a private
+# message's display_recipient with their ids.  Those are filled back
+# in when the dict is extracted, from a small cache of per-user
+# records shared by all the messages they sent or received.
+COMPACT_MESSAGE_DICT_MARKER = b'\x01' # zlib output never starts with this
+MESSAGE_DICT_SENDER_FIELDS = {
+    'sender_email': 'email',
+    'sender_full_name': 'full_name',
+    'sender_short_name': 'short_name',
+    'sender_domain': 'domain',
+    'gravatar_hash': 'gravatar_hash',
+    'avatar_url': 'avatar_url',
+} # type: Dict[str, str]
+DISPLAY_RECIPIENT_USER_FIELDS = ['email', 'domain', 'full_name', 'short_name',
+                                 'id', 'is_mirror_dummy'] # type: List[str]
+
+@cache_with_key(lambda *args: message_user_cache_key(args[0]),
+                timeout=3600*24*7)
+def get_message_user_remote_cache(user_profile_id):
+    # type: (int) -> Dict[str, Any]
+    return message_user_dict(UserProfile.objects.select_related('realm').get(id=user_profile_id))
+
+def message_user_dict(user_profile):
+    # type: (UserProfile) -> Dict[str, Any]
+    return {'email': user_profile.email,
+            'domain': user_profile.realm.domain,
+            'full_name': user_profile.full_name,
+            'short_name': user_profile.short_name,
+            'id': user_profile.id,
+            'is_mirror_dummy': user_profile.is_mirror_dummy,
+            'gravatar_hash': gravatar_hash(user_profile.email),
+            'avatar_url': get_avatar_url(user_profile.avatar_source, user_profile.email)}
+
+per_request_message_user_cache = {} # type: Dict[int, Dict[str, Any]]
+def get_message_user_dict(user_profile_id):
+    # type: (int) -> Dict[str, Any]
+    if user_profile_id not in per_request_message_user_cache:
+        per_request_message_user_cache[user_profile_id] = \
+            get_message_user_remote_cache(user_profile_id)
+    return per_request_message_user_cache[user_profile_id]
+
+def fetch_message_user_dicts(user_profile_ids):
+    # type: (Iterable[int]) -> None
+    """Adds the given users' dicts to the per-request cache, with one
+    remote cache request and at most one query for all of them."""
+    needed_ids = set(user_profile_ids) - set(per_request_message_user_cache)
+    if not needed_ids:
+        return
+    per_request_message_user_cache.update(generic_bulk_cached_fetch(
+        message_user_cache_key,
+        lambda ids: UserProfile.objects.select_related('realm').filter(id__in=ids),
+        needed_ids,
+        cache_transformer=message_user_dict,
+        timeout=3600*24*7))
+
+def extract_message_dicts(messages_bytes):
+    # type: (List[binary_type]) -> List[Dict[str, Any]]
+    """Bulk version of extract_message_dict, which fetches the users
+    the messages refer to all at once."""
+    # The decoded compact dicts, or None for those cached before the
+    # compact encoding
+    compact_dicts = [] # type: List[Optional[Dict[str, Any]]]
+    user_profile_ids = set() # type: Set[int]
+    for message_bytes in messages_bytes:
+        if message_bytes[:1] != COMPACT_MESSAGE_DICT_MARKER:
+            compact_dicts.append(None)
+            continue
+        message_dict = decode_message_dict(message_bytes)
+        user_profile_ids.add(message_dict['sender_id'])
+        if message_dict['type'] == 'private':
+            user_profile_ids.update(message_dict['display_recipient'])
+        compact_dicts.append(message_dict)
+    fetch_message_user_dicts(user_profile_ids)
+    return [fill_message_dict(compact_dict) if compact_dict is not None
+            else extract_message_dict(message_bytes)
+            for (message_bytes, compact_dict) in zip(messages_bytes, compact_dicts)]
+
+def decode_message_dict(message_bytes):
+    # type: (binary_type) -> Dict[str, Any]
+    return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes[1:]).decode("utf-8")))
+
 def extract_message_dict(message_bytes):
     # type: (binary_type) -> Dict[str, Any]
-    return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+    if message_bytes[:1] != COMPACT_MESSAGE_DICT_MARKER:
+        # Cached before the compact encoding
+        return dict_with_str_keys(ujson.loads(zlib.decompress(message_bytes).decode("utf-8")))
+    return fill_message_dict(decode_message_dict(message_bytes))
+
+def fill_message_dict(message_dict):
+    # type: (Dict[str, Any]) -> Dict[str, Any]
+    """Fills in the sender and recipient fields of a compact message
+    dict from the users' current dicts."""
+    sender = get_message_user_dict(message_dict['sender_id'])
+    for (key, field) in MESSAGE_DICT_SENDER_FIELDS.items():
+        message_dict[key] = sender[field]
+    if message_dict['type'] == 'private':
+        display_recipient = [] # type: List[Dict[str, Any]]
+        for user_profile_id in message_dict['display_recipient']:
+            user = get_message_user_dict(user_profile_id)
+            display_recipient.append(dict((field, user[field])
+                                          for field in DISPLAY_RECIPIENT_USER_FIELDS))
+        message_dict['display_recipient'] = display_recipient
+    return message_dict
 
 def stringify_message_dict(message_dict):
     # type: (Dict[str, Any]) -> binary_type
-    return zlib.compress(force_bytes(ujson.dumps(message_dict)))
+    compact = dict((key, value) for (key, value) in message_dict.items()
+                   if key not in MESSAGE_DICT_SENDER_FIELDS)
+    if message_dict['type'] == 'private':
+        compact['display_recipient'] = [recip['id'] for recip in message_dict['display_recipient']]
+    return COMPACT_MESSAGE_DICT_MARKER + zlib.compress(force_bytes(ujson.dumps(compact)))
+
+# How long message dicts are cached for
+MESSAGE_DICT_CACHE_TIMEOUT = 3600*24
 
 def to_dict_cache_key_id(message_id, apply_markdown):
     # type: (int, bool) -> text_type
@@ -856,12 +974,16 @@ class Message(ModelReprMixin, models.Model):
         # type: () -> Realm
         return self.sender.realm
 
-    def render_markdown(self, content, domain=None):
-        # type: (text_type, Optional[text_type]) -> text_type
+    def render_markdown(self, content, domain=None, defer_link_previews=False):
+        # type: (text_type, Optional[text_type], bool) -> text_type
         """Return HTML for given markdown. Bugdown may add properties to the
         message object such as `mentions_user_ids` and `mentions_wildcard`.
         These are only on this Django object and are not saved in the
         database.
+
+        With defer_link_previews, link previews that aren't cached are
+        left out and recorded in `link_previews_pending`, to be fetched
+        by the link_previews queue worker (see queue_link_previews).
         """
         global bugdown
         if bugdown is None:
@@ -872,6 +994,8 @@ class Message(ModelReprMixin, models.Model):
         self.is_me_message = False
         self.mentions_user_ids = set() # type: Set[int]
         self.user_ids_with_alert_words = set() # type: Set[int]
+        self.link_previews_pending = set() if defer_link_previews else None # type: Optional[Set[Tuple[text_type, text_type]]]
+        self.link_preview_failed = False
 
         if not domain:
             domain = self.sender.realm.domain
@@ -908,8 +1032,8 @@ class Message(ModelReprMixin, models.Model):
         # type: () -> None
         self.save(update_fields=["rendered_content", "rendered_content_version"])
 
-    def maybe_render_content(self, domain, save = False):
-        # type: (Optional[text_type], bool) -> bool
+    def maybe_render_content(self, domain, save = False, defer_link_previews = False):
+        # type: (Optional[text_type], bool, bool) -> bool
         """Render the markdown if there is no existing rendered_content"""
         global bugdown
         if bugdown is None:
@@ -917,7 +1041,7 @@ class Message(ModelReprMixin, models.Model):
             # 'from zerver.lib import bugdown' gives mypy error in python 3 mode.
 
         if Message.need_to_render_content(self.rendered_content, self.rendered_content_version):
-            return self.set_rendered_content(self.render_markdown(self.content, domain), save)
+            return self.set_rendered_content(self.render_markdown(self.content, domain, defer_link_previews), save)
         else:
             return True
 
@@ -930,7 +1054,7 @@ class Message(ModelReprMixin, models.Model):
         # type: (bool) -> Dict[str, Any]
         return extract_message_dict(self.to_dict_json(apply_markdown))
 
-    @cache_with_key(to_dict_cache_key, timeout=3600*24)
+    @cache_with_key(to_dict_cache_key, timeout=MESSAGE_DICT_CACHE_TIMEOUT)
     def to_dict_json(self, apply_markdown):
         # type: (bool) -> binary_type
         return self.to_dict_uncached(apply_markdown)
@@ -1121,34 +1245,37 @@ class Message(ModelReprMixin, models.Model):
             content           = self.content,
             timestamp         = datetime_to_timestamp(self.pub_date))
 
+    # The fields of a Message and related objects that
+    # build_dict_from_raw_db_row needs
+    RAW_DB_ROW_FIELDS = [
+        'id',
+        'subject',
+        'pub_date',
+        'last_edit_time',
+        'edit_history',
+        'content',
+        'rendered_content',
+        'rendered_content_version',
+        'recipient_id',
+        'recipient__type',
+        'recipient__type_id',
+        'sender_id',
+        'sending_client__name',
+        'sender__email',
+        'sender__full_name',
+        'sender__short_name',
+        'sender__realm__id',
+        'sender__realm__domain',
+        'sender__avatar_source',
+        'sender__is_mirror_dummy',
+    ] # type: List[str]
+
     @staticmethod
     def get_raw_db_rows(needed_ids):
         # type: (List[int]) -> List[Dict[str, Any]]
         # This is a special purpose function optimized for
         # callers like get_old_messages_backend().
-        fields = [
-            'id',
-            'subject',
-            'pub_date',
-            'last_edit_time',
-            'edit_history',
-            'content',
-            'rendered_content',
-            'rendered_content_version',
-            'recipient_id',
-            'recipient__type',
-            'recipient__type_id',
-            'sender_id',
-            'sending_client__name',
-            'sender__email',
-            'sender__full_name',
-            'sender__short_name',
-            'sender__realm__id',
-            'sender__realm__domain',
-            'sender__avatar_source',
-            'sender__is_mirror_dummy',
-        ]
-        return Message.objects.filter(id__in=needed_ids).values(*fields)
+        return Message.objects.filter(id__in=needed_ids).values(*Message.RAW_DB_ROW_FIELDS)
 
     @classmethod
     def remove_unreachable(cls):
@@ -1158,7 +1285,12 @@ class Message(ModelReprMixin, models.Model):
 
     def sent_by_human(self):
         # type: () -> bool
-        sending_client = self.sending_client.name.lower()
+        return Message.is_human_client(self.sending_client)
+
+    @staticmethod
+    def is_human_client(client):
+        # type: (Client) -> bool
+        sending_client = client.name.lower()
 
         return (sending_client in ('zulipandroid', 'zulipios', 'zulipdesktop',
                                    'website', 'ios', 'android')) or \
@@ -1259,14 +1391,27 @@ class UserMessage(ModelReprMixin, models.Model):
         # type: () -> List[str]
         return [flag for flag in self.flags.keys() if getattr(self.flags, flag).is_set]
 
+def make_usermessage_flag_tables():
+    # type: () -> List[List[List[str]]]
+    """For each byte of the flags bitmask, builds a table mapping each
+    possible value of that byte to the list of flags it encodes."""
+    tables = [] # type: List[List[List[str]]]
+    for shift in range(0, len(UserMessage.ALL_FLAGS), 8):
+        byte_flags = UserMessage.ALL_FLAGS[shift:shift + 8]
+        tables.append([[flag for (i, flag) in enumerate(byte_flags) if value & (1 << i)]
+                       for value in range(256)])
+    return tables
+
+usermessage_flag_tables = make_usermessage_flag_tables()
+
 def parse_usermessage_flags(val):
     # type: (int) -> List[str]
-    flags = []
-    mask = 1
-    for flag in UserMessage.ALL_FLAGS:
-        if val & mask:
-            flags.append(flag)
-        mask <<= 1
+    # This is called for every row get_old_messages returns, so rather
+    # than testing each flag's bit, decode a byte at a time.
+    flags = [] # type: List[str]
+    for table in usermessage_flag_tables:
+        flags.extend(table[val & 0xff])
+        val >>= 8
     return flags
 
 class Attachment(ModelReprMixin, models.Model):
@@ -1502,12 +1647,11 @@ class UserPresence(models.Model):
                 'user_profile__is_mirror_dummy',
         )
 
-        mobile_user_ids = [row['user'] for row in PushDeviceToken.objects.filter(
-                user__realm_id=1,
+        mobile_user_ids = set(row['user'] for row in PushDeviceToken.objects.filter(
+                user__realm_id=realm_id,
                 user__is_active=True,
                 user__is_bot=False,
-        ).distinct("user").values("user")]
-
+        ).distinct("user").values("user"))
 
         for row in query:
             info = UserPresence.to_presence_dict(
@@ -1522,6 +1666,67 @@ class UserPresence(models.Model):
 
         return user_statuses
 
+    @staticmethod
+    def get_status_dicts_for_users(user_profile_ids):
+        # type: (Iterable[int]) -> Dict[int, Dict[text_type, Dict[str, Any]]]
+        """Returns the presence info for each of the given users, keyed by
+        user id and then by client name, as in get_status_dict_by_realm.
+        Bots, inactive users, and users with no presence information map
+        to an empty dict.
+
+        Each user's presence is cached separately in the remote cache and
+        kept up to date by do_update_user_presence, so this only does
+        work proportional to the number of users asked about, rather
+        than the size of their realm."""
+        start = time.time()
+        misses = [0]
+
+        def query_function(user_profile_ids):
+            # type: (List[int]) -> List[Tuple[int, Dict[text_type, Dict[str, Any]]]]
+            misses[0] += len(user_profile_ids)
+            if len(user_profile_ids) == 0:
+                return []
+            user_statuses = dict((user_profile_id, {}) for user_profile_id in user_profile_ids) # type: Dict[int, Dict[text_type, Dict[str, Any]]]
+            query = UserPresence.objects.filter(
+                    user_profile_id__in=user_profile_ids,
+                    user_profile__is_active=True,
+                    user_profile__is_bot=False
+            ).values(
+                    'client__name',
+                    'status',
+                    'timestamp',
+                    'user_profile__id',
+                    'user_profile__enable_offline_push_notifications',
+                    'user_profile__is_mirror_dummy',
+            )
+            mobile_user_ids = set(row['user'] for row in PushDeviceToken.objects.filter(
+                    user_id__in=user_profile_ids,
+            ).distinct("user").values("user"))
+
+            for row in query:
+                info = UserPresence.to_presence_dict(
+                        client_name=row['client__name'],
+                        status=row['status'],
+                        dt=row['timestamp'],
+                        push_enabled=row['user_profile__enable_offline_push_notifications'],
+                        has_push_devices=row['user_profile__id'] in mobile_user_ids,
+                        is_mirror_dummy=row['user_profile__is_mirror_dummy'],
+                        )
+                user_statuses[row['user_profile__id']][row['client__name']] = info
+            return list(user_statuses.items())
+
+        user_profile_ids = list(user_profile_ids)
+        result = generic_bulk_cached_fetch(user_presence_cache_key,
+                                           query_function,
+                                           user_profile_ids,
+                                           id_fetcher=lambda row: row[0],
+                                           cache_transformer=lambda row: row[1])
+
+        statsd.incr("presence_cache.hit", len(user_profile_ids) - misses[0])
+        statsd.incr("presence_cache.miss", misses[0])
+        statsd.timing("presence_cache.latency", (time.time() - start) * 1000)
+        return result
+
     @staticmethod
     def to_presence_dict(client_name=None, status=None, dt=None, push_enabled=None,
                          has_push_devices=None, is_mirror_dummy=None):
@@ -1559,6 +1764,11 @@ class UserPresence(models.Model):
     class Meta(object):
         unique_together = ("user_profile", "client")
 
+# Rather than updating the user's cached presence in place, which would
+# race with concurrent updates from their other clients, we let the next
+# read refill it.
+post_save.connect(flush_user_presence, sender=UserPresence)
+
 class DefaultStream(models.Model):
     realm = models.ForeignKey(Realm) # type: Realm
     stream = models.ForeignKey(Stream) # type: Stream
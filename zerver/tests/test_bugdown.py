@@ -7,22 +7,38 @@ from django.test import TestCase
 from zerver.lib import bugdown
 from zerver.lib.actions import (
     check_add_realm_emoji,
+    do_change_full_name,
+    do_fetch_link_previews,
     do_remove_realm_emoji,
+    do_update_link_previews,
     do_set_alert_words,
     get_realm,
 )
+from zerver.lib.cache import cache_get, cache_set, get_cache_backend
 from zerver.lib.camo import get_camo_url
+from zerver.lib import link_preview
+from zerver.lib import rerender
+from zerver.lib.test_helpers import AuthedTestCase
+from zerver.lib.timeout import alarm_timeout, TimeoutExpired
 from zerver.models import (
+    extract_message_dict,
     get_client,
     get_user_profile_by_email,
+    to_dict_cache_key_id,
     Message,
     RealmFilter,
+    Recipient,
+    UserMessage,
 )
 
 import mock
 import os
+import tempfile
+import threading
+import time
 import ujson
 import six
+from six.moves import BaseHTTPServer
 
 class FencedBlockPreprocessorTest(TestCase):
     def test_simple_quoting(self):
@@ -388,6 +404,27 @@ class BugdownTest(TestCase):
         self.assertEqual(converted, '<p>We should fix <a href="https://trac.zulip.net/ticket/224" target="_blank" title="https://trac.zulip.net/ticket/224">#224</a> and <a href="https://trac.zulip.net/ticket/115" target="_blank" title="https://trac.zulip.net/ticket/115">#115</a>, but not issue#124 or #1124z or <a href="https://trac.zulip.net/ticket/16" target="_blank" title="https://trac.zulip.net/ticket/16">trac #15</a> today.</p>')
         self.assertEqual(converted_subject,  [u'https://trac.zulip.net/ticket/444'])
 
+    def test_subject_links(self):
+        realm = get_realm('zulip.com')
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        with mock.patch.object(bugdown.CompiledRealmFilters, 'subject_links',
+                               autospec=True, side_effect=bugdown.CompiledRealmFilters.subject_links) as m:
+            self.assertEqual(bugdown.subject_links('zulip.com', "#444 and #555"),
+                             [u'https://trac.zulip.net/ticket/444', u'https://trac.zulip.net/ticket/555'])
+            self.assertEqual(bugdown.subject_links('zulip.com', "#444 and #555"),
+                             [u'https://trac.zulip.net/ticket/444', u'https://trac.zulip.net/ticket/555'])
+            self.assertEqual(m.call_count, 1)
+
+            # Overlapping filters each link their matches, in filter order
+            RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{3})",
+                        url_format_string=r"https://example.com/%(id)s").save()
+            self.assertEqual(bugdown.subject_links('zulip.com', "#444 and #555"),
+                             [u'https://trac.zulip.net/ticket/444', u'https://trac.zulip.net/ticket/555',
+                              u'https://example.com/444', u'https://example.com/555'])
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(bugdown.subject_links('zulip.com', "no links"), [])
+
     def test_realm_patterns_negative(self):
         realm = get_realm('zulip.com')
         RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
@@ -474,6 +511,66 @@ class BugdownTest(TestCase):
                          '<p>Hey @<strong>Nonexistent User</strong></p>')
         self.assertEqual(msg.mentions_user_ids, set())
 
+    def test_render_cache(self):
+        sender_user_profile = get_user_profile_by_email("othello@zulip.com")
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        do_set_alert_words(hamlet, ["scaryword"])
+        content = "@**King Hamlet** is a scaryword"
+        rendered = ('<p><span class="user-mention" data-user-email="hamlet@zulip.com">'
+                    '@King Hamlet</span> is a scaryword</p>')
+
+        def render(content):
+            msg = Message(sender=sender_user_profile, sending_client=get_client("test"))
+            with mock.patch('zerver.lib.bugdown.do_convert', wraps=bugdown.do_convert) as m:
+                self.assertEqual(msg.render_markdown(content), rendered)
+            self.assertEqual(msg.mentions_user_ids, set([hamlet.id]))
+            self.assertEqual(msg.user_ids_with_alert_words, set([hamlet.id]))
+            return m.call_count
+
+        with self.settings(BUGDOWN_RENDER_CACHE=True):
+            (hits, misses) = bugdown.get_bugdown_cache_stats()
+            self.assertEqual(render(content), 1)
+            # The mentions and alert words come from the cache entry,
+            # and the realm's users aren't fetched for the key
+            with mock.patch('zerver.models.get_active_user_dicts_in_realm') as user_dicts:
+                self.assertEqual(render(content), 0)
+            self.assertFalse(user_dicts.called)
+            self.assertEqual(bugdown.get_bugdown_cache_stats(), (hits + 1, misses + 1))
+
+            # A change to the realm's users changes the key
+            do_change_full_name(get_user_profile_by_email("cordelia@zulip.com"), "Cordelia")
+            self.assertEqual(render(content), 1)
+
+            # Fenced code hides alert words from the render, so isn't cached
+            self.assertFalse(bugdown.render_cacheable("```\nscaryword\n```"))
+
+    def test_render_cache_preview(self):
+        realm = get_user_profile_by_email("othello@zulip.com").realm
+        content = "a **preview** of @**King Hamlet**"
+
+        def preview(content):
+            with mock.patch('zerver.lib.bugdown.do_convert', wraps=bugdown.do_convert) as m:
+                rendered = bugdown.convert(content, realm.domain, realm=realm)
+            return (rendered, m.call_count)
+
+        with self.settings(BUGDOWN_RENDER_CACHE=True):
+            (rendered, calls) = preview(content)
+            self.assertEqual(calls, 1)
+            self.assertEqual(preview(content), (rendered, 0))
+
+            # Message renderings resolve mentions, so they don't share
+            # entries with previews
+            msg = Message(sender=get_user_profile_by_email("othello@zulip.com"),
+                          sending_client=get_client("test"))
+            with mock.patch('zerver.lib.bugdown.do_convert', wraps=bugdown.do_convert) as m:
+                self.assertNotEqual(msg.render_markdown(content), rendered)
+            self.assertEqual(m.call_count, 1)
+
+            # Nor are renderings without a realm to key them by
+            with mock.patch('zerver.lib.bugdown.do_convert', wraps=bugdown.do_convert) as m:
+                self.assertEqual(bugdown.convert(content, realm.domain), rendered)
+            self.assertEqual(m.call_count, 1)
+
     def test_stream_subscribe_button_simple(self):
         msg = '!_stream_subscribe_button(simple)'
         converted = bugdown_convert(msg)
@@ -556,3 +653,199 @@ class BugdownTest(TestCase):
             '<p><a href="https://lists.debian.org/debian-ctte/2014/02/msg00173.html" target="_blank" title="https://lists.debian.org/debian-ctte/2014/02/msg00173.html">https://lists.debian.org/debian-ctte/2014/02/msg00173.html</a></p>',
             )
 
+class RerenderTest(AuthedTestCase):
+    def test_rerender_messages(self):
+        message_ids = [self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, u"plain")
+                       for i in range(2)]
+        # Cache the first message's dict, before its rendering goes stale
+        Message.objects.get(id=message_ids[0]).to_dict(True)
+        Message.objects.filter(id__in=message_ids).update(content=u"**bold**",
+                                                          rendered_content_version=bugdown.version - 1)
+
+        checkpoint_file = os.path.join(tempfile.mkdtemp(), 'rerender_checkpoint')
+        results = list(rerender.rerender_messages(batch_size=1, checkpoint_file=checkpoint_file))
+        self.assertEqual(sum(count for (_, count, _) in results), 2)
+        self.assertFalse(os.path.exists(checkpoint_file))
+        self.assertEqual(rerender.stale_messages().filter(id__in=message_ids).count(), 0)
+        for message in Message.objects.filter(id__in=message_ids):
+            self.assertEqual(message.rendered_content, u"<p><strong>bold</strong></p>")
+            self.assertEqual(message.rendered_content_version, bugdown.version)
+
+        # The cached dict was refreshed; the uncached one wasn't cached
+        cached = cache_get(to_dict_cache_key_id(message_ids[0], True))
+        self.assertEqual(extract_message_dict(cached[0])['content'], u"<p><strong>bold</strong></p>")
+        self.assertIsNone(cache_get(to_dict_cache_key_id(message_ids[1], True)))
+
+    def test_render_message_batches(self):
+        class InProcessPool(object):
+            # Stands in for a make_render_pool pool
+            def imap(self, func, iterable):
+                return six.moves.map(func, iterable)
+
+        sender = get_user_profile_by_email("othello@zulip.com")
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        do_set_alert_words(hamlet, ["scaryword"])
+        contents = [u"@**King Hamlet**", u"a scaryword", u"/me waves", u"**bold**", u"@**all**"]
+        # Unsaved, as in a bulk import
+        messages = [Message(sender=sender, sending_client=get_client("test"), content=content)
+                    for content in contents]
+        results = rerender.render_message_batches(InProcessPool(), messages, batch_size=2)
+        self.assertIn(u'data-user-email="hamlet@zulip.com"', results[0]['rendered_content'])
+        self.assertEqual([result['mentions_user_ids'] for result in results],
+                         [set([hamlet.id]), set(), set(), set(), set()])
+        self.assertEqual([result['user_ids_with_alert_words'] for result in results],
+                         [set(), set([hamlet.id]), set(), set(), set()])
+        self.assertEqual([result['is_me_message'] for result in results],
+                         [False, False, True, False, False])
+        self.assertEqual([result['mentions_wildcard'] for result in results],
+                         [False, False, False, False, True])
+        self.assertEqual(results[3]['rendered_content'], u"<p><strong>bold</strong></p>")
+
+    def test_warm_render_worker(self):
+        realm = get_user_profile_by_email("othello@zulip.com").realm
+        with mock.patch('zerver.lib.bugdown.render_timeout', bugdown.timeout), \
+                mock.patch('zerver.lib.rerender.alert_words.alert_word_matcher') as matcher:
+            rerender.warm_render_worker([realm.id])
+            matcher.assert_called_once_with(realm)
+            # Renderings are interrupted by SIGALRM, without a thread
+            self.assertEqual(bugdown.render_timeout, alarm_timeout)
+            with mock.patch('zerver.lib.timeout.threading.Thread') as thread:
+                self.assertEqual(bugdown.convert(u"**bold**"), u"<p><strong>bold</strong></p>")
+            self.assertFalse(thread.called)
+        with self.assertRaises(TimeoutExpired):
+            alarm_timeout(0.1, time.sleep, 10)
+
+class OpenGraphHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Stands in for a site we fetch link previews from: /image has an
+    # Open Graph image, and any other page doesn't.
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/image':
+            head = ('<meta property="og:image" content="https://example.com/preview.png" />'
+                    '<meta property="og:title" content="Preview" />')
+        else:
+            head = '<title>No preview</title>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(('<html><head>%s</head><body></body></html>' % (head,)).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        pass
+
+class LinkPreviewTest(AuthedTestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), OpenGraphHandler)
+        self.server.paths = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        # The test suite's database cache is a dummy
+        caches = dict(settings.CACHES, database={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'link-preview-test',
+        })
+        self.cache_settings = self.settings(CACHES=caches)
+        self.cache_settings.enable()
+        get_cache_backend('database').clear()
+
+    def tearDown(self):
+        self.cache_settings.disable()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+    def test_fetch_link_preview(self):
+        preview = {'image': 'https://example.com/preview.png', 'title': 'Preview', 'desc': None}
+        for i in range(2):
+            self.assertEqual(bugdown.link_preview("open_graph", self.url('/image')), preview)
+            # Pages without a preview are cached too
+            self.assertIsNone(bugdown.link_preview("open_graph", self.url('/plain')))
+        self.assertEqual(self.server.paths, ['/image', '/plain'])
+
+        # So are failed fetches, for a shorter time
+        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', side_effect=IOError) as fetch, \
+                mock.patch('logging.warning'):
+            for i in range(2):
+                self.assertIsNone(bugdown.link_preview("open_graph", self.url('/timeout')))
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(cache_get(bugdown.link_preview_cache_key("open_graph", self.url('/timeout')),
+                                   cache_name="database"), (bugdown.LINK_PREVIEW_FAILED,))
+
+    def test_failed_link_preview_not_render_cached(self):
+        url = 'https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5'
+        message = Message(sender=get_user_profile_by_email("hamlet@zulip.com"),
+                          sending_client=get_client("test"))
+        with self.settings(BUGDOWN_RENDER_CACHE=True, INLINE_PREVIEWS_IN_BACKGROUND=False), \
+                mock.patch('zerver.lib.bugdown.fetch_open_graph_image', side_effect=IOError), \
+                mock.patch('zerver.lib.bugdown.cache_set', wraps=cache_set) as render_cache_set, \
+                mock.patch('logging.warning'):
+            message.render_markdown(url)
+            self.assertTrue(message.link_preview_failed)
+            # Rendering again uses the cached failure, and still isn't cached
+            message.render_markdown(url)
+            self.assertTrue(message.link_preview_failed)
+        self.assertFalse([call for call in render_cache_set.call_args_list
+                          if call[0][0].startswith(u"bugdown_render:")])
+
+    def test_host_slots(self):
+        with self.settings(LINK_PREVIEW_MAX_FETCHES_PER_HOST=1), \
+                mock.patch.object(link_preview, 'HOST_WAIT_SECS', 0):
+            self.assertTrue(link_preview.acquire_host_slot(u"slots.example.com", "a"))
+            self.assertFalse(link_preview.acquire_host_slot(u"slots.example.com", "b"))
+            link_preview.release_host_slot(u"slots.example.com", "a")
+            self.assertTrue(link_preview.acquire_host_slot(u"slots.example.com", "b"))
+            link_preview.release_host_slot(u"slots.example.com", "b")
+
+    def test_deferred_link_previews(self):
+        url = 'https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5'
+        link = '<p><a href="%s" target="_blank" title="%s">%s</a></p>' % (url, url, url)
+        fetch_open_graph_image = bugdown.fetch_open_graph_image
+        with self.settings(INLINE_PREVIEWS_IN_BACKGROUND=True), \
+                mock.patch('zerver.lib.bugdown.fetch_open_graph_image',
+                           side_effect=lambda url: fetch_open_graph_image(self.url('/image'))), \
+                mock.patch('zerver.lib.actions.queue_json_publish') as queue_json_publish:
+            message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, url)
+
+            # The message is sent without waiting for the preview
+            self.assertEqual(Message.objects.get(id=message_id).rendered_content,
+                             link + '\n<div class="message_inline_preview_pending"></div>')
+            self.assertEqual(self.server.paths, [])
+            [(queue_name, event, _)] = [call[0] for call in queue_json_publish.call_args_list
+                                        if call[0][0] == "link_previews"]
+            self.assertEqual(event, {'message_id': message_id, 'previews': [("open_graph", url)]})
+
+            with mock.patch('zerver.lib.actions.send_event') as send_event:
+                do_fetch_link_previews(ujson.loads(ujson.dumps(event)))
+
+        rendered_content = link + ('\n<div class="message_inline_image"><a href="%s" target="_blank" title="Preview">'
+                                   '<img src="https://example.com/preview.png"></a></div>' % (url,))
+        self.assertEqual(self.server.paths, ['/image'])
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, rendered_content)
+        [(update_event, users)] = [call[0] for call in send_event.call_args_list]
+        self.assertEqual(update_event, {'type': 'update_message', 'message_id': message_id,
+                                        'message_ids': [message_id], 'rendering_only': True,
+                                        'rendered_content': rendered_content})
+        self.assertEqual(sorted(user['id'] for user in users),
+                         sorted(UserMessage.objects.filter(message=message_id)
+                                               .values_list('user_profile_id', flat=True)))
+
+    def test_link_previews_after_edit(self):
+        url = 'https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5'
+        fetch_open_graph_image = bugdown.fetch_open_graph_image
+        with self.settings(INLINE_PREVIEWS_IN_BACKGROUND=True), \
+                mock.patch('zerver.lib.bugdown.fetch_open_graph_image',
+                           side_effect=lambda url: fetch_open_graph_image(self.url('/image'))):
+            message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM, url)
+            message = Message.objects.get(id=message_id)
+
+            # The message is edited before the worker saves the preview;
+            # the edit's rendering is kept.
+            Message.objects.filter(id=message_id).update(content=u"edited",
+                                                         rendered_content=u"<p>edited</p>")
+            with mock.patch('zerver.lib.actions.send_event') as send_event:
+                do_update_link_previews(message)
+        self.assertEqual(Message.objects.get(id=message_id).rendered_content, u"<p>edited</p>")
+        self.assertFalse(send_event.called)
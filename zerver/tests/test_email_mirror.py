@@ -10,11 +10,13 @@ from zerver.lib.test_helpers import (
 )
 
 from zerver.models import (
-    get_display_recipient, get_stream, get_user_profile_by_email,
-    Recipient,
+    get_client, get_display_recipient, get_realm, get_recipient, get_stream,
+    get_user_profile_by_email, Recipient,
 )
 
 from zerver.lib.actions import (
+    check_send_message,
+    create_stream_if_needed,
     encode_email_address,
 )
 from zerver.lib.email_mirror import (
@@ -22,9 +24,11 @@ from zerver.lib.email_mirror import (
     create_missed_message_address,
 )
 
-from zerver.lib.digest import handle_digest_email
+from zerver.lib.digest import gather_private_conversations, gather_realm_conversations, \
+    handle_digest_email, handle_digest_emails, RealmDigest
 
 from zerver.lib.notifications import (
+    build_message_list as real_build_message_list,
     handle_missedmessage_emails,
 )
 
@@ -209,6 +213,92 @@ class TestDigestEmailMessages(AuthedTestCase):
         self.assertEqual(mock_send_future_email.call_args[0][0][0]['email'],
                          u'othello@zulip.com')
 
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_realm_digest_emails(self, mock_send_future_email):
+        cutoff = time.time() - 1
+        emails = ["hamlet@zulip.com", "othello@zulip.com", "iago@zulip.com"]
+        for email in emails:
+            self.subscribe_to_stream(email, "digest")
+        stream = get_stream("digest", get_realm("zulip.com"))
+        recipient_id = get_recipient(Recipient.STREAM, stream.id).id
+
+        def send_stream_message(email, subject, client=u"website"):
+            check_send_message(get_user_profile_by_email(email), get_client(client), "stream",
+                               ["digest"], subject, u"digest content")
+        for email in emails:
+            send_stream_message(email, u"diverse")
+        for i in range(5):
+            send_stream_message("hamlet@zulip.com", u"long")
+        send_stream_message("othello@zulip.com", u"quiet")
+        # Automated messages aren't counted
+        for i in range(5):
+            send_stream_message("iago@zulip.com", u"bots", client=u"test suite")
+
+        cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
+        realm_digest = RealmDigest(get_realm("zulip.com"), cutoff_date)
+        self.assertEqual([key for (key, _) in realm_digest.hot_conversations([recipient_id])],
+                         [(recipient_id, u"diverse"), (recipient_id, u"long"), (recipient_id, u"quiet")])
+        self.assertEqual(realm_digest.hot_conversations([]), [])
+        teaser = realm_digest.teaser(get_user_profile_by_email("hamlet@zulip.com"),
+                                     realm_digest.hot_conversations([recipient_id])[1])
+        self.assertEqual(teaser["participants"], [u"King Hamlet"])
+        self.assertEqual(teaser["count"], 3)
+
+        # The realm's conversations are gathered once for all its users
+        user_profile_ids = [get_user_profile_by_email(email).id for email in emails]
+        with mock.patch('zerver.lib.digest.gather_realm_conversations',
+                        wraps=gather_realm_conversations) as gather:
+            handle_digest_emails(user_profile_ids, cutoff)
+        self.assertEqual(gather.call_count, 1)
+        self.assertEqual(sorted(call[0][0][0]['email'] for call in mock_send_future_email.call_args_list),
+                         sorted(emails))
+
+    def test_private_stream_digest(self):
+        cutoff = time.time() - 1
+        realm = get_realm("zulip.com")
+        stream, _ = create_stream_if_needed(realm, u"secret", invite_only=True)
+        recipient_id = get_recipient(Recipient.STREAM, stream.id).id
+        hamlet = get_user_profile_by_email("hamlet@zulip.com")
+        iago = get_user_profile_by_email("iago@zulip.com")
+        self.subscribe_to_stream(hamlet.email, u"secret")
+        check_send_message(hamlet, get_client(u"website"), "stream", [u"secret"],
+                           u"plans", u"secret content")
+        # Iago joins after the message was sent, so never received it
+        self.subscribe_to_stream(iago.email, u"secret")
+
+        cutoff_date = datetime.datetime.utcfromtimestamp(int(cutoff))
+        realm_digest = RealmDigest(realm, cutoff_date)
+        self.assertNotIn(recipient_id, realm_digest.public_recipient_ids)
+        private_conversations = gather_private_conversations([hamlet, iago], cutoff_date,
+                                                             realm_digest.public_recipient_ids)
+        self.assertEqual(private_conversations[hamlet.id], {(recipient_id, u"plans"): (1, [u"King Hamlet"])})
+        self.assertNotIn(iago.id, private_conversations)
+        self.assertEqual(realm_digest.hot_conversations([recipient_id]), [])
+
+        hot_conversations = realm_digest.hot_conversations([recipient_id], private_conversations[hamlet.id])
+        self.assertEqual(len(hot_conversations), 1)
+        teaser = realm_digest.teaser(hamlet, hot_conversations[0])
+        self.assertEqual(teaser["count"], 0)
+        self.assertEqual(realm_digest.teasers, {})
+
+    @mock.patch('zerver.lib.digest.send_future_email')
+    def test_digest_email_errors_are_per_user(self, mock_send_future_email):
+        cutoff = time.time() - 1
+        emails = ["hamlet@zulip.com", "othello@zulip.com"]
+        for email in emails:
+            self.subscribe_to_stream(email, "digest")
+        check_send_message(get_user_profile_by_email("hamlet@zulip.com"), get_client(u"website"),
+                           "stream", ["digest"], u"topic", u"digest content")
+
+        def build_message_list(user_profile, messages):
+            if user_profile.email == "hamlet@zulip.com":
+                raise Exception("Failed")
+            return real_build_message_list(user_profile, messages)
+        with mock.patch('zerver.lib.digest.build_message_list', side_effect=build_message_list):
+            handle_digest_emails([get_user_profile_by_email(email).id for email in emails], cutoff)
+        self.assertEqual([call[0][0][0]['email'] for call in mock_send_future_email.call_args_list],
+                         [u"othello@zulip.com"])
+
 class TestReplyExtraction(AuthedTestCase):
     def test_reply_is_extracted_from_plain(self):
 
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
-from typing import Any, Callable, Optional
+from typing import Any, Callable, List, Optional
 
 from django.http import HttpRequest, HttpResponse
 from django.test import TestCase
@@ -49,7 +49,16 @@ from zerver.lib.actions import (
     get_subscription
 )
 
-from zerver.lib.event_queue import allocate_client_descriptor
+from zerver.lib import event_queue
+from zerver.lib.event_queue import allocate_client_descriptor, \
+    get_client_descriptors_for_realm_stream, ClientDescriptor, \
+    get_shard_for_queue_id, get_user_profile_id_for_queue_id, split_users_by_shard, \
+    read_event_queue_journal, \
+    do_gc_event_queues, get_client_descriptor, fetch_events, \
+    cache_encoded_message, encode_events
+from zerver.lib import event_queue_journal
+from zerver.lib.event_queue_journal import EventQueueJournal, read_journal
+from zerver.lib.socket import SocketAuthError, SocketConnection
 from zerver.lib.test_helpers import AuthedTestCase, POSTRequestMock
 from zerver.lib.validator import (
     check_bool, check_dict, check_int, check_list, check_string,
@@ -61,9 +70,15 @@ from zerver.views import _default_all_public_streams, _default_narrow
 from zerver.tornadoviews import get_events_backend
 
 from collections import OrderedDict
+import mock
+import os
+import shutil
+import tempfile
 import time
 import ujson
 from six.moves import range
+from six import text_type
+import six
 
 
 class GetEventsTest(AuthedTestCase):
@@ -983,6 +998,282 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_flag_duplicate_collapsing(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        for messages in [[1, 2], [2, 3], [1, 3]]:
+            queue.push({"type": "update_message_flags",
+                        "flag": "read",
+                        "operation": "add",
+                        "all": False,
+                        "messages": messages,
+                        "timestamp": "1"})
+        self.assertEqual(queue.contents()[0]["messages"], [1, 2, 3])
+
+    def test_presence_collapsing(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "presence",
+                    "email": "hamlet@zulip.com",
+                    "server_timestamp": 1,
+                    "presence": {"website": {"status": "active", "timestamp": 1}}})
+        queue.push({"type": "presence",
+                    "email": "othello@zulip.com",
+                    "server_timestamp": 2,
+                    "presence": {"website": {"status": "active", "timestamp": 2}}})
+        queue.push({"type": "presence",
+                    "email": "hamlet@zulip.com",
+                    "server_timestamp": 3,
+                    "presence": {"ZulipAndroid": {"status": "idle", "timestamp": 3}}})
+        self.assertEqual(queue.contents(),
+                         [{"id": 1,
+                           "type": "presence",
+                           "email": "othello@zulip.com",
+                           "server_timestamp": 2,
+                           "presence": {"website": {"status": "active", "timestamp": 2}}},
+                          {"id": 2,
+                           "type": "presence",
+                           "email": "hamlet@zulip.com",
+                           "server_timestamp": 3,
+                           "presence": {"website": {"status": "active", "timestamp": 1},
+                                        "ZulipAndroid": {"status": "idle", "timestamp": 3}}}])
+
+    def test_queued_bytes(self):
+        # type: () -> None
+        queue = EventQueue("1")
+        queue.push({"type": "unknown"}, 100)
+        queue.push({"type": "unknown"})
+        queue.push({"type": "pointer", "pointer": 1, "timestamp": "1"})
+        self.assertEqual(queue.queued_bytes, 100 + len(ujson.dumps({"type": "unknown"})))
+        queue.prune(0)
+        self.assertEqual(queue.queued_bytes, len(ujson.dumps({"type": "unknown"})))
+        queue.prune(2)
+        self.assertEqual(queue.queued_bytes, 0)
+
+    def test_encode_events(self):
+        # type: () -> None
+        message = dict(id=1, content="hello", type="stream")
+        cache_encoded_message(message, True, ujson.dumps(message))
+        events = [dict(type="message", message=message, flags=[], id=0),
+                  dict(type="message", message=dict(message, content="copy"), flags=["read"], id=1),
+                  dict(type="pointer", pointer=1, id=2)]
+        self.assertEqual(ujson.loads(encode_events(events, True)), events)
+        self.assertEqual(ujson.loads(encode_events(events, False)), events)
+        self.assertEqual(encode_events([], True), "[]")
+
+    def test_queue_overflow(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        client = allocate_client_descriptor(
+            dict(user_profile_id = user_profile.id,
+                 user_profile_email = user_profile.email,
+                 realm_id = user_profile.realm.id,
+                 event_types = None,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = False,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = []))
+        queue_id = client.event_queue.id
+        with mock.patch('zerver.lib.event_queue.MAX_QUEUE_EVENTS', 2):
+            client.add_event({"type": "unknown"})
+            client.add_event({"type": "unknown"})
+            self.assertEqual(get_client_descriptor(queue_id), client)
+            client.add_event({"type": "unknown"})
+        self.assertIsNone(get_client_descriptor(queue_id))
+
+        result = fetch_events(dict(queue_id=queue_id,
+                                   dont_block=True,
+                                   last_event_id=0,
+                                   user_profile_id=user_profile.id,
+                                   user_profile_email=user_profile.email,
+                                   client_type_name="website",
+                                   handler_id=1))
+        self.assertEqual(result["type"], "error")
+        self.assertIn("Bad event queue id: %s (too many queued events)" % (queue_id,),
+                      result["message"])
+
+class RealmStreamClientsTest(TestCase):
+    def allocate(self, user_profile, all_public_streams, narrow, event_types=None):
+        # type: (UserProfile, bool, List[List[text_type]], Optional[List[str]]) -> ClientDescriptor
+        return allocate_client_descriptor(
+            dict(user_profile_id = user_profile.id,
+                 user_profile_email = user_profile.email,
+                 realm_id = user_profile.realm.id,
+                 event_types = event_types,
+                 client_type_name = "website",
+                 apply_markdown = True,
+                 all_public_streams = all_public_streams,
+                 queue_timeout = 600,
+                 last_connection_time = time.time(),
+                 narrow = narrow)
+            )
+
+    def test_stream_interest_index(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        realm_id = user_profile.realm.id
+        all_streams = self.allocate(user_profile, True, [])
+        denmark = self.allocate(user_profile, False, [["stream", "Denmark"]])
+        scotland = self.allocate(user_profile, False, [["stream", "scotland"], ["topic", "lunch"]])
+        private = self.allocate(user_profile, False, [["is", "private"]])
+        pointer_only = self.allocate(user_profile, True, [], event_types=["pointer"])
+
+        clients = get_client_descriptors_for_realm_stream(realm_id, "denmark")
+        self.assertIn(all_streams, clients)
+        self.assertIn(denmark, clients)
+        self.assertNotIn(scotland, clients)
+        self.assertNotIn(private, clients)
+        self.assertNotIn(pointer_only, clients)
+
+        clients = get_client_descriptors_for_realm_stream(realm_id, "Scotland")
+        self.assertIn(all_streams, clients)
+        self.assertIn(scotland, clients)
+        self.assertNotIn(denmark, clients)
+
+        denmark.cleanup()
+        clients = get_client_descriptors_for_realm_stream(realm_id, "Denmark")
+        self.assertIn(all_streams, clients)
+        self.assertNotIn(denmark, clients)
+
+class TornadoShardingTest(TestCase):
+    def test_split_users_by_shard(self):
+        # type: () -> None
+        with self.settings(TORNADO_PROCESSES=2):
+            self.assertEqual(split_users_by_shard(dict(type='pointer'), [1, 2, 3]),
+                             {0: [2], 1: [1, 3]})
+
+            users = [dict(id=4, flags=[]), dict(id=6, flags=['mentioned'])]
+            self.assertEqual(split_users_by_shard(dict(type='message', stream_name='Denmark'), users),
+                             {0: users, 1: []})
+            self.assertEqual(split_users_by_shard(dict(type='message', stream_name='Denmark',
+                                                       invite_only=True), users),
+                             {0: users})
+            self.assertEqual(split_users_by_shard(dict(type='message'), users),
+                             {0: users})
+
+    def test_shard_for_queue_id(self):
+        # type: () -> None
+        self.assertEqual(get_shard_for_queue_id("1466545829:12"), 0)
+        with self.settings(TORNADO_PROCESSES=4):
+            self.assertEqual(get_shard_for_queue_id("3:1466545829:12"), 3)
+            self.assertEqual(get_shard_for_queue_id("3:17:1466545829:12"), 3)
+            # Ids naming shards that don't exist, or not naming them
+            # at all, are rejected
+            for queue_id in ["4:17:1466545829:12", "-1:17:1466545829:12", "a:b:c"]:
+                with self.assertRaises(ValueError):
+                    get_shard_for_queue_id(queue_id)
+        with self.assertRaises(ValueError):
+            get_shard_for_queue_id("3:17:1466545829:12")
+
+    def test_user_profile_id_for_queue_id(self):
+        # type: () -> None
+        self.assertIsNone(get_user_profile_id_for_queue_id("1466545829:12"))
+        self.assertIsNone(get_user_profile_id_for_queue_id("3:1466545829:12"))
+        self.assertEqual(get_user_profile_id_for_queue_id("3:17:1466545829:12"), 17)
+        with self.assertRaises(ValueError):
+            get_user_profile_id_for_queue_id("3:b:1466545829:12")
+
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        with self.settings(TORNADO_PROCESSES=2):
+            client = allocate_client_descriptor(
+                dict(user_profile_id = user_profile.id,
+                     user_profile_email = user_profile.email,
+                     realm_id = user_profile.realm.id,
+                     event_types = None,
+                     client_type_name = "website",
+                     apply_markdown = True,
+                     all_public_streams = False,
+                     queue_timeout = 600,
+                     last_connection_time = time.time(),
+                     narrow = []))
+        try:
+            queue_id = client.event_queue.id
+            self.assertEqual(get_shard_for_queue_id(queue_id), event_queue.current_tornado_shard)
+            self.assertEqual(get_user_profile_id_for_queue_id(queue_id), user_profile.id)
+        finally:
+            client.cleanup()
+
+    def test_socket_auth_bad_queue_id(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        connection = mock.MagicMock(authenticated=False, csrf_token="token")
+        authenticate_client = six.get_unbound_function(SocketConnection.authenticate_client)
+        # Malformed, and naming a shard that doesn't exist
+        for queue_id in ["a:b:c", "5:%d:1466545829:12" % (user_profile.id,)]:
+            msg = dict(req_id=1, request=dict(csrf_token="token", queue_id=queue_id))
+            with self.settings(TORNADO_PROCESSES=1), \
+                    mock.patch('zerver.lib.socket.get_user_profile', return_value=user_profile):
+                with self.assertRaises(SocketAuthError) as cm:
+                    authenticate_client(connection, msg)
+            self.assertEqual(cm.exception.msg, "Bad event queue id: %s" % (queue_id,))
+        self.assertFalse(connection.authenticated)
+
+class EventQueueJournalTest(TestCase):
+    def test_journal_replay(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email("hamlet@zulip.com")
+        journal_dir = tempfile.mkdtemp()
+        filename = os.path.join(journal_dir, "event_queues.journal")
+        event_queue.journal = EventQueueJournal(filename)
+        event_queue.journal.open()
+        try:
+            client = allocate_client_descriptor(
+                dict(user_profile_id = user_profile.id,
+                     user_profile_email = user_profile.email,
+                     realm_id = user_profile.realm.id,
+                     event_types = None,
+                     client_type_name = "website",
+                     apply_markdown = True,
+                     all_public_streams = False,
+                     queue_timeout = 600,
+                     last_connection_time = time.time(),
+                     narrow = []))
+            gc_client = allocate_client_descriptor(
+                dict(user_profile_id = user_profile.id,
+                     user_profile_email = user_profile.email,
+                     realm_id = user_profile.realm.id,
+                     event_types = None,
+                     client_type_name = "website",
+                     apply_markdown = True,
+                     all_public_streams = False,
+                     queue_timeout = 600,
+                     last_connection_time = time.time(),
+                     narrow = []))
+            queue = client.event_queue
+            queue.push({"type": "unknown", "timestamp": "1"})
+            queue.push({"type": "pointer", "pointer": 1, "timestamp": "1"})
+            queue.push({"type": "unknown", "timestamp": "2"})
+            queue.contents()
+            queue.push({"type": "pointer", "pointer": 2, "timestamp": "2"})
+            queue.prune(0)
+            # A message's dict is journaled once for all its queues
+            message = {"id": 10, "content": "journaled once"}
+            queue.push({"type": "message", "message": message, "flags": ["read"]}, 100)
+            gc_client.event_queue.push({"type": "message", "message": message, "flags": []}, 100)
+            # Events that can't be journaled still use up an id
+            queue.push({"type": "unknown", "timestamp": object()}, 10)
+            queue.prune(queue.next_event_id - 1)
+            queue.push({"type": "unknown", "timestamp": "3"})
+            do_gc_event_queues({gc_client.event_queue.id}, set(), set())
+            event_queue.journal.close()
+
+            record_types = [record[0] for record in read_journal(filename)]
+            self.assertEqual(record_types.count(event_queue_journal.MESSAGE), 1)
+            self.assertEqual(record_types.count(event_queue_journal.MESSAGE_EVENT), 2)
+            self.assertEqual(record_types.count(event_queue_journal.SKIPPED), 1)
+
+            (restored, clean) = read_event_queue_journal(filename)
+            self.assertTrue(clean)
+            self.assertEqual(list(restored.keys()), [queue.id])
+            restored_queue = restored[queue.id].event_queue
+            self.assertEqual(restored_queue.next_event_id, queue.next_event_id)
+            self.assertEqual(restored_queue.contents(), queue.contents())
+        finally:
+            event_queue.journal = None
+            shutil.rmtree(journal_dir)
+
 class TestEventsRegisterAllPublicStreamsDefaults(TestCase):
     def setUp(self):
         # type: () -> None
@@ -7,10 +7,14 @@ from django.test import TestCase
 
 from zerver.forms import not_mit_mailing_list
 
+from zerver.lib import rate_limiter
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    block_user,
     clear_user_history,
+    rate_limit_request,
     remove_ratelimit_rule,
+    unblock_user,
 )
 
 from zerver.lib.actions import compute_mit_user_fullname
@@ -127,6 +131,50 @@ class RateLimitTests(AuthedTestCase):
 
         self.assert_json_success(result)
 
+    def check_rate_limit_request(self):
+        # type: () -> None
+        user = get_user_profile_by_email("othello@zulip.com")
+        clear_user_history(user)
+        for i in range(5):
+            (ratelimited, secs_to_freedom, calls_left) = rate_limit_request(user)
+            self.assertFalse(ratelimited)
+            self.assertEqual(calls_left, 100 - i - 1)
+        (ratelimited, secs_to_freedom, calls_left) = rate_limit_request(user)
+        self.assertTrue(ratelimited)
+        self.assertTrue(0 < secs_to_freedom <= 1)
+
+        clear_user_history(user)
+        block_user(user, 30)
+        (ratelimited, secs_to_freedom, calls_left) = rate_limit_request(user)
+        self.assertTrue(ratelimited)
+        self.assertEqual(secs_to_freedom, 30)
+        unblock_user(user)
+        self.assertFalse(rate_limit_request(user)[0])
+
+    def test_rate_limit_request(self):
+        # type: () -> None
+        self.check_rate_limit_request()
+
+    def test_rate_limit_request_gcra(self):
+        # type: () -> None
+        with self.settings(RATE_LIMITING_ALGORITHM='gcra'):
+            self.check_rate_limit_request()
+
+    def test_leased_calls(self):
+        # type: () -> None
+        user = get_user_profile_by_email("othello@zulip.com")
+        user.rate_limits = "60:25"
+        clear_user_history(user)
+        with self.settings(RATE_LIMITING_LEASE_SIZE=10), \
+                mock.patch('zerver.lib.rate_limiter._run_ratelimit_script',
+                           wraps=rate_limiter._run_ratelimit_script) as script:
+            calls_left = [rate_limit_request(user)[2] for i in range(25)]
+            self.assertEqual(calls_left, list(range(24, -1, -1)))
+            # Leases of 10, 10 and the last 5 calls
+            self.assertEqual(script.call_count, 3)
+            self.assertTrue(rate_limit_request(user)[0])
+        clear_user_history(user)
+
 class APNSTokenTests(AuthedTestCase):
     def test_add_token(self):
         # type: () -> None
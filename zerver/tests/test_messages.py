@@ -14,20 +14,25 @@ from zerver.lib.test_helpers import (
     message_ids, message_stream_count,
     most_recent_message,
     queries_captured,
+    tornado_redirected_to_list,
 )
 
 from zerver.models import (
     MAX_MESSAGE_LENGTH, MAX_SUBJECT_LENGTH,
     Client, Message, Realm, Recipient, Stream, UserMessage, UserProfile, Attachment,
-    get_realm, get_stream, get_user_profile_by_email,
+    get_realm, get_stream, get_user_profile_by_email, parse_usermessage_flags,
+    extract_message_dict, flush_per_request_caches, stringify_message_dict,
 )
 
 from zerver.lib.actions import (
     check_message, check_send_message,
     create_stream_if_needed,
-    do_add_subscription, do_create_user,
+    do_add_subscription, do_create_user, do_send_messages,
+    internal_prep_message, do_change_full_name,
 )
 
+from zerver.lib.cache import cache_delete_many, get_remote_cache_requests, \
+    message_user_cache_key
 from zerver.lib.upload import create_attachment
 
 import datetime
@@ -35,6 +40,7 @@ import DNS
 import mock
 import time
 import ujson
+import zlib
 from six.moves import range
 
 class TestCrossRealmPMs(AuthedTestCase):
@@ -319,6 +325,33 @@ class StreamMessagesTest(AuthedTestCase):
 
         self.assert_length(queries, 7)
 
+    def test_batched_send_queries(self):
+        sender = get_user_profile_by_email('hamlet@zulip.com')
+        for stream_name in ['Denmark', 'Scotland']:
+            self.subscribe_to_stream(sender.email, stream_name)
+
+        def prep_messages(count):
+            return [internal_prep_message(sender.email, "stream", stream_name,
+                                          "batch", "batch message %d" % (i,))
+                    for i in range(count)
+                    for stream_name in ['Denmark', 'Scotland']]
+
+        do_send_messages(prep_messages(1)) # prime the caches
+        with queries_captured() as small_batch_queries:
+            do_send_messages(prep_messages(1))
+
+        events = []
+        with tornado_redirected_to_list(events):
+            with queries_captured() as large_batch_queries:
+                message_ids = do_send_messages(prep_messages(10))
+
+        # The number of queries shouldn't grow with the size of the batch.
+        self.assert_length(large_batch_queries, len(small_batch_queries))
+        self.assertEqual([event['event']['message'] for event in events], message_ids)
+        for event in events:
+            self.assertEqual(event['event']['message_dict_markdown']['id'],
+                             event['event']['message'])
+
     def test_message_mentions(self):
         user_profile = get_user_profile_by_email("iago@zulip.com")
         self.subscribe_to_stream(user_profile.email, "Denmark")
@@ -951,6 +984,82 @@ class StarTests(AuthedTestCase):
         self.assertEqual(sent_message.message.content, content)
         self.assertFalse(sent_message.flags.starred)
 
+class UserMessageFlagsTest(TestCase):
+    def test_parse_usermessage_flags(self):
+        self.assertEqual(parse_usermessage_flags(0), [])
+        self.assertEqual(parse_usermessage_flags(UserMessage.flags.read.mask), ['read'])
+        flags = (UserMessage.flags.is_me_message.mask | UserMessage.flags.starred.mask |
+                 UserMessage.flags.historical.mask)
+        self.assertEqual(parse_usermessage_flags(flags), ['starred', 'historical', 'is_me_message'])
+        all_flags = (1 << len(UserMessage.ALL_FLAGS)) - 1
+        self.assertEqual(parse_usermessage_flags(all_flags), UserMessage.ALL_FLAGS)
+
+class MessageDictCacheTest(AuthedTestCase):
+    def test_compact_encoding(self):
+        # type: () -> None
+        stream_message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM)
+        private_message_id = self.send_message("hamlet@zulip.com", "othello@zulip.com", Recipient.PERSONAL)
+        for message_id in (stream_message_id, private_message_id):
+            message_dict = Message.objects.get(id=message_id).to_dict_uncached_helper(True)
+            encoded = stringify_message_dict(message_dict)
+            self.assertLess(len(encoded), len(zlib.compress(ujson.dumps(message_dict).encode("utf-8"))))
+            self.assertEqual(extract_message_dict(encoded), message_dict)
+
+        # Dicts cached before the compact encoding can still be read
+        self.assertEqual(extract_message_dict(zlib.compress(ujson.dumps(message_dict).encode("utf-8"))),
+                         message_dict)
+
+        # The sender and recipients are filled in as they are now
+        do_change_full_name(get_user_profile_by_email("othello@zulip.com"), "Othello, the Moor")
+        flush_per_request_caches()
+        message_dict = extract_message_dict(encoded)
+        self.assertEqual(message_dict['sender_full_name'], "King Hamlet")
+        self.assertEqual([recip['full_name'] for recip in message_dict['display_recipient']],
+                         ["King Hamlet", "Othello, the Moor"])
+
+    def test_bulk_message_user_fetch(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        senders = ["othello@zulip.com", "cordelia@zulip.com", "iago@zulip.com", "prospero@zulip.com"]
+        one_sender_ids = [self.send_message(senders[0], "hamlet@zulip.com", Recipient.PERSONAL)
+                          for sender in senders]
+        many_sender_ids = [self.send_message(sender, "hamlet@zulip.com", Recipient.PERSONAL)
+                           for sender in senders]
+        user_ids = [get_user_profile_by_email(email).id for email in senders + ["hamlet@zulip.com"]]
+
+        def fetch_page(anchor):
+            # With the message dicts cached, but not their users
+            self.get_old_messages(anchor, 0, len(senders) - 1)
+            cache_delete_many([message_user_cache_key(user_id) for user_id in user_ids])
+            flush_per_request_caches()
+            remote_requests = get_remote_cache_requests()
+            with queries_captured() as queries:
+                messages = self.get_old_messages(anchor, 0, len(senders) - 1)
+            self.assertEqual(len(messages), len(senders))
+            return (get_remote_cache_requests() - remote_requests, len(queries))
+
+        # A page from many senders costs no more than one from a
+        # single sender
+        self.assertEqual(fetch_page(many_sender_ids[0]), fetch_page(one_sender_ids[0]))
+
+    def test_early_refresh(self):
+        # type: () -> None
+        self.login("hamlet@zulip.com")
+        # Sending the message caches its dicts, with their expiry
+        message_id = self.send_message("othello@zulip.com", "hamlet@zulip.com", Recipient.PERSONAL)
+
+        def refreshed_ids():
+            with mock.patch.object(Message, 'get_raw_db_rows', wraps=Message.get_raw_db_rows) as m:
+                self.get_old_messages(message_id, 0, 0)
+            return [call[0][0] for call in m.call_args_list if call[0][0]]
+
+        # Cached for a day, the dict isn't refreshed right away...
+        self.assertEqual(refreshed_ids(), [])
+        # ...but is once it's near enough expiry, for how long it took
+        # to fetch (here, as if it took ages).
+        with mock.patch('zerver.lib.cache.EARLY_REFRESH_BETA', 10.0 ** 12):
+            self.assertEqual(refreshed_ids(), [[message_id]])
+
 class AttachmentTest(AuthedTestCase):
     def test_basics(self):
         self.assertFalse(Message.content_has_attachment('whatever'))
@@ -22,10 +22,13 @@ from zerver.lib.test_helpers import (
 from zerver.views.messages import (
     exclude_muting_conditions,
     get_old_messages_backend, ok_to_include_history,
+    narrow_needs_message_table, plan_narrow, search_page_is_complete,
+    search_results_are_cacheable,
     NarrowBuilder, BadNarrowOperator
 )
 
 from six.moves import range
+import mock
 import os
 import re
 import ujson
@@ -238,6 +241,39 @@ class NarrowBuilderTest(AuthedTestCase):
     def _build_query(self, term):
         return self.builder.add_term(self.raw_query, term)
 
+class PlanNarrowTest(TestCase):
+    def test_plan_narrow(self):
+        narrow = [dict(operator='search', operand='jumping'),
+                  dict(operator='near', operand='12'),
+                  dict(operator='is', operand='alerted'),
+                  dict(operator='topic', operand='golf', negated=True),
+                  dict(operator='topic', operand='lunch'),
+                  dict(operator='in', operand='all'),
+                  dict(operator='is', operand='mentioned'),
+                  dict(operator='stream', operand='Scotland')]
+        terms = [(term['operator'], term['operand'], term.get('negated', False))
+                 for term in plan_narrow(narrow)]
+        self.assertEqual(terms, [('stream', 'Scotland', False),
+                                 ('topic', 'lunch', False),
+                                 ('topic', 'golf', True),
+                                 ('is', 'mentioned', False),
+                                 ('search', 'jumping', False)])
+
+    def test_narrow_needs_message_table(self):
+        def needs_message_table(narrow):
+            return narrow_needs_message_table(plan_narrow(narrow))
+
+        self.assertFalse(needs_message_table([]))
+        self.assertFalse(needs_message_table([dict(operator='is', operand='starred'),
+                                              dict(operator='in', operand='all')]))
+        self.assertFalse(needs_message_table([dict(operator='is', operand='alerted', negated=True),
+                                              dict(operator='near', operand='12'),
+                                              dict(operator='id', operand='12')]))
+        self.assertTrue(needs_message_table([dict(operator='is', operand='private')]))
+        self.assertTrue(needs_message_table([dict(operator='is', operand='starred'),
+                                             dict(operator='stream', operand='Scotland')]))
+        self.assertTrue(needs_message_table([dict(operator='in', operand='home')]))
+
 class BuildNarrowFilterTest(TestCase):
     def test_build_narrow_filter(self):
         fixtures_path = os.path.join(os.path.dirname(__file__),
@@ -405,6 +441,27 @@ class GetOldMessagesTest(AuthedTestCase):
             self.assertEqual(message["type"], "stream")
             self.assertEqual(message["recipient_id"], stream_id)
 
+    def test_get_old_messages_with_history(self):
+        """
+        Messages from before the user subscribed to a public stream are
+        returned as read and historical; the user's own messages come
+        with their actual flags.
+        """
+        self.subscribe_to_stream("othello@zulip.com", "history")
+        historical_id = self.send_message("othello@zulip.com", "history", Recipient.STREAM)
+        self.subscribe_to_stream("hamlet@zulip.com", "history")
+        received_id = self.send_message("othello@zulip.com", "history", Recipient.STREAM)
+
+        self.login("hamlet@zulip.com")
+        narrow = [dict(operator='stream', operand='history')]
+        result = self.post_with_params(dict(narrow=ujson.dumps(narrow),
+                                            anchor=historical_id,
+                                            num_before=0,
+                                            num_after=10))
+        flags = dict((message['id'], message['flags']) for message in result['messages'])
+        self.assertEqual(flags[historical_id], ["read", "historical"])
+        self.assertEqual(flags[received_id], [])
+
     def test_get_old_messages_with_narrow_stream_mit_unicode_regex(self):
         """
         A request for old messages for a user in the mit.edu relam with unicode
@@ -553,6 +610,67 @@ class GetOldMessagesTest(AuthedTestCase):
             '<p>I am hungry!</p>')
 
 
+    def test_get_old_messages_search_cache(self):
+        self.login("cordelia@zulip.com")
+        message_id = self.send_message("cordelia@zulip.com", "Verona", Recipient.STREAM,
+                                       content="lunch is ready", subject="food")
+        with connection.cursor() as cursor:
+            cursor.execute("""
+                UPDATE zerver_message SET
+                search_tsvector = to_tsvector('zulip.english_us_search',
+                subject || rendered_content)
+                """)
+
+        def search(operand):
+            narrow = [dict(operator='search', operand=operand)]
+            with queries_captured() as queries:
+                result = self.post_with_params(dict(narrow=ujson.dumps(narrow),
+                                                    anchor=message_id,
+                                                    num_before=10,
+                                                    num_after=0))
+            searched = any("/* get_old_messages */" in query['sql'] for query in queries)
+            return (result['messages'], searched)
+
+        (messages, searched) = search('lunch')
+        self.assertTrue(searched)
+        self.assertEqual(messages[-1]['id'], message_id)
+        self.assertEqual(messages[-1]['match_content'],
+                         '<p><span class="highlight">lunch</span> is ready</p>')
+
+        # The page ends at an existing message, so it was cached; the
+        # search is normalized for the cache key.
+        (cached_messages, searched) = search(' Lunch ')
+        self.assertFalse(searched)
+        self.assertEqual(cached_messages, messages)
+
+        # Editing a message invalidates the cached results
+        result = self.client.post("/json/update_message", {
+            'message_id': message_id,
+            'content': 'lunch is over'
+        })
+        self.assert_json_success(result)
+        (messages, searched) = search('lunch')
+        self.assertTrue(searched)
+        self.assertEqual(messages[-1]['match_content'],
+                         '<p><span class="highlight">lunch</span> is over</p>')
+
+    def test_search_results_are_cacheable(self):
+        self.assertTrue(search_results_are_cacheable([dict(operator='search', operand='lunch'),
+                                                      dict(operator='is', operand='private')]))
+        # Starring, mentions and muting don't invalidate cached results
+        for (operator, operand) in [('is', 'starred'), ('is', 'mentioned'), ('is', 'alerted'),
+                                    ('in', 'home')]:
+            self.assertFalse(search_results_are_cacheable([dict(operator='search', operand='lunch'),
+                                                           dict(operator=operator, operand=operand)]))
+
+    def test_search_page_is_complete(self):
+        # Without an after query, the anchor must be a returned message
+        self.assertTrue(search_page_is_complete([3, 5, 8], 8, 0))
+        self.assertFalse(search_page_is_complete([3, 5, 8], 10, 0))
+        # Otherwise, the after query must have been filled
+        self.assertTrue(search_page_is_complete([3, 5, 8, 9], 5, 3))
+        self.assertFalse(search_page_is_complete([3, 5, 8], 5, 3))
+
     def test_get_old_messages_with_only_searching_anchor(self):
         """
         Test that specifying an anchor but 0 for num_before and num_after
@@ -733,7 +851,9 @@ class GetOldMessagesTest(AuthedTestCase):
         with queries_captured() as queries:
             get_old_messages_backend(request, user_profile)
 
-        queries = [q for q in queries if q['sql'].startswith("SELECT message_id, flags")]
+        # The first unread message is looked up within the main query
+        self.assertEqual(len([q for q in queries if "zerver_usermessage" in q['sql']]), 1)
+        queries = [q for q in queries if "/* get_old_messages */" in q['sql']]
 
         ids = {}
         for stream_name in ['Scotland']:
@@ -744,6 +864,22 @@ class GetOldMessagesTest(AuthedTestCase):
         cond = cond.format(**ids)
         self.assertTrue(cond in queries[0]['sql'])
 
+    def test_slow_narrow_explain(self):
+        self.login("hamlet@zulip.com")
+        narrow = [dict(operator='stream', operand='Scotland')]
+        with self.settings(SLOW_NARROW_EXPLAIN_SECS=0), \
+                mock.patch('zerver.views.messages.queue_json_publish') as mock_publish:
+            result = self.client.get("/json/messages",
+                                     dict(anchor=0, num_before=0, num_after=10,
+                                          narrow=ujson.dumps(narrow)))
+        self.assert_json_success(result)
+        self.assertEqual(mock_publish.call_count, 1)
+        (queue_name, report, _) = mock_publish.call_args[0]
+        self.assertEqual(queue_name, "slow_queries")
+        self.assertTrue(report.startswith("get_old_messages [stream] took "))
+        self.assertIn("(hamlet@zulip.com)\n", report)
+        self.assertIn("actual time=", report)
+
     def test_exclude_muting_conditions(self):
         realm = get_realm('zulip.com')
         create_stream_if_needed(realm, 'devel')
@@ -814,7 +950,7 @@ class GetOldMessagesTest(AuthedTestCase):
                                                   'narrow': '[["pm-with", "othello@zulip.com"]]'},
                                                  sql)
 
-        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT message_id, flags \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (flags & 2) != 0 AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT message_id, flags \nFROM zerver_usermessage \nWHERE user_profile_id = {hamlet_id} AND (flags & 2) != 0 AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["is", "starred"]]'},
@@ -826,7 +962,7 @@ class GetOldMessagesTest(AuthedTestCase):
                                                   'narrow': '[["sender", "othello@zulip.com"]]'},
                                                 sql)
 
-        sql_template = 'SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"]]'},
@@ -838,7 +974,7 @@ class GetOldMessagesTest(AuthedTestCase):
                                                   'narrow': '[["topic", "blah"]]'},
                                                  sql)
 
-        sql_template = "SELECT anon_1.message_id \nFROM (SELECT id AS message_id \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND upper(subject) = upper('blah') AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"], ["topic", "blah"]]'},
@@ -860,19 +996,19 @@ class GetOldMessagesTest(AuthedTestCase):
     def test_get_old_messages_with_search_queries(self):
         query_ids = self.get_query_ids()
 
-        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["search", "jumping"]]'},
                                                  sql)
 
-        sql_template = "SELECT anon_1.message_id, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT id AS message_id, subject, rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM zerver_message \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
+        sql_template = "SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, ts_match_locs_array('zulip.english_us_search', rendered_content, plainto_tsquery('zulip.english_us_search', 'jumping')) AS content_matches, ts_match_locs_array('zulip.english_us_search', escape_html(subject), plainto_tsquery('zulip.english_us_search', 'jumping')) AS subject_matches \nFROM (SELECT zerver_message.id AS message_id, zerver_usermessage.flags AS flags, subject, rendered_content \nFROM zerver_message LEFT OUTER JOIN zerver_usermessage ON zerver_usermessage.message_id = zerver_message.id AND zerver_usermessage.user_profile_id = {hamlet_id} \nWHERE recipient_id = {scotland_recipient} AND (search_tsvector @@ plainto_tsquery('zulip.english_us_search', 'jumping')) AND zerver_message.id >= 0 ORDER BY zerver_message.id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC"
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["stream", "Scotland"], ["search", "jumping"]]'},
                                                  sql)
 
-        sql_template = 'SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, anon_1.content_matches, anon_1.subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content, ts_match_locs_array(\'zulip.english_us_search\', rendered_content, plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS content_matches, ts_match_locs_array(\'zulip.english_us_search\', escape_html(subject), plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS subject_matches \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
+        sql_template = 'SELECT anon_1.message_id, anon_1.flags, anon_1.subject, anon_1.rendered_content, ts_match_locs_array(\'zulip.english_us_search\', rendered_content, plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS content_matches, ts_match_locs_array(\'zulip.english_us_search\', escape_html(subject), plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AS subject_matches \nFROM (SELECT message_id, flags, subject, rendered_content \nFROM zerver_usermessage JOIN zerver_message ON zerver_usermessage.message_id = zerver_message.id \nWHERE user_profile_id = {hamlet_id} AND (content ILIKE \'%jumping%\' OR subject ILIKE \'%jumping%\') AND (search_tsvector @@ plainto_tsquery(\'zulip.english_us_search\', \'"jumping" quickly\')) AND message_id >= 0 ORDER BY message_id ASC \n LIMIT 10) AS anon_1 ORDER BY message_id ASC'
         sql = sql_template.format(**query_ids)
         self.common_check_get_old_messages_query({'anchor': 0, 'num_before': 0, 'num_after': 10,
                                                   'narrow': '[["search", "\\"jumping\\" quickly"]]'},
@@ -2,7 +2,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from typing import Any, Callable, Dict, Iterable, List, Tuple, TypeVar
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Tuple, TypeVar
 from mock import patch, MagicMock
 
 from django.http import HttpResponse
@@ -16,26 +16,32 @@ from zerver.lib.test_helpers import (
 from zerver.lib.test_runner import slow
 
 from zerver.models import UserProfile, Recipient, \
-    Realm, Client, UserActivity, \
-    get_user_profile_by_email, split_email_to_domain, get_realm, \
+    Realm, Client, UserActivity, UserActivityInterval, \
+    get_user_profile_by_email, get_user_profile_by_id, split_email_to_domain, get_realm, \
     get_client, get_stream, Message, get_unique_open_realm, \
-    completely_open
+    completely_open, to_dict_cache_key_id, extract_message_dict
 
+from zerver.lib import cache, cache_helpers, queue
 from zerver.lib.avatar import get_avatar_url
 from zerver.lib.initial_password import initial_password
+from zerver.lib.create_user import create_user
 from zerver.lib.email_mirror import create_missed_message_address
 from zerver.lib.actions import \
     get_emails_from_user_ids, do_deactivate_user, do_reactivate_user, \
     do_change_is_admin, extract_recipients, \
     do_set_realm_name, do_deactivate_realm, \
-    do_add_subscription, do_remove_subscription, do_make_stream_private
+    do_add_subscription, do_remove_subscription, do_make_stream_private, \
+    do_change_full_name, get_status_dict
 from zerver.lib.alert_words import alert_words_in_realm, user_alert_words, \
-    add_user_alert_words, remove_user_alert_words
+    add_user_alert_words, remove_user_alert_words, alert_word_matcher, AlertWordMatcher
 from zerver.lib.notifications import handle_missedmessage_emails
+from zerver.lib.redis_utils import get_redis_client
 from zerver.lib.session_user import get_session_dict_user
+from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.middleware import is_slow_query
 
 from zerver.worker import queue_processors
+from zerver.worker.supervisor import QueueSupervisor
 
 from django.conf import settings
 from django.core import mail
@@ -44,7 +50,10 @@ from six.moves import range
 import datetime
 import os
 import re
+import signal
 import sys
+import tempfile
+import threading
 import time
 import ujson
 import random
@@ -166,6 +175,193 @@ class RealmTest(AuthedTestCase):
         user = get_user_profile_by_email('hamlet@zulip.com')
         self.assertTrue(user.realm.deactivated)
 
+class LocalCacheTest(AuthedTestCase):
+    def test_lru_and_ttl(self):
+        # type: () -> None
+        local = cache.LocalCache(2)
+        local.set(u'a', (1,), 60)
+        local.set(u'b', (2,), 60)
+        self.assertEqual(local.get(u'a'), (1,))
+        local.set(u'c', (3,), 60)
+        # 'b' was the least recently used entry
+        self.assertIsNone(local.get(u'b'))
+        self.assertEqual(local.get(u'a'), (1,))
+        self.assertEqual(local.get(u'c'), (3,))
+
+        local.set(u'd', (4,), -1)
+        self.assertIsNone(local.get(u'd'))
+
+        # Every get returns a separate copy
+        local.set(u'e', ([],), 60)
+        local.get(u'e')[0].append(1)
+        self.assertEqual(local.get(u'e'), ([],))
+
+    def test_threads(self):
+        # type: () -> None
+        local = cache.LocalCache(50)
+        errors = [] # type: List[Exception]
+
+        def churn(thread_num):
+            # type: (int) -> None
+            try:
+                for i in range(2000):
+                    key = u'%d' % (i % 100,)
+                    local.set(key, (thread_num, i), 60)
+                    local.get(key)
+                    if i % 7 == 0:
+                        local.delete(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=churn, args=(thread_num,)) for thread_num in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(len(local.entries) <= 50)
+
+    def test_local_cache(self):
+        # type: () -> None
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        with self.settings(LOCAL_CACHE_MAX_ENTRIES=100):
+            get_user_profile_by_id(user_profile.id)
+            remote_requests = cache.get_remote_cache_requests()
+            self.assertEqual(get_user_profile_by_id(user_profile.id).email, 'hamlet@zulip.com')
+            self.assertEqual(cache.get_remote_cache_requests(), remote_requests)
+
+            # Changes made by this process update its local cache
+            do_change_full_name(user_profile, 'Prince Hamlet')
+            remote_requests = cache.get_remote_cache_requests()
+            self.assertEqual(get_user_profile_by_id(user_profile.id).full_name, 'Prince Hamlet')
+            self.assertEqual(cache.get_remote_cache_requests(), remote_requests)
+
+            # Changes made by other processes invalidate it
+            key = cache.KEY_PREFIX + cache.user_profile_by_id_cache_key(user_profile.id)
+            get_redis_client().publish(cache.LOCAL_CACHE_INVALIDATION_CHANNEL,
+                                       ujson.dumps(["another process", [key]]))
+            for i in range(100):
+                if cache.get_local_cache().get(key) is None:
+                    break
+                time.sleep(0.01)
+            get_user_profile_by_id(user_profile.id)
+            self.assertEqual(cache.get_remote_cache_requests(), remote_requests + 1)
+
+class BulkCachedFetchTest(TestCase):
+    def fetch(self, object_ids, queried):
+        # type: (List[int], List[List[int]]) -> Dict[int, Any]
+        def query_function(ids):
+            # type: (List[int]) -> List[Dict[str, int]]
+            queried.append(ids)
+            return [dict(id=object_id, value=object_id * 2) for object_id in ids]
+        return cache.generic_bulk_cached_fetch(lambda object_id: u"bulk_fetch_test:%d" % (object_id,),
+                                               query_function,
+                                               object_ids,
+                                               id_fetcher=lambda obj: obj['id'],
+                                               single_flight=True)
+
+    def test_single_flight(self):
+        # type: () -> None
+        queried = [] # type: List[List[int]]
+        self.assertEqual(self.fetch([1, 2], queried)[2], dict(id=2, value=4))
+        self.assertEqual(queried, [[1, 2]])
+        self.assertIsNone(cache.cache_get(cache.bulk_fetch_lease_cache_key(
+            [u"bulk_fetch_test:1", u"bulk_fetch_test:2"])))
+
+        # Someone else holds the lease on fetching 3; we wait for them
+        # to fill the cache rather than querying ourselves.
+        lease_key = cache.bulk_fetch_lease_cache_key([u"bulk_fetch_test:3"])
+        self.assertTrue(cache.cache_add(lease_key, True))
+        self.assertFalse(cache.cache_add(lease_key, True))
+        def fill_cache(secs):
+            # type: (float) -> None
+            cache.cache_set(u"bulk_fetch_test:3", dict(id=3, value=6))
+        queried = []
+        with patch('zerver.lib.cache.time.sleep', side_effect=fill_cache):
+            self.assertEqual(self.fetch([1, 3], queried)[3], dict(id=3, value=6))
+        self.assertEqual(queried, [[]])
+
+        # If they never do, we eventually query for it ourselves.
+        queried = []
+        with patch('zerver.lib.cache.BULK_FETCH_WAIT_SECS', 0):
+            self.assertEqual(self.fetch([4], queried)[4], dict(id=4, value=8))
+        self.assertEqual(queried, [[4]])
+
+    def test_lease_released_on_error(self):
+        # type: () -> None
+        def query_function(ids):
+            # type: (List[int]) -> List[Dict[str, int]]
+            raise Exception("database error")
+        with self.assertRaises(Exception):
+            cache.generic_bulk_cached_fetch(lambda object_id: u"bulk_fetch_test:%d" % (object_id,),
+                                            query_function, [8], single_flight=True)
+        self.assertIsNone(cache.cache_get(cache.bulk_fetch_lease_cache_key([u"bulk_fetch_test:8"])))
+
+    def test_early_refresh(self):
+        # type: () -> None
+        now = time.time()
+        self.assertFalse(cache.should_refresh_early((1,), now))
+        self.assertFalse(cache.should_refresh_early((1, now + 3600, 0.01), now))
+        self.assertTrue(cache.should_refresh_early((1, now - 1, 0.01), now))
+        # Items cached without a timeout are never refreshed early
+        self.assertFalse(cache.should_refresh_early((1, None, 0.01), now))
+        self.fetch([7], [])
+        self.assertEqual(cache.cache_get(u"bulk_fetch_test:7")[0][1], None)
+
+        queried = [] # type: List[List[int]]
+        self.fetch([5, 6], queried)
+        queried = []
+        with patch('zerver.lib.cache.should_refresh_early', return_value=True):
+            self.fetch([5, 6], queried)
+        self.assertEqual(queried, [[5, 6]])
+
+class CacheWarmupTest(AuthedTestCase):
+    def test_cache_shards(self):
+        # type: () -> None
+        user_ids = set(UserProfile.objects.values_list('id', flat=True))
+        shards = cache_helpers.cache_shards('user', 3)
+        self.assertEqual(len(shards), max(user_ids) // 3 - min(user_ids) // 3 + 1)
+        # Newest first, aligned to the shard size, and covering every
+        # user exactly once
+        self.assertEqual(shards[0][2], (max(user_ids) // 3 + 1) * 3)
+        self.assertTrue(all(min_id % 3 == 0 and max_id == min_id + 3
+                            for (_, min_id, max_id) in shards))
+        covered = [user_id for (_, min_id, max_id) in shards for user_id in range(min_id, max_id)]
+        self.assertEqual(len(covered), len(set(covered)))
+        self.assertTrue(user_ids <= set(covered))
+
+        # Creating users doesn't move the existing shards, so that a
+        # checkpoint from an earlier run still matches them.
+        for i in range(4):
+            create_user('shard%d@zulip.com' % (i,), 'test', get_realm('zulip.com'),
+                        'Shard Test', 'shard%d' % (i,))
+        self.assertTrue(set(shards) <= set(cache_helpers.cache_shards('user', 3)))
+        self.assertEqual(cache_helpers.cache_shards('session', 3), [('session', None, None)])
+
+    def test_warm_remote_caches(self):
+        # type: () -> None
+        message_id = self.send_message("hamlet@zulip.com", "Denmark", Recipient.STREAM)
+        user_profile = get_user_profile_by_email('hamlet@zulip.com')
+        checkpoint_file = os.path.join(tempfile.mkdtemp(), 'cache_warmup_checkpoint')
+        cache.cache_delete_many([cache.user_profile_by_id_cache_key(user_profile.id),
+                                 to_dict_cache_key_id(message_id, True)])
+        stats = cache_helpers.warm_remote_caches(['user', 'message'], shard_size=5,
+                                                 checkpoint_file=checkpoint_file)
+        self.assertEqual(stats['user'][0], UserProfile.objects.count())
+        self.assertFalse(os.path.exists(checkpoint_file))
+        self.assertEqual(cache.cache_get(cache.user_profile_by_id_cache_key(user_profile.id))[0].email,
+                         'hamlet@zulip.com')
+        self.assertEqual(extract_message_dict(cache.cache_get(to_dict_cache_key_id(message_id, True))[0])['id'],
+                         message_id)
+
+        # Shards recorded in the checkpoint aren't filled again
+        with open(checkpoint_file, "w") as f:
+            for shard in cache_helpers.cache_shards('user', 5):
+                f.write(ujson.dumps(shard) + "\n")
+        stats = cache_helpers.warm_remote_caches(['user'], shard_size=5,
+                                                 checkpoint_file=checkpoint_file)
+        self.assertEqual(stats['user'], (0, 0.0))
+
 class PermissionTest(AuthedTestCase):
     def test_get_admin_users(self):
         # type: () -> None
@@ -324,17 +520,29 @@ class WorkerTest(TestCase):
         def __init__(self):
             # type: () -> None
             self.consumers = {} # type: Dict[str, Callable]
+            self.batch_consumers = {} # type: Dict[str, Tuple[Callable, int]]
             self.queue = [] # type: List[Tuple[str, Dict[str, Any]]]
+            self.connection = MagicMock()
 
         def register_json_consumer(self, queue_name, callback):
             # type: (str, Callable) -> None
             self.consumers[queue_name] = callback
 
+        def register_json_batch_consumer(self, queue_name, callback, prefetch_count,
+                                         max_batch_size, max_latency):
+            # type: (str, Callable, int, int, float) -> None
+            self.batch_consumers[queue_name] = (callback, max_batch_size)
+
         def start_consuming(self):
             # type: () -> None
             for queue_name, data in self.queue:
-                callback = self.consumers[queue_name]
-                callback(data)
+                if queue_name in self.consumers:
+                    callback = self.consumers[queue_name]
+                    callback(data)
+            for queue_name, (callback, max_batch_size) in self.batch_consumers.items():
+                events = [data for (name, data) in self.queue if name == queue_name]
+                for i in range(0, len(events), max_batch_size):
+                    callback(events[i:i + max_batch_size])
 
 
     def test_UserActivityWorker(self):
@@ -366,6 +574,67 @@ class WorkerTest(TestCase):
             self.assertTrue(len(activity_records), 1)
             self.assertTrue(activity_records[0].count, 1)
 
+    def test_UserActivityWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivity.objects.filter(user_profile=user, query__in=['batch_1', 'batch_2']).delete()
+        now = time.time()
+        for (query, offset) in [('batch_1', 0), ('batch_2', 1), ('batch_1', 2)]:
+            fake_client.queue.append(('user_activity', dict(user_profile_id=user.id, client='ios',
+                                                            time=now + offset, query=query)))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            with queries_captured() as queries:
+                worker.start()
+            # Both activities are created by one bulk query
+            self.assertEqual(len([query for query in queries
+                                  if 'INSERT INTO "zerver_useractivity"' in query['sql']]), 1)
+        activity = UserActivity.objects.get(user_profile=user, query='batch_1')
+        self.assertEqual(activity.count, 2)
+        self.assertEqual(activity.last_visit, timestamp_to_datetime(now + 2))
+
+        # A second batch updates the existing rows
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.start()
+        self.assertEqual(UserActivity.objects.get(user_profile=user, query='batch_1').count, 4)
+        self.assertEqual(UserActivity.objects.get(user_profile=user, query='batch_2').count, 2)
+
+    def test_UserActivityIntervalWorker_batch(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        user = get_user_profile_by_email('hamlet@zulip.com')
+        UserActivityInterval.objects.filter(user_profile=user).delete()
+        now = time.time()
+        # The first two visits overlap; the third is two hours later
+        for offset in [0, 5 * 60, 2 * 3600]:
+            fake_client.queue.append(('user_activity_interval',
+                                      dict(user_profile_id=user.id, time=now + offset)))
+
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            worker.start()
+        intervals = UserActivityInterval.objects.filter(user_profile=user).order_by('start')
+        self.assertEqual([(interval.start, interval.end) for interval in intervals],
+                         [(timestamp_to_datetime(now), timestamp_to_datetime(now + 20 * 60)),
+                          (timestamp_to_datetime(now + 2 * 3600),
+                           timestamp_to_datetime(now + 2 * 3600 + 15 * 60))])
+
+        # A visit overlapping the latest interval extends it
+        fake_client.queue = [('user_activity_interval',
+                              dict(user_profile_id=user.id, time=now + 2 * 3600 + 10 * 60))]
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityIntervalWorker()
+            worker.setup()
+            worker.start()
+        intervals = UserActivityInterval.objects.filter(user_profile=user).order_by('start')
+        self.assertEqual(intervals[1].end, timestamp_to_datetime(now + 2 * 3600 + 25 * 60))
+
     def test_error_handling(self):
         # type: () -> None
         processed = []
@@ -404,6 +673,49 @@ class WorkerTest(TestCase):
         event = ujson.loads(line.split('\t')[1])
         self.assertEqual(event, 'unexpected behaviour')
 
+    def test_per_request_caches_flushed_per_event(self):
+        # type: () -> None
+        from zerver import models
+        hamlet = get_user_profile_by_email('hamlet@zulip.com')
+        cached = []
+
+        @queue_processors.assign_queue('caching_worker')
+        class CachingWorker(queue_processors.QueueProcessingWorker):
+            def consume(self, data):
+                # type: (str) -> None
+                cached.append(list(models.per_request_message_user_cache))
+                models.get_message_user_dict(hamlet.id)
+
+        fake_client = self.FakeClient()
+        for msg in ['first', 'second']:
+            fake_client.queue.append(('caching_worker', msg))
+        models.flush_per_request_caches()
+        with simulated_queue_client(lambda: fake_client):
+            worker = CachingWorker()
+            worker.setup()
+            worker.start()
+        self.assertEqual(cached, [[], []])
+        self.assertEqual(models.per_request_message_user_cache, {})
+
+    def test_request_stop(self):
+        # type: () -> None
+        fake_client = self.FakeClient()
+        fake_client.stop_consuming = MagicMock()
+        with simulated_queue_client(lambda: fake_client):
+            worker = queue_processors.UserActivityWorker()
+            worker.setup()
+            worker.start()
+        # Consuming workers check for a stop request from a timer
+        (delay, check) = fake_client.connection.add_timeout.call_args[0]
+        check()
+        self.assertFalse(fake_client.stop_consuming.called)
+        self.assertEqual(fake_client.connection.add_timeout.call_count, 2)
+
+        worker.request_stop()
+        self.assertFalse(fake_client.stop_consuming.called)
+        check()
+        self.assertTrue(fake_client.stop_consuming.called)
+
     def test_worker_noname(self):
         # type: () -> None
         class TestWorker(queue_processors.QueueProcessingWorker):
@@ -428,6 +740,125 @@ class WorkerTest(TestCase):
             worker = TestWorker()
             worker.consume({})
 
+    def test_supervisor(self):
+        # type: () -> None
+        with self.settings(QUEUE_WORKER_PROCESSES={'user_activity': (1, 3)}):
+            supervisor = QueueSupervisor(['user_activity', 'signups'])
+        self.assertEqual(supervisor.pool_sizes, {'user_activity': (1, 3), 'signups': (1, 1)})
+        pids = iter(range(100, 200))
+
+        def start_worker(queue_name):
+            # type: (str) -> None
+            pid = next(pids)
+            # Distinct start times, so the newest worker is well-defined
+            supervisor.workers[queue_name][pid] = time.time() + pid / 1000.0
+        supervisor.start_worker = start_worker # type: ignore # monkey-patching
+        supervisor.stop_worker = lambda queue_name, pid: supervisor.stopping.add(pid) # type: ignore # monkey-patching
+
+        now = time.time()
+        # Starts the minimum, then scales up one worker at a time with depth
+        supervisor.scale('user_activity', None, now)
+        supervisor.scale('user_activity', 150, now)
+        supervisor.scale('user_activity', 150, now)
+        self.assertEqual(sorted(supervisor.running_workers('user_activity')), [100, 101])
+        for i in range(3):
+            supervisor.scale('user_activity', 1000, now)
+        self.assertEqual(len(supervisor.running_workers('user_activity')), 3)
+
+        # Scales down to the minimum, stopping the newest first, once empty
+        for i in range(3):
+            supervisor.scale('user_activity', 0, now)
+        self.assertEqual(supervisor.running_workers('user_activity'), [100])
+        self.assertEqual(supervisor.stopping, set([101, 102]))
+        supervisor.worker_exited(102, 0)
+        self.assertEqual(supervisor.stopping, set([101]))
+        self.assertEqual(supervisor.crashes['user_activity'], 0)
+
+        # A crashed worker is restarted after an increasing delay
+        supervisor.scale('signups', None, now)
+        supervisor.worker_exited(103, 1)
+        self.assertEqual(supervisor.describe_exit(1 << 8), "exited with status 1")
+        self.assertEqual(supervisor.describe_exit(signal.SIGKILL), "was killed by signal 9")
+        supervisor.scale('signups', None, time.time())
+        self.assertEqual(supervisor.running_workers('signups'), [])
+        supervisor.scale('signups', None, time.time() + supervisor.restart_delay(1))
+        self.assertEqual(supervisor.running_workers('signups'), [104])
+        supervisor.worker_exited(104, 1)
+        self.assertEqual(supervisor.crashes['signups'], 2)
+        self.assertEqual(supervisor.restart_delay(2), 2 * supervisor.restart_delay(1))
+        self.assertEqual(supervisor.restart_delay(100), supervisor.MAX_RESTART_BACKOFF_SECS)
+
+class SimpleQueueClientTest(TestCase):
+    def test_batch_consumer_reconnect(self):
+        # type: () -> None
+        batches = [] # type: List[List[Mapping[str, Any]]]
+        with patch('zerver.lib.queue.pika.BlockingConnection', side_effect=lambda params: MagicMock()):
+            client = queue.SimpleQueueClient()
+            client.register_json_batch_consumer('user_activity', batches.append, prefetch_count=10,
+                                                max_batch_size=2, max_latency=1.0)
+            (consumer,) = client.consumers['user_activity']
+            consumer(client.channel, MagicMock(delivery_tag=1), None, '{"id": 1}')
+
+            client._reconnect()
+            client._reconnect_consumer_callbacks()
+            # The prefetch count is set on the new channel too
+            client.channel.basic_qos.assert_called_once_with(prefetch_count=10)
+
+            # The event pending on the old channel isn't in the next
+            # batch, so its delivery tag is never acked on the new one
+            consumer(client.channel, MagicMock(delivery_tag=1), None, '{"id": 2}')
+            consumer(client.channel, MagicMock(delivery_tag=2), None, '{"id": 3}')
+        self.assertEqual(batches, [[{'id': 2}, {'id': 3}]])
+        client.channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+
+class BackgroundQueuePublisherTest(TestCase):
+    def test_coalesced_publish(self):
+        # type: () -> None
+        bursts = [] # type: List[List[Tuple[str, str]]]
+        client = MagicMock()
+        client.publish_many_reconnecting.side_effect = bursts.append
+        processor = MagicMock()
+
+        publisher = queue.background_publisher
+        with self.settings(USING_RABBITMQ=True, QUEUE_PUBLISH_IN_BACKGROUND=True), \
+                patch('zerver.lib.queue.get_queue_client', return_value=client), \
+                patch.object(publisher, 'linger_secs', 0.1):
+            event = {'id': 1}
+            queue.queue_json_publish('user_activity', event, processor)
+            # Events are serialized when they're queued
+            event['id'] = 4
+            queue.queue_json_publish('signups', {'id': 2}, processor)
+            queue.queue_json_publish('user_activity', {'id': 3}, processor)
+            for i in range(100):
+                if bursts:
+                    break
+                time.sleep(0.05)
+            publisher.flush()
+
+        self.assertEqual([[(queue_name, ujson.loads(body)) for (queue_name, body) in burst]
+                          for burst in bursts],
+                         [[('user_activity', {'id': 1}),
+                           ('signups', {'id': 2}),
+                           ('user_activity', {'id': 3})]])
+        self.assertFalse(processor.called)
+
+    def test_failed_publish_saved(self):
+        # type: () -> None
+        client = MagicMock()
+        client.publish_many_reconnecting.side_effect = Exception("rabbitmq is down")
+        queue_error_dir = tempfile.mkdtemp()
+
+        publisher = queue.BackgroundQueuePublisher()
+        with self.settings(QUEUE_ERROR_DIR=queue_error_dir), \
+                patch('zerver.lib.queue.get_queue_client', return_value=client), \
+                patch('logging.exception'):
+            publisher.pending = [('user_activity', ujson.dumps({'id': 1}))]
+            publisher.flush()
+
+        with open(os.path.join(queue_error_dir, 'user_activity.errors')) as f:
+            line = f.readline().strip()
+        self.assertEqual(ujson.loads(line.split('\t')[1]), {'id': 1})
+
 class ActivityTest(AuthedTestCase):
     def test_activity(self):
         # type: () -> None
@@ -1512,6 +1943,27 @@ class UserPresenceTests(AuthedTestCase):
         self.assertEqual(json['presences'][email][client]['status'], 'active')
         self.assertEqual(json['presences']['hamlet@zulip.com'][client]['status'], 'idle')
 
+    def test_cached_presence_updates(self):
+        # type: () -> None
+        email = "hamlet@zulip.com"
+        self.login(email)
+        user_profile = get_user_profile_by_email(email)
+        self.client.post("/json/users/me/presence", {'status': 'idle'})
+
+        # Fill the presence cache; updates flush it, and the next read
+        # refills it.
+        get_status_dict(user_profile)
+        with queries_captured() as queries:
+            get_status_dict(user_profile)
+        self.assert_length(queries, 0)
+        self.client.post("/json/users/me/presence", {'status': 'active'})
+        self.assertIsNone(cache.cache_get(cache.user_presence_cache_key(user_profile.id)))
+        presences = get_status_dict(user_profile)
+        self.assertEqual(presences[email]['website']['status'], 'active')
+        with queries_captured() as queries:
+            get_status_dict(user_profile)
+        self.assert_length(queries, 0)
+
     def test_no_mit(self):
         # type: () -> None
         """MIT never gets a list of users"""
@@ -1624,6 +2076,34 @@ class AlertWordTests(AuthedTestCase):
                          self.interesting_alert_word_list)
         self.assertEqual(realm_words[user2.id], ['another'])
 
+    def test_matcher(self):
+        # type: () -> None
+        matcher = AlertWordMatcher({1: [u'alert', u'multi-word word', u'☃'],
+                                    2: [u'word', u'ALERTS'],
+                                    3: [u'lert']})
+        self.assertEqual(matcher.user_ids_with_alert_words(u'An ALERT!'), set([1]))
+        self.assertEqual(matcher.user_ids_with_alert_words(u'alerts, (multi-word word)'), set([1, 2]))
+        self.assertEqual(matcher.user_ids_with_alert_words(u'snow ☃'), set([1]))
+        # Only whole words match
+        self.assertEqual(matcher.user_ids_with_alert_words(u'alerting words'), set())
+        self.assertEqual(matcher.user_ids_with_alert_words(u''), set())
+
+    def test_realm_matcher(self):
+        # type: () -> None
+        """
+        Each realm's matcher is built once, and rebuilt when a user in
+        the realm changes their alert words.
+        """
+        user = get_user_profile_by_email("cordelia@zulip.com")
+        add_user_alert_words(user, ['alert'])
+        matcher = alert_word_matcher(user.realm)
+        self.assertIs(alert_word_matcher(user.realm), matcher)
+        self.assertEqual(matcher.user_ids_with_alert_words(u'alert'), set([user.id]))
+
+        remove_user_alert_words(user, ['alert'])
+        matcher = alert_word_matcher(user.realm)
+        self.assertEqual(matcher.user_ids_with_alert_words(u'alert'), set())
+
     def test_json_list_default(self):
         # type: () -> None
         self.login("hamlet@zulip.com")
@@ -11,10 +11,10 @@ from zerver.decorator import asynchronous, \
     authenticated_json_post_view, internal_notify_view, RespondAsynchronously, \
     has_request_variables, REQ, _RespondAsynchronously
 
-from zerver.lib.response import json_success, json_error
+from zerver.lib.response import json_success, json_error, json_response
 from zerver.lib.validator import check_bool, check_list, check_string
 from zerver.lib.event_queue import get_client_descriptor, \
-    process_notification, fetch_events
+    process_notification, fetch_events, encode_events
 from django.core.handlers.base import BaseHandler
 
 from typing import Union, Optional, Iterable, Sequence, List
@@ -95,4 +95,7 @@ def get_events_backend(request, user_profile, handler,
         return RespondAsynchronously
     if result["type"] == "error":
         return json_error(result["message"])
-    return json_success(result["response"])
+    response = result["response"]
+    events = response.pop("events")
+    return json_response(data=response,
+                         encoded_data=dict(events=encode_events(events, result["apply_markdown"])))
@@ -9,7 +9,7 @@ from django.db import connection
 from django.db.models import Q
 from django.http import HttpRequest, HttpResponse
 from six import text_type
-from typing import AnyStr, Iterable, Optional, Tuple
+from typing import Any, AnyStr, Dict, Iterable, List, Optional, Set, Tuple
 from zerver.lib.str_utils import force_bytes
 
 from zerver.decorator import authenticated_api_view, authenticated_json_post_view, \
@@ -21,25 +21,29 @@ from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     compute_mit_user_fullname, compute_irc_user_fullname, compute_jabber_user_fullname, \
     create_mirror_user_if_needed, check_send_message, do_update_message, \
     extract_recipients, truncate_body
-from zerver.lib.cache import generic_bulk_cached_fetch
+from zerver.lib.cache import cache_get, cache_set, generic_bulk_cached_fetch, \
+    search_generation_cache_key
+from zerver.lib.queue import queue_json_publish
 from zerver.lib.response import json_success, json_error
 from zerver.lib.sqlalchemy_utils import get_sqlalchemy_connection
-from zerver.lib.utils import statsd
+from zerver.lib.utils import statsd, make_safe_digest
 from zerver.lib.validator import \
     check_list, check_int, check_dict, check_string, check_bool
 from zerver.models import Message, UserProfile, Stream, Subscription, \
     Recipient, UserMessage, bulk_get_recipients, get_recipient, \
     get_user_profile_by_email, get_stream, valid_stream_name, \
-    parse_usermessage_flags, to_dict_cache_key_id, extract_message_dict, \
+    parse_usermessage_flags, to_dict_cache_key_id, extract_message_dicts, \
+    MESSAGE_DICT_CACHE_TIMEOUT, \
     stringify_message_dict, \
     resolve_email_to_domain, get_realm, get_active_streams, \
     bulk_get_streams
 
 from sqlalchemy import func
-from sqlalchemy.sql import select, join, column, literal_column, literal, and_, \
+from sqlalchemy.sql import select, join, outerjoin, column, literal_column, literal, and_, \
     or_, not_, union_all, alias
 
 import re
+import time
 import ujson
 import datetime
 
@@ -59,6 +63,8 @@ class NarrowBuilder(object):
     def __init__(self, user_profile, msg_id_column):
         self.user_profile = user_profile
         self.msg_id_column = msg_id_column
+        # The operands of the search terms, used for highlighting matches
+        self.search_operands = [] # type: List[text_type]
 
     def add_term(self, query, term):
         # We have to be careful here because we're letting users call a method
@@ -235,15 +241,8 @@ class NarrowBuilder(object):
             return query.where(maybe_negate(cond))
 
     def by_search(self, query, operand, maybe_negate):
+        self.search_operands.append(operand)
         tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
-        ts_locs_array = func.ts_match_locs_array
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           column("rendered_content"),
-                                           tsquery).label("content_matches"))
-        # We HTML-escape the subject in Postgres to avoid doing a server round-trip
-        query = query.column(ts_locs_array(literal("zulip.english_us_search"),
-                                           func.escape_html(column("subject")),
-                                           tsquery).label("subject_matches"))
 
         # Do quoted string matching.  We really want phrase
         # search here so we can ignore punctuation and do
@@ -260,6 +259,128 @@ class NarrowBuilder(object):
         cond = column("search_tsvector").op("@@")(tsquery)
         return query.where(maybe_negate(cond))
 
+# Rough relative cost of filtering by each narrow operator.  The
+# planner orders narrow conditions by these, so that selective
+# predicates on indexed columns come first and full-text search last.
+NARROW_OPERATOR_COSTS = {
+    'id': 0,
+    'stream': 1,
+    'pm-with': 1,
+    'topic': 2,
+    'sender': 2,
+    'is': 3,
+    'has': 3,
+    'in': 4,
+    'search': 10,
+} # type: Dict[str, int]
+
+# Terms that can be answered from zerver_usermessage alone, without
+# joining zerver_message.
+USERMESSAGE_ONLY_TERMS = frozenset([
+    ('id', None),
+    ('is', 'starred'),
+    ('is', 'mentioned'),
+])
+
+def plan_narrow(narrow):
+    # type: (Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]
+    """Returns the terms of the narrow in the order in which their
+    conditions should be added to the query, dropping terms that don't
+    restrict it at all and duplicates."""
+    terms = [] # type: List[Dict[str, Any]]
+    seen = set() # type: Set[Tuple[str, text_type, bool]]
+    for term in narrow:
+        operator = term['operator']
+        operand = term['operand']
+        negated = term.get('negated', False)
+        if operator == 'is' and operand == 'alerted':
+            # Equivalent to is:mentioned; see NarrowBuilder.by_is
+            operand = 'mentioned'
+        if operator == 'near' or (operator == 'in' and operand == 'all'):
+            continue
+        key = (operator, operand, negated)
+        if key in seen:
+            continue
+        seen.add(key)
+        terms.append(dict(term, operand=operand))
+    # Unknown operators sort last; NarrowBuilder will reject them.
+    terms.sort(key=lambda term: (NARROW_OPERATOR_COSTS.get(term['operator'], 100),
+                                 term.get('negated', False)))
+    return terms
+
+def narrow_needs_message_table(narrow):
+    # type: (Iterable[Dict[str, Any]]) -> bool
+    for term in narrow:
+        operand = None if term['operator'] == 'id' else term['operand']
+        if (term['operator'], operand) not in USERMESSAGE_ONLY_TERMS:
+            return True
+    return False
+
+def add_search_highlight_columns(query, operand):
+    # type: (Any, text_type) -> Any
+    """Adds the locations of the matches for the search to each row of
+    the query, which must already select subject and rendered_content.
+    This is applied to the outer query in get_old_messages, so that
+    the matches are only located within the messages we return."""
+    tsquery = func.plainto_tsquery(literal("zulip.english_us_search"), literal(operand))
+    ts_locs_array = func.ts_match_locs_array
+    query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                       column("rendered_content"),
+                                       tsquery).label("content_matches"))
+    # We HTML-escape the subject in Postgres to avoid doing a server round-trip
+    query = query.column(ts_locs_array(literal("zulip.english_us_search"),
+                                       func.escape_html(column("subject")),
+                                       tsquery).label("subject_matches"))
+    return query
+
+# Narrows whose results depend on the user's message flags or
+# subscriptions, which change without bumping the search generation.
+UNCACHEABLE_SEARCH_TERMS = [('is', 'starred'), ('is', 'mentioned'), ('is', 'alerted'),
+                            ('in', 'home')]
+
+def search_results_are_cacheable(terms):
+    # type: (Iterable[Dict[str, Any]]) -> bool
+    return not any((term['operator'], term['operand']) in UNCACHEABLE_SEARCH_TERMS
+                   for term in terms)
+
+def search_result_cache_key(user_profile, terms, anchor, num_before, num_after):
+    # type: (UserProfile, Iterable[Dict[str, Any]], int, int, int) -> text_type
+    generation_key = search_generation_cache_key(user_profile.realm_id)
+    generation = cache_get(generation_key)
+    if generation is None:
+        generation = (str(time.time()),)
+        cache_set(generation_key, generation[0])
+
+    normalized_terms = []
+    for term in terms:
+        operand = term['operand']
+        if term['operator'] == 'search':
+            # Both the full-text and the quoted string matching are
+            # case-insensitive.
+            operand = ' '.join(operand.lower().split())
+        normalized_terms.append((term['operator'], operand, term.get('negated', False)))
+    query_key = ujson.dumps([normalized_terms, anchor, num_before, num_after])
+    return u"search_results:%s:%s:%s" % (user_profile.id, generation[0],
+                                         make_safe_digest(query_key))
+
+def search_page_is_complete(message_ids, anchor, num_after):
+    # type: (List[int], int, int) -> bool
+    """Whether new messages can't change the results of a search.  New
+    messages have larger ids than any existing message, so this is the
+    case if the after query returned as many messages as it could, or
+    there was no after query and the anchor is an existing message."""
+    if num_after == 0:
+        return anchor in message_ids
+    return len([message_id for message_id in message_ids if message_id >= anchor]) >= num_after
+
+def get_user_message_flags_rows(user_profile, message_ids):
+    # type: (UserProfile, List[int]) -> List[Tuple[int, Optional[int]]]
+    flags = dict(UserMessage.objects.filter(user_profile=user_profile,
+                                            message_id__in=message_ids)
+                                    .values_list("message_id", "flags"))
+    return [(message_id, int(flags[message_id]) if message_id in flags else None)
+            for message_id in message_ids]
+
 def highlight_string(text, locs):
     # type: (AnyStr, Iterable[Tuple[int, int]]) -> text_type
     string = force_bytes(text)
@@ -404,6 +525,26 @@ def exclude_muting_conditions(user_profile, narrow):
 
     return conditions
 
+def report_slow_narrow(sa_conn, query, narrow_description, query_time, user_profile):
+    # type: (Any, Any, str, float, UserProfile) -> None
+    """Re-runs a slow narrow query under EXPLAIN ANALYZE, and sends the
+    plan to the slow_queries queue, so we can see which narrows hurt."""
+    compiled = query.compile(dialect=sa_conn.dialect)
+    plan = sa_conn.execute("EXPLAIN ANALYZE " + str(compiled), compiled.params).fetchall()
+    report = "get_old_messages %s took %.3fs (%s)\n%s" % (
+        narrow_description, query_time, user_profile.email,
+        "\n".join(row[0] for row in plan))
+    queue_json_publish("slow_queries", report, lambda e: None)
+
+# Pages of search results are cached for this long; edits to messages
+# invalidate them sooner.
+SEARCH_RESULT_CACHE_TIMEOUT = 600
+# Larger pages of search results aren't cached
+MAX_CACHED_SEARCH_RESULTS = 200
+
+# Used as the anchor by use_first_unread_anchor when there are no unread messages
+LARGER_THAN_MAX_MESSAGE_ID = 10000000000000000
+
 @has_request_variables
 def get_old_messages_backend(request, user_profile,
                              anchor = REQ(converter=int),
@@ -415,16 +556,35 @@ def get_old_messages_backend(request, user_profile,
                                                 converter=ujson.loads)):
     include_history = ok_to_include_history(narrow, user_profile.realm)
 
+    terms = [] # type: List[Dict[str, Any]]
+    if narrow is not None:
+        terms = plan_narrow(narrow)
+
+    muting_conditions = [] # type: List[Any]
+    if use_first_unread_anchor:
+        # We exclude messages on muted topics when finding the first unread
+        # message in this narrow
+        muting_conditions = exclude_muting_conditions(user_profile, narrow)
+
     if include_history and not use_first_unread_anchor:
-        query = select([column("id").label("message_id")], None, "zerver_message")
+        # Outer join against the user's UserMessage rows, so that we
+        # get their flags for the messages they did receive from the
+        # same query; the flags are NULL for historical messages.
+        query = select([literal_column("zerver_message.id").label("message_id"),
+                        literal_column("zerver_usermessage.flags").label("flags")],
+                       None,
+                       outerjoin("zerver_message", "zerver_usermessage",
+                                 and_(literal_column("zerver_usermessage.message_id") ==
+                                      literal_column("zerver_message.id"),
+                                      literal_column("zerver_usermessage.user_profile_id") ==
+                                      literal(user_profile.id))))
         inner_msg_id_col = literal_column("zerver_message.id")
-    elif narrow is None:
+    elif not muting_conditions and not narrow_needs_message_table(terms):
         query = select([column("message_id"), column("flags")],
                        column("user_profile_id") == literal(user_profile.id),
                        "zerver_usermessage")
         inner_msg_id_col = column("message_id")
     else:
-        # TODO: Don't do this join if we're not doing a search
         query = select([column("message_id"), column("flags")],
                        column("user_profile_id") == literal(user_profile.id),
                        join("zerver_usermessage", "zerver_message",
@@ -448,7 +608,7 @@ def get_old_messages_backend(request, user_profile,
         # Build the query for the narrow
         num_extra_messages = 0
         builder = NarrowBuilder(user_profile, inner_msg_id_col)
-        for term in narrow:
+        for term in terms:
             if term['operator'] == 'search' and not is_search:
                 query = query.column("subject").column("rendered_content")
                 is_search = True
@@ -464,90 +624,110 @@ def get_old_messages_backend(request, user_profile,
         num_before += num_extra_messages
 
     sa_conn = get_sqlalchemy_connection()
-    if use_first_unread_anchor:
-        condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
-
-        # We exclude messages on muted topics when finding the first unread
-        # message in this narrow
-        muting_conditions = exclude_muting_conditions(user_profile, narrow)
-        if muting_conditions:
-            condition = and_(condition, *muting_conditions)
-
-        first_unread_query = query.where(condition)
-        first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
-        first_unread_result = list(sa_conn.execute(first_unread_query).fetchall())
-        if len(first_unread_result) > 0:
-            anchor = first_unread_result[0][0]
-        else:
-            anchor = 10000000000000000
-
-    before_query = None
-    after_query = None
-    if num_before != 0:
-        before_anchor = anchor
+    search_start = time.time()
+    search_fields = dict() # type: Dict[int, Dict[str, text_type]]
+    search_cache_key = None # type: Optional[text_type]
+    cached_search_results = None
+    if is_search and not use_first_unread_anchor and search_results_are_cacheable(terms):
+        search_cache_key = search_result_cache_key(user_profile, terms, anchor,
+                                                   num_before, num_after)
+        cached_search_results = cache_get(search_cache_key)
+
+    if cached_search_results is not None:
+        # The cache holds the ids of the messages matching the search,
+        # with their highlighted content and subject; we just need the
+        # user's current flags for them.
+        for (message_id, match_content, match_subject) in cached_search_results[0]:
+            search_fields[message_id] = dict(match_content=match_content,
+                                             match_subject=match_subject)
+        query_result = get_user_message_flags_rows(user_profile,
+                                                   [row[0] for row in cached_search_results[0]])
+    else:
+        if use_first_unread_anchor:
+            condition = column("flags").op("&")(UserMessage.flags.read.mask) == 0
+            if muting_conditions:
+                condition = and_(condition, *muting_conditions)
+
+            # Rather than looking up the first unread message and then
+            # querying around it, embed the lookup in the main query as a
+            # scalar subquery, saving a database round trip.
+            first_unread_query = query.with_only_columns([inner_msg_id_col]).where(condition)
+            first_unread_query = first_unread_query.order_by(inner_msg_id_col.asc()).limit(1)
+            anchor = func.coalesce(first_unread_query.correlate(None).as_scalar(),
+                                   literal(LARGER_THAN_MAX_MESSAGE_ID))
+
+        before_query = None
+        after_query = None
+        if num_before != 0:
+            before_anchor = anchor
+            if num_after != 0:
+                # Don't include the anchor in both the before query and the after query
+                before_anchor = anchor - 1
+            before_query = query.where(inner_msg_id_col <= before_anchor) \
+                                .order_by(inner_msg_id_col.desc()).limit(num_before)
         if num_after != 0:
-            # Don't include the anchor in both the before query and the after query
-            before_anchor = anchor - 1
-        before_query = query.where(inner_msg_id_col <= before_anchor) \
-                            .order_by(inner_msg_id_col.desc()).limit(num_before)
-    if num_after != 0:
-        after_query = query.where(inner_msg_id_col >= anchor) \
-                           .order_by(inner_msg_id_col.asc()).limit(num_after)
+            after_query = query.where(inner_msg_id_col >= anchor) \
+                               .order_by(inner_msg_id_col.asc()).limit(num_after)
 
-    if num_before == 0 and num_after == 0:
-        # This can happen when a narrow is specified.
-        after_query = query.where(inner_msg_id_col == anchor)
+        if num_before == 0 and num_after == 0:
+            # This can happen when a narrow is specified.
+            after_query = query.where(inner_msg_id_col == anchor)
 
-    if before_query is not None:
-        if after_query is not None:
-            query = union_all(before_query.self_group(), after_query.self_group())
+        if before_query is not None:
+            if after_query is not None:
+                query = union_all(before_query.self_group(), after_query.self_group())
+            else:
+                query = before_query
         else:
-            query = before_query
-    else:
-        query = after_query
-    main_query = alias(query)
-    query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
-    # This is a hack to tag the query we use for testing
-    query = query.prefix_with("/* get_old_messages */")
-    query_result = list(sa_conn.execute(query).fetchall())
-
-    # The following is a little messy, but ensures that the code paths
-    # are similar regardless of the value of include_history.  The
-    # 'user_messages' dictionary maps each message to the user's
-    # UserMessage object for that message, which we will attach to the
-    # rendered message dict before returning it.  We attempt to
-    # bulk-fetch rendered message dicts from remote cache using the
-    # 'messages' list.
-    search_fields = dict() # type: Dict[int, Dict[str, text_type]]
+            query = after_query
+        main_query = alias(query)
+        query = select(main_query.c, None, main_query).order_by(column("message_id").asc())
+        if is_search:
+            query = add_search_highlight_columns(query, " ".join(builder.search_operands))
+        # This is a hack to tag the query we use for testing
+        query = query.prefix_with("/* get_old_messages */")
+        query_start = time.time()
+        query_result = list(sa_conn.execute(query).fetchall())
+        query_time = time.time() - query_start
+        if (narrow is not None and settings.SLOW_NARROW_EXPLAIN_SECS is not None and
+                query_time >= settings.SLOW_NARROW_EXPLAIN_SECS):
+            report_slow_narrow(sa_conn, query, request._log_data['extra'], query_time, user_profile)
+
+    # Each row holds the message's id and the user's flags for it
+    # (NULL if the user never received it, which only happens when
+    # include_history is set), followed by the search fields, if any.
+    # We attach the flags to the rendered message dicts, which we
+    # attempt to bulk-fetch from remote cache using 'message_ids'.
     message_ids = [] # type: List[int]
     user_message_flags = {} # type: Dict[int, List[str]]
-    if include_history:
-        message_ids = [row[0] for row in query_result]
-
-        # TODO: This could be done with an outer join instead of two queries
-        user_message_flags = dict((user_message.message_id, user_message.flags_list()) for user_message in
-                                  UserMessage.objects.filter(user_profile=user_profile,
-                                                             message__id__in=message_ids))
-        for row in query_result:
-            message_id = row[0]
-            if user_message_flags.get(message_id) is None:
-                user_message_flags[message_id] = ["read", "historical"]
-            if is_search:
-                (_, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
-    else:
-        for row in query_result:
-            message_id = row[0]
-            flags = row[1]
+    for row in query_result:
+        message_id = row[0]
+        flags = row[1]
+        if flags is None:
+            user_message_flags[message_id] = ["read", "historical"]
+        else:
             user_message_flags[message_id] = parse_usermessage_flags(flags)
 
-            message_ids.append(message_id)
+        message_ids.append(message_id)
 
-            if is_search:
-                (_, _, subject, rendered_content, content_matches, subject_matches) = row
-                search_fields[message_id] = get_search_fields(rendered_content, subject,
-                                                              content_matches, subject_matches)
+        if is_search and cached_search_results is None:
+            (_, _, subject, rendered_content, content_matches, subject_matches) = row
+            search_fields[message_id] = get_search_fields(rendered_content, subject,
+                                                          content_matches, subject_matches)
+
+    if is_search:
+        if cached_search_results is not None:
+            statsd.timing("search.cache_hit", (time.time() - search_start) * 1000)
+        else:
+            statsd.timing("search.cache_miss", (time.time() - search_start) * 1000)
+            if search_cache_key is not None and len(message_ids) <= MAX_CACHED_SEARCH_RESULTS and \
+                    search_page_is_complete(message_ids, anchor, num_after):
+                cache_set(search_cache_key,
+                          [(result_id,
+                            search_fields[result_id]['match_content'],
+                            search_fields[result_id]['match_subject'])
+                           for result_id in message_ids],
+                          timeout=SEARCH_RESULT_CACHE_TIMEOUT)
 
     cache_transformer = lambda row: Message.build_dict_from_raw_db_row(row, apply_markdown)
     id_fetcher = lambda row: row['id']
@@ -557,8 +737,10 @@ def get_old_messages_backend(request, user_profile,
                                               message_ids,
                                               id_fetcher=id_fetcher,
                                               cache_transformer=cache_transformer,
-                                              extractor=extract_message_dict,
-                                              setter=stringify_message_dict)
+                                              bulk_extractor=extract_message_dicts,
+                                              setter=stringify_message_dict,
+                                              single_flight=True,
+                                              timeout=MESSAGE_DICT_CACHE_TIMEOUT)
 
     message_list = []
     for message_id in message_ids:
@@ -819,7 +1001,7 @@ def update_message_backend(request, user_profile,
         if content == "":
             raise JsonableError(_("Content can't be empty"))
         content = truncate_body(content)
-        rendered_content = message.render_markdown(content)
+        rendered_content = message.render_markdown(content, defer_link_previews=True)
         if not rendered_content:
             raise JsonableError(_("We were unable to render your updated message"))
 
@@ -844,7 +1026,7 @@ def json_fetch_raw_message(request, user_profile,
 @has_request_variables
 def render_message_backend(request, user_profile, content=REQ()):
     # type: (HttpRequest, UserProfile, text_type) -> HttpResponse
-    rendered_content = bugdown.convert(content, user_profile.realm.domain)
+    rendered_content = bugdown.convert(content, user_profile.realm.domain, realm=user_profile.realm)
     return json_success({"rendered": rendered_content})
 
 @authenticated_json_post_view
@@ -5,17 +5,18 @@ from django.conf import settings
 from django.core.handlers.wsgi import WSGIRequest
 from django.core.handlers.base import BaseHandler
 from zerver.models import get_user_profile_by_email, \
-    get_user_profile_by_id, get_prereg_user_by_email, get_client
+    get_user_profile_by_id, get_prereg_user_by_email, get_client, flush_per_request_caches
 from zerver.lib.context_managers import lockfile
 from zerver.lib.queue import SimpleQueueClient, queue_json_publish
 from zerver.lib.timestamp import timestamp_to_datetime
 from zerver.lib.notifications import handle_missedmessage_emails, enqueue_welcome_emails, \
     clear_followup_emails_queue, send_local_email_template_with_delay
 from zerver.lib.actions import do_send_confirmation_email, \
-    do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
+    do_update_user_activities, do_update_user_activity_intervals, do_update_user_presence, \
     internal_send_message, check_send_message, extract_recipients, \
-    handle_push_notification
-from zerver.lib.digest import handle_digest_email
+    handle_push_notification, do_fetch_link_previews
+from zerver.lib.digest import handle_digest_email, handle_digest_emails
+from zerver.lib.rerender import rerender_message_range
 from zerver.lib.email_mirror import process_message as mirror_email
 from zerver.decorator import JsonableError
 from zerver.lib.socket import req_redis_key
@@ -23,6 +24,7 @@ from confirmation.models import Confirmation
 from zerver.lib.db import reset_queries
 from django.core.mail import EmailMessage
 from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
 
 import os
 import sys
@@ -58,9 +60,15 @@ def get_active_worker_queues():
 
 class QueueProcessingWorker(object):
     queue_name = None # type: str
+    # How often a consuming worker checks whether it's been asked to stop
+    stop_poll_secs = 1.0
 
     def __init__(self):
         self.q = None # type: SimpleQueueClient
+        # Whether the worker is consuming from the queue, and so can be
+        # stopped cleanly after the event it's handling
+        self.consuming = False
+        self.stop_requested = False
         if self.queue_name is None:
             raise WorkerDeclarationException("Queue worker declared without queue_name")
 
@@ -68,20 +76,32 @@ class QueueProcessingWorker(object):
         raise WorkerDeclarationException("No consumer defined!")
 
     def consume_wrapper(self, data):
+        start = time.time()
         try:
             self.consume(data)
         except Exception:
             self._log_problem()
-            if not os.path.exists(settings.QUEUE_ERROR_DIR):
-                os.mkdir(settings.QUEUE_ERROR_DIR)
-            fname = '%s.errors' % (self.queue_name,)
-            fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
-            line = u'%s\t%s\n' % (time.asctime(), ujson.dumps(data))
-            lock_fn = fn + '.lock'
-            with lockfile(lock_fn):
-                with open(fn, 'ab') as f:
-                    f.write(line.encode('utf-8'))
+            self._save_failed_events([data])
         reset_queries()
+        # There's no request to flush these after, and they'd
+        # otherwise grow, and go stale, for the life of the worker.
+        flush_per_request_caches()
+        self._record_stats(1, time.time() - start)
+
+    def _record_stats(self, num_events, elapsed):
+        statsd.incr("queue_worker.%s.events" % (self.queue_name,), num_events)
+        statsd.timing("queue_worker.%s.consume" % (self.queue_name,), elapsed * 1000)
+
+    def _save_failed_events(self, events):
+        if not os.path.exists(settings.QUEUE_ERROR_DIR):
+            os.mkdir(settings.QUEUE_ERROR_DIR)
+        fname = '%s.errors' % (self.queue_name,)
+        fn = os.path.join(settings.QUEUE_ERROR_DIR, fname)
+        lines = u''.join(u'%s\t%s\n' % (time.asctime(), ujson.dumps(data)) for data in events)
+        lock_fn = fn + '.lock'
+        with lockfile(lock_fn):
+            with open(fn, 'ab') as f:
+                f.write(lines.encode('utf-8'))
 
     def _log_problem(self):
         logging.exception("Problem handling data on queue %s" % (self.queue_name,))
@@ -91,11 +111,64 @@ class QueueProcessingWorker(object):
 
     def start(self):
         self.q.register_json_consumer(self.queue_name, self.consume_wrapper)
+        self.consume_until_stopped()
+
+    def consume_until_stopped(self):
+        self.consuming = True
+        self.q.connection.add_timeout(self.stop_poll_secs, self._check_stop_requested)
         self.q.start_consuming()
 
+    def request_stop(self):
+        """Asks a consuming worker to stop after the event it's handling.
+        This only sets a flag, so it's safe to call from a signal
+        handler; the worker stops from a timer on its connection, which
+        pika runs between events."""
+        self.stop_requested = True
+
+    def _check_stop_requested(self):
+        if self.stop_requested:
+            self.stop()
+        else:
+            self.q.connection.add_timeout(self.stop_poll_secs, self._check_stop_requested)
+
     def stop(self):
         self.q.stop_consuming()
 
+class BatchedQueueProcessingWorker(QueueProcessingWorker):
+    """A worker that handles events in batches, for when doing the
+    work for many events at once is much cheaper than one at a time
+    (e.g. a single bulk database query)."""
+    # RabbitMQ sends us at most this many unacknowledged events at a time...
+    prefetch_count = 200
+    # ...which are passed to consume_batch in lists of up to this many,
+    max_batch_size = 100
+    # waiting at most this many seconds for a batch to fill up.
+    max_batch_latency = 1.0
+
+    def consume(self, data):
+        self.consume_batch([data])
+
+    def consume_batch(self, events):
+        raise WorkerDeclarationException("No batch consumer defined!")
+
+    def consume_batch_wrapper(self, events):
+        start = time.time()
+        try:
+            self.consume_batch(events)
+        except Exception:
+            self._log_problem()
+            self._save_failed_events(events)
+        reset_queries()
+        flush_per_request_caches()
+        self._record_stats(len(events), time.time() - start)
+
+    def start(self):
+        self.q.register_json_batch_consumer(self.queue_name, self.consume_batch_wrapper,
+                                            prefetch_count=self.prefetch_count,
+                                            max_batch_size=self.max_batch_size,
+                                            max_latency=self.max_batch_latency)
+        self.consume_until_stopped()
+
 if settings.MAILCHIMP_API_KEY:
     from postmonkey import PostMonkey, MailChimpException
 
@@ -149,20 +222,20 @@ class ConfirmationEmailWorker(QueueProcessingWorker):
                                              sender={'email': settings.ZULIP_ADMINISTRATOR, 'name': 'Zulip'})
 
 @assign_queue('user_activity')
-class UserActivityWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        client = get_client(event["client"])
-        log_time = timestamp_to_datetime(event["time"])
-        query = event["query"]
-        do_update_user_activity(user_profile, client, query, log_time)
+class UserActivityWorker(BatchedQueueProcessingWorker):
+    def consume_batch(self, events):
+        do_update_user_activities([(event["user_profile_id"],
+                                     get_client(event["client"]).id,
+                                     event["query"],
+                                     timestamp_to_datetime(event["time"]))
+                                    for event in events])
 
 @assign_queue('user_activity_interval')
-class UserActivityIntervalWorker(QueueProcessingWorker):
-    def consume(self, event):
-        user_profile = get_user_profile_by_id(event["user_profile_id"])
-        log_time = timestamp_to_datetime(event["time"])
-        do_update_user_activity_interval(user_profile, log_time)
+class UserActivityIntervalWorker(BatchedQueueProcessingWorker):
+    def consume_batch(self, events):
+        do_update_user_activity_intervals([(event["user_profile_id"],
+                                            timestamp_to_datetime(event["time"]))
+                                           for event in events])
 
 @assign_queue('user_presence')
 class UserPresenceWorker(QueueProcessingWorker):
@@ -189,6 +262,7 @@ class MissedMessageWorker(QueueProcessingWorker):
                 handle_missedmessage_emails(user_profile_id, events)
 
             reset_queries()
+            flush_per_request_caches()
             # Aggregate all messages received every 2 minutes to let someone finish sending a batch
             # of messages
             time.sleep(2 * 60)
@@ -273,7 +347,9 @@ class SlowQueryWorker(QueueProcessingWorker):
 
             content = ""
             for query in slow_queries:
-                content += "    %s\n" % (query,)
+                # Indent every line, so multi-line reports (e.g. query
+                # plans) stay inside the code block.
+                content += "    %s\n" % (query.replace("\n", "\n    "),)
 
             internal_send_message(settings.ERROR_BOT, "stream", "logs", topic, content)
 
@@ -332,7 +408,11 @@ class DigestWorker(QueueProcessingWorker):
     # management command, not here.
     def consume(self, event):
         logging.info("Received digest event: %s" % (event,))
-        handle_digest_email(event["user_profile_id"], event["cutoff"])
+        if "user_profile_ids" in event:
+            handle_digest_emails(event["user_profile_ids"], event["cutoff"])
+        else:
+            # Queued one user at a time, before an upgrade
+            handle_digest_email(event["user_profile_id"], event["cutoff"])
 
 @assign_queue('email_mirror')
 class MirrorWorker(QueueProcessingWorker):
@@ -342,6 +422,20 @@ class MirrorWorker(QueueProcessingWorker):
         mirror_email(email.message_from_string(event["message"].encode("utf-8")),
                      rcpt_to=event["rcpt_to"], pre_checked=True)
 
+@assign_queue('message_rerender')
+class MessageRerenderWorker(QueueProcessingWorker):
+    # Re-renders the stale messages in an id range; see the
+    # rerender_messages management command.
+    def consume(self, event):
+        rerender_message_range(((event["min_id"], event["max_id"]), event.get("max_load")))
+
+@assign_queue('link_previews')
+class LinkPreviewWorker(QueueProcessingWorker):
+    # Fetches the link previews a new or edited message was rendered
+    # without, and sends the message's new rendering.
+    def consume(self, event):
+        do_fetch_link_previews(event)
+
 @assign_queue('test')
 class TestWorker(QueueProcessingWorker):
     # This worker allows you to test the queue worker infrastructure without
@@ -0,0 +1,220 @@
+from __future__ import absolute_import
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db import connection
+from zerver.lib.queue import SimpleQueueClient
+from zerver.lib.utils import statsd
+from zerver.worker.queue_processors import get_worker
+
+from collections import defaultdict
+import logging
+import os
+import pika
+import signal
+import time
+
+# The queue supervisor runs each queue's workers in a pool of worker
+# processes, between a minimum and maximum size per queue
+# (settings.QUEUE_WORKER_PROCESSES; one of each by default), adding a
+# worker when the queue backs up and removing one when it's empty.  It
+# restarts workers that crash, after a delay that grows with each
+# consecutive crash, and on SIGTERM asks every worker to finish the
+# events it has in hand before exiting.
+
+def run_worker(queue_name):
+    # type: (str) -> None
+    """The body of a worker process."""
+    # Each worker needs its own database connection
+    connection.close()
+    worker = get_worker(queue_name)
+    worker.setup()
+
+    def drain(signum, frame):
+        # type: (int, Any) -> None
+        if not worker.consuming:
+            # Workers with their own loop (e.g. MissedMessageWorker)
+            # can't be stopped between events; just exit.
+            raise SystemExit(0)
+        # Stopping talks to RabbitMQ, which we can't do from here, in
+        # the middle of whatever the connection was doing; the worker
+        # stops itself once it sees the request.
+        worker.request_stop()
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    worker.start()
+
+class QueueSupervisor(object):
+    # How often to check on the workers and queue depths
+    POLL_SECS = 5.0
+    # Add a worker when more than this many events per worker are waiting
+    SCALE_UP_DEPTH = 100
+    # Wait this long to restart a crashed worker, doubling with each
+    # consecutive crash up to the maximum...
+    RESTART_BACKOFF_SECS = 1.0
+    MAX_RESTART_BACKOFF_SECS = 60.0
+    # ...where crashes are consecutive unless a worker ran this long.
+    STABLE_SECS = 60.0
+    # How long to give workers to finish before killing them on shutdown
+    DRAIN_SECS = 30.0
+
+    def __init__(self, queue_names):
+        # type: (Iterable[str]) -> None
+        self.pool_sizes = {} # type: Dict[str, Tuple[int, int]]
+        for queue_name in queue_names:
+            (min_workers, max_workers) = settings.QUEUE_WORKER_PROCESSES.get(queue_name, (1, 1))
+            self.pool_sizes[queue_name] = (min_workers, max(min_workers, max_workers))
+        # queue name => {pid: start time}
+        self.workers = dict((queue_name, {}) for queue_name in self.pool_sizes) # type: Dict[str, Dict[int, float]]
+        self.stopping = set() # type: Set[int]
+        self.crashes = defaultdict(int) # type: Dict[str, int]
+        self.restart_at = {} # type: Dict[str, float]
+        self.shutting_down = False
+        self.queue_client = None # type: Optional[SimpleQueueClient]
+
+    def start_worker(self, queue_name):
+        # type: (str) -> None
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(queue_name)
+            except SystemExit as e:
+                status = e.code or 0
+            except Exception:
+                logging.exception("Worker for queue %s crashed" % (queue_name,))
+                status = 1
+            finally:
+                # Don't run the supervisor's atexit handlers or
+                # close its connections.
+                os._exit(status)
+        logging.info("Started worker %d for queue %s" % (pid, queue_name))
+        self.workers[queue_name][pid] = time.time()
+
+    def stop_worker(self, queue_name, pid):
+        # type: (str, int) -> None
+        logging.info("Stopping worker %d for queue %s" % (pid, queue_name))
+        self.stopping.add(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def running_workers(self, queue_name):
+        # type: (str) -> List[int]
+        return [pid for pid in self.workers[queue_name] if pid not in self.stopping]
+
+    def restart_delay(self, crashes):
+        # type: (int) -> float
+        return min(self.RESTART_BACKOFF_SECS * 2 ** (crashes - 1), self.MAX_RESTART_BACKOFF_SECS)
+
+    def describe_exit(self, status):
+        # type: (int) -> str
+        """Describes a status returned by os.waitpid."""
+        if os.WIFSIGNALED(status):
+            return "was killed by signal %d" % (os.WTERMSIG(status),)
+        return "exited with status %d" % (os.WEXITSTATUS(status),)
+
+    def worker_exited(self, pid, status):
+        # type: (int, int) -> None
+        for (queue_name, workers) in self.workers.items():
+            if pid not in workers:
+                continue
+            started = workers.pop(pid)
+            if pid in self.stopping:
+                self.stopping.remove(pid)
+                return
+            now = time.time()
+            if now - started >= self.STABLE_SECS:
+                self.crashes[queue_name] = 0
+            self.crashes[queue_name] += 1
+            delay = self.restart_delay(self.crashes[queue_name])
+            logging.error("Worker %d for queue %s %s; restarting in %.0fs" %
+                          (pid, queue_name, self.describe_exit(status), delay))
+            statsd.incr("queue_supervisor.%s.crashes" % (queue_name,))
+            self.restart_at[queue_name] = now + delay
+            return
+
+    def reap(self):
+        # type: () -> None
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # No children left
+                return
+            if pid == 0:
+                return
+            self.worker_exited(pid, status)
+
+    def queue_depth(self, queue_name):
+        # type: (str) -> Optional[int]
+        try:
+            if self.queue_client is None:
+                self.queue_client = SimpleQueueClient()
+            result = self.queue_client.channel.queue_declare(queue=queue_name, durable=True, passive=True)
+            return result.method.message_count
+        except (AttributeError, pika.exceptions.AMQPError):
+            logging.warning("Could not get the depth of queue %s" % (queue_name,))
+            self.queue_client = None
+            return None
+
+    def scale(self, queue_name, depth, now):
+        # type: (str, Optional[int], float) -> None
+        """Starts or stops a worker for the queue, if needed."""
+        (min_workers, max_workers) = self.pool_sizes[queue_name]
+        running = self.running_workers(queue_name)
+        if len(running) < min_workers or \
+                (depth is not None and depth > self.SCALE_UP_DEPTH * len(running) and
+                 len(running) < max_workers):
+            if now >= self.restart_at.get(queue_name, 0):
+                self.start_worker(queue_name)
+        elif depth == 0 and len(running) > min_workers:
+            # Stop the newest worker
+            self.stop_worker(queue_name, max(running, key=lambda pid: self.workers[queue_name][pid]))
+
+    def poll(self):
+        # type: () -> None
+        self.reap()
+        now = time.time()
+        for queue_name in self.pool_sizes:
+            depth = None # type: Optional[int]
+            if self.pool_sizes[queue_name][1] > self.pool_sizes[queue_name][0]:
+                depth = self.queue_depth(queue_name)
+            self.scale(queue_name, depth, now)
+            if depth is not None:
+                statsd.gauge("queue_supervisor.%s.depth" % (queue_name,), depth)
+            statsd.gauge("queue_supervisor.%s.workers" % (queue_name,),
+                         len(self.running_workers(queue_name)))
+
+    def shutdown(self, signum, frame):
+        # type: (int, Any) -> None
+        self.shutting_down = True
+
+    def drain(self):
+        # type: () -> None
+        logging.info("Draining queue workers")
+        for (queue_name, workers) in self.workers.items():
+            for pid in list(workers):
+                self.stop_worker(queue_name, pid)
+        deadline = time.time() + self.DRAIN_SECS
+        while any(self.workers.values()) and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for (queue_name, workers) in self.workers.items():
+            for pid in workers:
+                logging.warning("Killing worker %d for queue %s, which didn't finish in time" %
+                                (pid, queue_name))
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+    def run(self):
+        # type: () -> None
+        signal.signal(signal.SIGTERM, self.shutdown)
+        signal.signal(signal.SIGINT, self.shutdown)
+        while not self.shutting_down:
+            self.poll()
+            time.sleep(self.POLL_SECS)
+        self.drain()
@@ -0,0 +1,96 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List, Set
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from zerver.lib.alert_words import AlertWordMatcher
+from zerver.models import Message
+import random
+import re
+import six
+from six import text_type
+import time
+from six.moves import range
+
+def regex_alert_word_user_ids(content, realm_words):
+    # type: (text_type, Dict[int, List[text_type]]) -> Set[int]
+    # How AlertWordsNotificationProcessor matched alert words before
+    # AlertWordMatcher: a regex search per word.
+    content = content.lower()
+    allowed_before_punctuation = "|".join([r'\s', '^', r'[\(\".,\';\[\*`>]'])
+    allowed_after_punctuation = "|".join([r'\s', '$', r'[\)\"\?:.,\';\]!\*`]'])
+    user_ids = set() # type: Set[int]
+    for user_id, words in six.iteritems(realm_words):
+        for word in words:
+            escaped = re.escape(word.lower())
+            match_re = re.compile(u'(?:%s)%s(?:%s)' %
+                                    (allowed_before_punctuation,
+                                     escaped,
+                                     allowed_after_punctuation))
+            if re.search(match_re, content):
+                user_ids.add(user_id)
+    return user_ids
+
+class Command(BaseCommand):
+    help = """Compare AlertWordMatcher with matching each alert word with its
+own regex, for realms with different numbers of alert words.
+
+Matches the content of recent messages against randomly generated
+alert words (some of them taken from the messages, so that there are
+matches), spread across users with up to 10 words each.  The regex
+approach is only run on the first --regex-messages messages, since it
+is very slow with many words.
+
+Usage: python manage.py benchmark_alert_words --words=1000,10000,100000"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--words',
+                    dest='words',
+                    default='1000,10000,100000',
+                    help='Comma-separated numbers of alert words in the realm.'),
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=1000,
+                    help='Number of recent messages to match.'),
+        make_option('--regex-messages',
+                    dest='regex_messages',
+                    type='int',
+                    default=20,
+                    help='Number of messages to match with a regex per word.'),
+        )
+
+    def measure(self, name, contents, match):
+        # type: (str, List[text_type], Callable[[text_type], Set[int]]) -> None
+        start = time.time()
+        for content in contents:
+            match(content)
+        elapsed = time.time() - start
+        print("    %-8s %10.3f ms/message" % (name, elapsed * 1000 / len(contents)))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        contents = list(Message.objects.order_by('-id')
+                                       .values_list('content', flat=True)[:options['messages']])
+        message_words = [word for content in contents for word in content.split()]
+        if not contents:
+            print("No messages to match")
+            return
+
+        for num_words in [int(n) for n in options['words'].split(',')]:
+            words = [random.choice(message_words) if message_words and random.random() < 0.01 else
+                     u''.join(random.choice(u'abcdefghijklmnopqrstuvwxyz')
+                              for i in range(random.randint(4, 12)))
+                     for j in range(num_words)]
+            realm_words = dict((user_id, words[user_id * 10:(user_id + 1) * 10])
+                               for user_id in range((num_words + 9) // 10))
+
+            start = time.time()
+            matcher = AlertWordMatcher(realm_words)
+            print("%d alert words (matcher built in %.1f ms)" % (num_words, (time.time() - start) * 1000))
+            self.measure("regex", contents[:options['regex_messages']],
+                         lambda content: regex_alert_word_user_ids(content, realm_words))
+            self.measure("matcher", contents, matcher.user_ids_with_alert_words)
@@ -0,0 +1,101 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from optparse import make_option
+
+from zerver.lib.cache import cache_delete_many, generic_bulk_cached_fetch
+from zerver.models import Message, to_dict_cache_key_id, extract_message_dicts, \
+    stringify_message_dict
+import threading
+import time
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Measure how many database queries concurrent requests make for
+the same messages when they are missing from the remote cache.
+
+Evicts the rendered message dicts for the most recent messages, then
+has a number of threads fetch them all at once, as happens when many
+clients load the same busy stream just after a deploy, and reports
+how many of them queried the database.  Run with and without
+--no-single-flight to compare.
+
+Usage: python manage.py benchmark_cache_stampede --threads=50 --messages=400"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads',
+                    dest='threads',
+                    type='int',
+                    default=50,
+                    help='Number of concurrent fetches.'),
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=400,
+                    help='Number of messages each thread fetches.'),
+        make_option('--rounds',
+                    dest='rounds',
+                    type='int',
+                    default=5,
+                    help='Number of times to evict the messages and fetch them.'),
+        make_option('--no-single-flight',
+                    dest='single_flight',
+                    action='store_false',
+                    default=True,
+                    help='Let every thread that misses the cache query the database.'),
+        )
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        message_ids = list(Message.objects.order_by('-id')
+                                          .values_list('id', flat=True)[:options['messages']])
+        cache_keys = [to_dict_cache_key_id(message_id, True) for message_id in message_ids]
+        # Each thread gets its own database connection
+        connection.close()
+
+        query_counts = [] # type: List[int]
+        fetch_times = [] # type: List[float]
+        lock = threading.Lock()
+
+        def query_function(ids):
+            # type: (List[int]) -> List[Dict[str, Any]]
+            if ids:
+                with lock:
+                    query_counts[-1] += 1
+            return Message.get_raw_db_rows(ids)
+
+        def fetch():
+            # type: () -> None
+            start = time.time()
+            generic_bulk_cached_fetch(lambda message_id: to_dict_cache_key_id(message_id, True),
+                                      query_function,
+                                      message_ids,
+                                      id_fetcher=lambda row: row['id'],
+                                      cache_transformer=lambda row: Message.build_dict_from_raw_db_row(row, True),
+                                      bulk_extractor=extract_message_dicts,
+                                      setter=stringify_message_dict,
+                                      single_flight=options['single_flight'])
+            with lock:
+                fetch_times.append(time.time() - start)
+            connection.close()
+
+        for i in range(options['rounds']):
+            cache_delete_many(cache_keys)
+            query_counts.append(0)
+            threads = [threading.Thread(target=fetch) for j in range(options['threads'])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        fetch_times.sort()
+        print("%d rounds of %d concurrent fetches of %d messages (single flight %s)"
+              % (options['rounds'], options['threads'], len(message_ids),
+                 "on" if options['single_flight'] else "off"))
+        print("  database queries per round: %s" % (", ".join(str(count) for count in query_counts),))
+        print("  fetch p50: %8.2f ms" % (fetch_times[len(fetch_times) // 2] * 1000,))
+        print("  fetch max: %8.2f ms" % (fetch_times[-1] * 1000,))
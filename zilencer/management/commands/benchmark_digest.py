@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from optparse import make_option
+
+from zerver.lib import digest
+from zerver.models import UserProfile, get_realm
+import datetime
+import mock
+import time
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Measure a digest email run for a realm with many users.
+
+Times building a digest for each of the realm's users (repeated, to
+reach --users users) in batches, as a realm's digest queue events are
+handled, and for --per-user-users users handled one run apiece, as
+the old per-user digest queue events were.  Emails aren't sent, and
+the unsubscribe tokens created are rolled back.
+
+Usage: python manage.py benchmark_digest --realm=zulip.com --users=10000"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--realm',
+                    dest='realm',
+                    default='zulip.com',
+                    help='The domain of the realm to build digests for.'),
+        make_option('--users',
+                    dest='users',
+                    type='int',
+                    default=10000,
+                    help='Number of users to build digests for in one run.'),
+        make_option('--per-user-users',
+                    dest='per_user_users',
+                    type='int',
+                    default=100,
+                    help='Number of users to build digests for one run apiece.'),
+        make_option('--days',
+                    dest='days',
+                    type='int',
+                    default=7,
+                    help='How many days of traffic the digests cover.'),
+        )
+
+    def measure(self, name, num_users, run):
+        # type: (str, int, Callable[[], None]) -> None
+        sent = []  # type: List[int]
+        with mock.patch('zerver.lib.digest.send_digest_email',
+                        lambda user_profile, html, text: sent.append(user_profile.id)):
+            with transaction.atomic():
+                start = time.time()
+                run()
+                elapsed = time.time() - start
+                transaction.set_rollback(True)
+        print("  %-10s %6d users %8.1f s %8.2f ms/user (%d emails, %.1f s for 10000 users)" %
+              (name, num_users, elapsed, elapsed * 1000 / num_users, len(sent),
+               elapsed * 10000 / num_users))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm = get_realm(options['realm'])
+        realm_users = list(UserProfile.objects.filter(realm=realm, is_active=True, is_bot=False))
+        if not realm_users:
+            print("No users in %s" % (options['realm'],))
+            return
+        cutoff_date = datetime.datetime.utcnow() - datetime.timedelta(days=options['days'])
+        cutoff = time.mktime(cutoff_date.timetuple())
+
+        users = (realm_users * (options['users'] // len(realm_users) + 1))[:options['users']]
+        def realm_run():
+            # type: () -> None
+            # One digest queue event per batch, as enqueue_digest_emails
+            # queues them.
+            for i in range(0, len(users), digest.DIGEST_BATCH_SIZE):
+                realm_digest = digest.RealmDigest(realm, cutoff_date)
+                digest.handle_digest_email_batch(realm_digest, users[i:i + digest.DIGEST_BATCH_SIZE])
+
+        per_user_users = users[:options['per_user_users']]
+        def per_user_run():
+            # type: () -> None
+            for user_profile in per_user_users:
+                digest.handle_digest_email(user_profile.id, cutoff)
+
+        print("Digests for %s (%d users, %d days of traffic)" %
+              (options['realm'], len(realm_users), options['days']))
+        self.measure("per-user", len(per_user_users), per_user_run)
+        self.measure("realm", len(users), realm_run)
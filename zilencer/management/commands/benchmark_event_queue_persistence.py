@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from zerver.lib import event_queue_journal
+from zerver.lib.event_queue import ClientDescriptor, EventQueue, \
+    read_event_queue_journal
+from zerver.lib.event_queue_journal import EventQueueJournal
+import os
+import shutil
+import tempfile
+import time
+import ujson
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Compare the cost of persisting Tornado event queues as a single
+JSON file (the old format) with the event queue journal.
+
+For each queue count, builds that many synthetic event queues holding a
+few message events each, then times writing and restoring them in both
+formats, and the cost of journaling additional events incrementally.
+
+Usage: python manage.py benchmark_event_queue_persistence --queues=10000,50000,100000"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--queues',
+                    dest='queues',
+                    default='10000,50000,100000',
+                    help='Comma-separated list of queue counts to measure.'),
+        make_option('--events-per-queue',
+                    dest='events_per_queue',
+                    type='int',
+                    default=5,
+                    help='Number of message events in each synthetic queue.'),
+        )
+
+    def make_clients(self, num_queues, events_per_queue):
+        # type: (int, int) -> Dict[str, ClientDescriptor]
+        clients = {} # type: Dict[str, ClientDescriptor]
+        for i in range(num_queues):
+            queue_id = "benchmark:%d" % (i,)
+            client = ClientDescriptor(i, "user%d@zulip.com" % (i,), 1, EventQueue(queue_id),
+                                      None, "website", lifespan_secs=600)
+            for j in range(events_per_queue):
+                client.event_queue.push(self.make_message_event(i * events_per_queue + j))
+            clients[queue_id] = client
+        return clients
+
+    def make_message_event(self, message_id):
+        # type: (int) -> Dict[str, Any]
+        message = dict(id=message_id,
+                       sender_id=1,
+                       sender_email="iago@zulip.com",
+                       sender_full_name="Iago",
+                       type="stream",
+                       display_recipient="Verona",
+                       subject="benchmark",
+                       content="<p>Benchmark message %d</p>" % (message_id,),
+                       content_type="text/html",
+                       timestamp=1466545829,
+                       client="website")
+        return dict(type="message", message=message, flags=[])
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        queue_counts = [int(count) for count in options['queues'].split(',')]
+        tmpdir = tempfile.mkdtemp()
+        try:
+            print("%8s %8s %10s %10s %10s %16s" %
+                  ("queues", "format", "size (KB)", "write (s)", "load (s)", "append (us/event)"))
+            for num_queues in queue_counts:
+                clients = self.make_clients(num_queues, options['events_per_queue'])
+
+                json_filename = os.path.join(tmpdir, "event_queues.json")
+                start = time.time()
+                with open(json_filename, "w") as f:
+                    ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()], f)
+                json_write = time.time() - start
+                start = time.time()
+                with open(json_filename, "r") as f:
+                    restored = dict((qid, ClientDescriptor.from_dict(client))
+                                    for (qid, client) in ujson.loads(f.read()))
+                json_load = time.time() - start
+                assert len(restored) == num_queues
+                print("%8d %8s %10d %10.3f %10.3f %16s" %
+                      (num_queues, "json", os.path.getsize(json_filename) / 1024,
+                       json_write, json_load, "-"))
+
+                journal_filename = os.path.join(tmpdir, "event_queues.journal")
+                journal = EventQueueJournal(journal_filename)
+                start = time.time()
+                journal.compact((event_queue_journal.QUEUE, qid, client.to_dict())
+                                for (qid, client) in clients.items())
+                journal_write = time.time() - start
+
+                # Journal one more message, delivered to every queue, as
+                # the IOLoop would
+                message = self.make_message_event(num_queues * options['events_per_queue'])['message']
+                start = time.time()
+                for (qid, client) in clients.items():
+                    journal.record_event(qid, dict(type="message", message=message, flags=[]), None)
+                journal.flush()
+                append_time = time.time() - start
+                journal.close()
+
+                start = time.time()
+                (restored, clean) = read_event_queue_journal(journal_filename)
+                journal_load = time.time() - start
+                assert clean and len(restored) == num_queues
+                print("%8d %8s %10d %10.3f %10.3f %16.1f" %
+                      (num_queues, "journal", os.path.getsize(journal_filename) / 1024,
+                       journal_write, journal_load, append_time * 1000000 / num_queues))
+        finally:
+            shutil.rmtree(tmpdir)
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand
+from django.http import HttpRequest
+from optparse import make_option
+
+from zerver.lib.cache import cache_delete_many
+from zerver.models import get_user_profile_by_email, to_dict_cache_key_id, \
+    UserMessage
+from zerver.views.messages import get_old_messages_backend
+import time
+import ujson
+from six.moves import range
+
+class MockRequest(HttpRequest):
+    def __init__(self, user_profile, params):
+        # type: (Any, Dict[str, Any]) -> None
+        self.user = user_profile
+        self.path = '/'
+        self.method = "GET"
+        self.META = {"REMOTE_ADDR": "127.0.0.1"}
+        self.REQUEST = params
+        self.GET = {} # type: Dict[Any, Any]
+        self._log_data = {} # type: Dict[str, Any]
+
+def percentile(sorted_times, fraction):
+    # type: (List[float], float) -> float
+    return sorted_times[min(int(len(sorted_times) * fraction), len(sorted_times) - 1)]
+
+class Command(BaseCommand):
+    help = """Measure the latency of get_old_messages against the current database.
+
+Repeatedly loads messages for a user, by default the way the web app
+loads the home view (the 200 messages on either side of the pointer),
+and reports latency percentiles.  With --cold, the user's rendered
+message dicts are evicted from the remote cache before each request.
+
+Usage: python manage.py benchmark_get_old_messages --email=hamlet@zulip.com --iterations=200"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--email',
+                    dest='email',
+                    help='Email address of the user to load messages for.'),
+        make_option('--iterations',
+                    dest='iterations',
+                    type='int',
+                    default=100,
+                    help='Number of requests to time.'),
+        make_option('--num-before',
+                    dest='num_before',
+                    type='int',
+                    default=200,
+                    help='Number of messages before the anchor.'),
+        make_option('--num-after',
+                    dest='num_after',
+                    type='int',
+                    default=200,
+                    help='Number of messages after the anchor.'),
+        make_option('--anchor',
+                    dest='anchor',
+                    type='int',
+                    default=None,
+                    help='Anchor message id (default: the user\'s pointer).'),
+        make_option('--narrow',
+                    dest='narrow',
+                    default=None,
+                    help='JSON-encoded narrow, e.g. \'[["stream", "Verona"]]\'.'),
+        make_option('--first-unread',
+                    dest='first_unread',
+                    action='store_true',
+                    default=False,
+                    help='Anchor at the first unread message, as narrowing in the web app does.'),
+        make_option('--cold',
+                    dest='cold',
+                    action='store_true',
+                    default=False,
+                    help='Evict the returned messages from the remote cache before each request.'),
+        )
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        user_profile = get_user_profile_by_email(options['email'])
+        anchor = options['anchor']
+        if anchor is None:
+            anchor = user_profile.pointer
+        params = {"anchor": anchor,
+                  "num_before": options['num_before'],
+                  "num_after": options['num_after'],
+                  "use_first_unread_anchor": ujson.dumps(options['first_unread'])}
+        if options['narrow'] is not None:
+            params["narrow"] = options['narrow']
+
+        cache_keys = [] # type: List[str]
+        if options['cold']:
+            message_ids = UserMessage.objects.filter(user_profile=user_profile) \
+                                             .values_list("message_id", flat=True)
+            cache_keys = [to_dict_cache_key_id(message_id, True) for message_id in message_ids]
+
+        times = [] # type: List[float]
+        num_messages = 0
+        for i in range(options['iterations']):
+            if cache_keys:
+                cache_delete_many(cache_keys)
+            request = MockRequest(user_profile, dict(params))
+            start = time.time()
+            response = get_old_messages_backend(request, user_profile, apply_markdown=True)
+            times.append(time.time() - start)
+            num_messages = len(ujson.loads(response.content)['messages'])
+
+        times.sort()
+        print("%d requests returning %d messages each" % (len(times), num_messages))
+        for (label, fraction) in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            print("  %s: %8.2f ms" % (label, percentile(times, fraction) * 1000))
+        print("  max: %8.2f ms" % (times[-1] * 1000,))
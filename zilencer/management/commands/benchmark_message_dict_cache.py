@@ -0,0 +1,69 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from zerver.models import Message, extract_message_dict, stringify_message_dict
+from zerver.lib.str_utils import force_bytes, dict_with_str_keys
+import time
+import ujson
+import zlib
+
+class Command(BaseCommand):
+    help = """Compare the size and decode time of the compact message dict
+cache encoding with the previous one (zlib-compressed JSON of the
+whole dict).
+
+Builds the message dicts for the most recent messages, encodes them
+both ways, and reports the memcached memory needed for 1M cached
+messages in each encoding, and the time to decode them (including
+filling in the sender and recipients, for the compact encoding).
+
+Usage: python manage.py benchmark_message_dict_cache --messages=5000"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=5000,
+                    help='Number of recent messages to encode.'),
+        make_option('--no-markdown',
+                    dest='apply_markdown',
+                    action='store_false',
+                    default=True,
+                    help='Use the dicts with unrendered content.'),
+        )
+
+    def measure(self, name, encoded, decode):
+        # type: (str, List[bytes], Callable[[bytes], Dict[str, Any]]) -> None
+        # memcached stores each item with ~50 bytes of overhead, plus the key
+        item_bytes = sum(len(value) + 50 + len("message_dict:1000000:1") for value in encoded)
+        start = time.time()
+        for value in encoded:
+            decode(value)
+        decode_time = time.time() - start
+        print("  %-8s %8.1f MB per 1M messages, decode %6.2f us/message" %
+              (name, item_bytes * 1000000.0 / len(encoded) / 1024 / 1024,
+               decode_time * 1000000 / len(encoded)))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        message_ids = list(Message.objects.order_by('-id')
+                                          .values_list('id', flat=True)[:options['messages']])
+        message_dicts = [Message.build_dict_from_raw_db_row(row, options['apply_markdown'])
+                         for row in Message.get_raw_db_rows(message_ids)]
+
+        plain = [zlib.compress(force_bytes(ujson.dumps(message_dict)))
+                 for message_dict in message_dicts]
+        compact = [stringify_message_dict(message_dict) for message_dict in message_dicts]
+        # Warm the sender/recipient records, as in steady state
+        for value in compact:
+            extract_message_dict(value)
+
+        print("%d message dicts" % (len(message_dicts),))
+        self.measure("json", plain,
+                     lambda value: dict_with_str_keys(ujson.loads(zlib.decompress(value).decode("utf-8"))))
+        self.measure("compact", compact, extract_message_dict)
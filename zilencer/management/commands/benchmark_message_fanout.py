@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from zerver.lib import event_queue
+from zerver.lib.event_queue import ClientDescriptor, allocate_client_descriptor, \
+    encode_events, process_notification
+import resource
+import time
+import ujson
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Measure the CPU and memory cost of delivering stream messages
+to many event queues in Tornado.
+
+Allocates one synthetic event queue per recipient, sends synthetic
+messages to all of them through the Tornado notification path, then
+encodes each queue's get_events response both with the shared
+pre-encoded message payloads and with a plain ujson.dumps of the
+events, as before.
+
+Nothing is sent to the queue server.
+
+Usage: python manage.py benchmark_message_fanout --recipients=1000"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--recipients',
+                    dest='recipients',
+                    type='int',
+                    default=1000,
+                    help='Number of recipients (one event queue each).'),
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=20,
+                    help='Number of messages to send to the recipients.'),
+        make_option('--content-size',
+                    dest='content_size',
+                    type='int',
+                    default=1000,
+                    help='Size of the rendered content of each message, in bytes.'),
+        )
+
+    def make_notice(self, message_id, content, user_ids):
+        # type: (int, str, List[int]) -> Dict[str, Any]
+        message_dict = dict(id=message_id,
+                            sender_id=1,
+                            sender_email="iago@zulip.com",
+                            sender_full_name="Iago",
+                            type="stream",
+                            display_recipient="Verona",
+                            subject="benchmark",
+                            content=content,
+                            content_type="text/html",
+                            timestamp=1466545829,
+                            client="website")
+        event = dict(type='message',
+                     message=message_id,
+                     message_dict_markdown=message_dict,
+                     message_dict_no_markdown=dict(message_dict, content_type="text/x-markdown"),
+                     stream_name="Verona",
+                     realm_id=1,
+                     presences={})
+        # Round-trip through JSON, as notices from Django do
+        return ujson.loads(ujson.dumps(dict(event=event,
+                                            users=[dict(id=user_id, flags=[])
+                                                   for user_id in user_ids])))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        user_ids = [200000 + i for i in range(options['recipients'])]
+        clients = [] # type: List[ClientDescriptor]
+        for user_id in user_ids:
+            clients.append(allocate_client_descriptor(
+                dict(user_profile_id=user_id,
+                     user_profile_email="benchmark%d@zulip.com" % (user_id,),
+                     realm_id=1,
+                     event_types=None,
+                     client_type_name="website",
+                     apply_markdown=True,
+                     all_public_streams=False,
+                     queue_timeout=600,
+                     last_connection_time=time.time(),
+                     narrow=[])))
+
+        content = "<p>" + "x" * max(options['content_size'] - 7, 0) + "</p>"
+        notices = [self.make_notice(i, content, user_ids) for i in range(options['messages'])]
+
+        event_queue.queue_json_publish = lambda queue_name, event, processor: None
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        for notice in notices:
+            process_notification(notice)
+        dispatch_time = time.time() - start
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        contents = [client.event_queue.contents() for client in clients]
+        start = time.time()
+        shared_bytes = sum(len(encode_events(events, True)) for events in contents)
+        shared_time = time.time() - start
+        start = time.time()
+        plain_bytes = sum(len(ujson.dumps(events)) for events in contents)
+        plain_time = time.time() - start
+        assert shared_bytes == plain_bytes
+
+        message_dicts = dict((id(event['message']), event['message'])
+                             for events in contents for event in events)
+        shared_payload = sum(len(ujson.dumps(message)) for message in message_dicts.values())
+        copied_payload = sum(len(ujson.dumps(event['message']))
+                             for events in contents for event in events)
+
+        print("%d messages to %d recipients" % (len(notices), len(clients)))
+        print("  dispatch:          %8.2f ms/message" % (dispatch_time * 1000 / len(notices),))
+        print("  max RSS growth:    %8d KB" % (rss_after - rss_before,))
+        print("  message payloads:  %8d KB shared (%d KB if copied per queue)"
+              % (shared_payload / 1024, copied_payload / 1024))
+        print("  encode responses:  %8.2f ms pre-encoded, %.2f ms ujson.dumps (%d KB)"
+              % (shared_time * 1000, plain_time * 1000, shared_bytes / 1024))
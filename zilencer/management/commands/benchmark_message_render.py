@@ -0,0 +1,68 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from optparse import make_option
+
+from zerver.lib.rerender import make_render_pool, render_message_batches, render_messages
+from zerver.models import Message
+import time
+
+class Command(BaseCommand):
+    help = """Measure how fast recent messages can be rendered, in one
+process as in a request, and in batches across a render pool of
+pre-warmed worker processes.
+
+Renders (without saving, and bypassing the render cache) the most
+recent messages, as a corpus of real content, and reports messages
+rendered per second.
+
+Usage: python manage.py benchmark_message_render --messages=2000 --processes=4"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=2000,
+                    help='Number of recent messages to render.'),
+        make_option('--processes',
+                    dest='processes',
+                    type='int',
+                    default=4,
+                    help='Number of processes in the pool.'),
+        make_option('--batch-size',
+                    dest='batch_size',
+                    type='int',
+                    default=100,
+                    help='Number of messages in each batch sent to the pool.'),
+        )
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        messages = list(Message.objects.select_related('sender__realm', 'sending_client')
+                                       .order_by('-id')[:options['messages']])
+        realm_ids = list(set(message.sender.realm_id for message in messages))
+        print("Rendering %d messages from %d realms" % (len(messages), len(realm_ids)))
+
+        # The pool's workers are forked inside, so inherit the override.
+        with override_settings(BUGDOWN_RENDER_CACHE=False):
+            start = time.time()
+            count = len(render_messages(messages))
+            elapsed = time.time() - start
+            print("  %-12s %8.0f messages/s" % ("1 process", count / elapsed))
+
+            pool = make_render_pool(options['processes'], realm_ids)
+            try:
+                # Keep each worker busy briefly, so that they've all
+                # warmed up before the timing starts.
+                pool.map(time.sleep, [0.1] * options['processes'], 1)
+
+                start = time.time()
+                count = len(render_message_batches(pool, messages, options['batch_size']))
+                elapsed = time.time() - start
+            finally:
+                pool.terminate()
+            print("  %-12s %8.0f messages/s" % ("%d processes" % (options['processes'],), count / elapsed))
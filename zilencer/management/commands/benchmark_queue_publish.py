@@ -0,0 +1,159 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, Dict, List
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from optparse import make_option
+
+from zerver.lib import queue
+from zerver.lib.queue import SimpleQueueClient, queue_json_publish
+import threading
+import time
+from six.moves import range
+
+class InMemoryChannel(object):
+    """Stands in for a pika BlockingChannel, charging each write to the
+    socket (publish) and each round trip to the broker a fixed time."""
+    def __init__(self, write_secs, round_trip_secs):
+        # type: (float, float) -> None
+        self.write_secs = write_secs
+        self.round_trip_secs = round_trip_secs
+        self.published = 0
+
+    def queue_declare(self, **kwargs):
+        # type: (**Any) -> None
+        time.sleep(self.round_trip_secs)
+
+    def tx_select(self):
+        # type: () -> None
+        time.sleep(self.round_trip_secs)
+
+    def tx_commit(self):
+        # type: () -> None
+        time.sleep(self.round_trip_secs)
+
+    def basic_publish(self, **kwargs):
+        # type: (**Any) -> None
+        time.sleep(self.write_secs)
+        self.published += 1
+
+class InMemoryConnection(object):
+    is_open = True
+
+    def __init__(self, write_secs, round_trip_secs):
+        # type: (float, float) -> None
+        self.write_secs = write_secs
+        self.round_trip_secs = round_trip_secs
+
+    def channel(self):
+        # type: () -> InMemoryChannel
+        return InMemoryChannel(self.write_secs, self.round_trip_secs)
+
+    def close(self):
+        # type: () -> None
+        pass
+
+def in_memory_client(write_secs, round_trip_secs):
+    # type: (float, float) -> Callable[[], SimpleQueueClient]
+    class InMemoryQueueClient(SimpleQueueClient):
+        def _connect(self):
+            # type: () -> None
+            self.connection = InMemoryConnection(write_secs, round_trip_secs)
+            self.channel = self.connection.channel()
+            self.batch_channel = None
+    return InMemoryQueueClient
+
+class Command(BaseCommand):
+    help = """Measure queue_json_publish throughput and the time it takes
+the caller, from many concurrent request threads.
+
+Compares publishing each event from the request thread, as by
+default, with QUEUE_PUBLISH_IN_BACKGROUND, which hands events to a
+background thread that publishes them in bursts.  The background
+times include waiting for the last burst to be published.
+
+Publishes to the RabbitMQ server in settings (to the
+benchmark_queue_publish queue, which it then empties), or with
+--in-memory, to a stand-in that takes --write-us per message written
+and --round-trip-us per round trip to the broker.
+
+Usage: python manage.py benchmark_queue_publish --threads=20 --events=500 --in-memory"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads',
+                    dest='threads',
+                    type='int',
+                    default=20,
+                    help='Number of concurrent publishing threads.'),
+        make_option('--events',
+                    dest='events',
+                    type='int',
+                    default=500,
+                    help='Number of events each thread publishes.'),
+        make_option('--in-memory',
+                    dest='in_memory',
+                    action='store_true',
+                    default=False,
+                    help='Publish to an in-memory stand-in for RabbitMQ.'),
+        make_option('--write-us',
+                    dest='write_us',
+                    type='int',
+                    default=20,
+                    help='Time the stand-in takes to write a message, in microseconds.'),
+        make_option('--round-trip-us',
+                    dest='round_trip_us',
+                    type='int',
+                    default=200,
+                    help='Time of a round trip to the stand-in, in microseconds.'),
+        )
+
+    def run(self, name, threads, events):
+        # type: (str, int, int) -> None
+        latencies = [] # type: List[float]
+        lock = threading.Lock()
+        event = {'user_profile_id': 1, 'client': 'website', 'query': 'get_events_backend',
+                 'time': time.time()} # type: Dict[str, Any]
+
+        def publisher():
+            # type: () -> None
+            times = [] # type: List[float]
+            for i in range(events):
+                start = time.time()
+                queue_json_publish('benchmark_queue_publish', event, lambda event: None)
+                times.append(time.time() - start)
+            with lock:
+                latencies.extend(times)
+
+        publisher_threads = [threading.Thread(target=publisher) for i in range(threads)]
+        start = time.time()
+        for thread in publisher_threads:
+            thread.start()
+        for thread in publisher_threads:
+            thread.join()
+        queue.background_publisher.flush()
+        # Wait for any burst the background thread is still publishing
+        with queue.queue_lock:
+            pass
+        elapsed = time.time() - start
+
+        latencies.sort()
+        print("  %-12s %8.0f events/s  caller p50 %7.3f ms  p99 %7.3f ms" %
+              (name, len(latencies) / elapsed,
+               latencies[len(latencies) // 2] * 1000,
+               latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        if options['in_memory']:
+            queue.queue_client = in_memory_client(options['write_us'] / 1000000.0,
+                                                  options['round_trip_us'] / 1000000.0)()
+        print("%d threads publishing %d events each" % (options['threads'], options['events']))
+        with override_settings(USING_RABBITMQ=True, RUNNING_INSIDE_TORNADO=False):
+            for background in (False, True):
+                with override_settings(QUEUE_PUBLISH_IN_BACKGROUND=background):
+                    self.run("background" if background else "per event",
+                             options['threads'], options['events'])
+            if not options['in_memory']:
+                queue.get_queue_client().drain_queue('benchmark_queue_publish')
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Callable, List
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from optparse import make_option
+
+from zerver.lib.rate_limiter import api_calls_left, clear_user_history, \
+    incr_ratelimit, is_ratelimited, rate_limit_request
+import threading
+import time
+from six.moves import range
+
+class BenchmarkUser(object):
+    """Stands in for a UserProfile; the rate limiter only needs these."""
+    def __init__(self, rate_limits):
+        # type: (str) -> None
+        self.id = 0
+        self.rate_limits = rate_limits
+
+def separate_requests(user):
+    # type: (BenchmarkUser) -> None
+    # What rate_limit_user did before rate_limit_request
+    (ratelimited, _) = is_ratelimited(user)
+    if not ratelimited:
+        incr_ratelimit(user)
+        api_calls_left(user)
+
+class Command(BaseCommand):
+    help = """Measure the rate limiter under contention: many concurrent
+clients making calls as a single user.
+
+Compares the single-script rate_limit_request, in each storage
+format, with the separate is_ratelimited/incr_ratelimit/api_calls_left
+calls it replaced, reporting calls per second and latency.  Each
+storage format is also measured with calls leased from redis in
+chunks (RATE_LIMITING_LEASE_SIZE), as if the clients were one process.
+
+Usage: python manage.py benchmark_rate_limiter --clients=50 --calls=200"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clients',
+                    dest='clients',
+                    type='int',
+                    default=50,
+                    help='Number of concurrent clients (threads).'),
+        make_option('--calls',
+                    dest='calls',
+                    type='int',
+                    default=200,
+                    help='Number of calls each client makes.'),
+        make_option('--rate-limits',
+                    dest='rate_limits',
+                    default='1:100,60:1000',
+                    help='Rate limits for the user, as seconds:requests pairs.'),
+        make_option('--lease-size',
+                    dest='lease_size',
+                    type='int',
+                    default=10,
+                    help='RATE_LIMITING_LEASE_SIZE for the leased runs.'),
+        )
+
+    def run(self, name, user, clients, calls, func):
+        # type: (str, BenchmarkUser, int, int, Callable[[BenchmarkUser], Any]) -> None
+        clear_user_history(user)
+        latencies = [] # type: List[float]
+        lock = threading.Lock()
+
+        def client():
+            # type: () -> None
+            times = [] # type: List[float]
+            for i in range(calls):
+                start = time.time()
+                func(user)
+                times.append(time.time() - start)
+            with lock:
+                latencies.extend(times)
+
+        threads = [threading.Thread(target=client) for i in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        latencies.sort()
+        print("  %-16s %8.0f calls/s  p50 %6.2f ms  p99 %6.2f ms" %
+              (name, len(latencies) / elapsed,
+               latencies[len(latencies) // 2] * 1000,
+               latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000))
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        user = BenchmarkUser(options['rate_limits'])
+        print("%d clients making %d calls each, as one user" % (options['clients'], options['calls']))
+        self.run("separate calls", user, options['clients'], options['calls'], separate_requests)
+        for algorithm in ('sliding_window', 'gcra'):
+            with override_settings(RATE_LIMITING_ALGORITHM=algorithm):
+                self.run(algorithm, user, options['clients'], options['calls'], rate_limit_request)
+            with override_settings(RATE_LIMITING_ALGORITHM=algorithm,
+                                   RATE_LIMITING_LEASE_SIZE=options['lease_size']):
+                self.run(algorithm + " leased", user, options['clients'], options['calls'],
+                         rate_limit_request)
+        clear_user_history(user)
@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, List
+
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from zerver.lib.actions import do_send_messages, internal_prep_message
+from zerver.lib.db import reset_queries
+from zerver.models import get_stream, get_user_profile_by_email
+import time
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Measure the per-message cost of do_send_messages as the batch size grows.
+
+Sends real messages to the given stream, so only run this against a
+development database.
+
+Usage: python manage.py benchmark_send_messages --sender=iago@zulip.com --stream=Verona"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sender',
+                    dest='sender',
+                    default='iago@zulip.com',
+                    help='Email address of the user sending the messages.'),
+        make_option('--stream',
+                    dest='stream',
+                    default='Verona',
+                    help='Stream to send the messages to.'),
+        make_option('--batch-sizes',
+                    dest='batch_sizes',
+                    default='1,10,50,100,500',
+                    help='Comma-separated list of batch sizes to measure.'),
+        make_option('--trials',
+                    dest='trials',
+                    type='int',
+                    default=3,
+                    help='Number of batches to send for each batch size.'),
+        )
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        sender = get_user_profile_by_email(options['sender'])
+        if get_stream(options['stream'], sender.realm) is None:
+            raise CommandError("No such stream: %s" % (options['stream'],))
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+
+        print("%10s %12s %12s" % ("batch", "total (ms)", "per msg (ms)"))
+        for batch_size in batch_sizes:
+            timings = [] # type: List[float]
+            for trial in range(options['trials']):
+                messages = [internal_prep_message(sender.email, "stream", options['stream'],
+                                                  "benchmark %d" % (batch_size,),
+                                                  "Benchmark message %d of %d" % (i, batch_size),
+                                                  realm=sender.realm)
+                            for i in range(batch_size)]
+                start = time.time()
+                do_send_messages(messages)
+                timings.append(time.time() - start)
+                reset_queries()
+            best = min(timings)
+            print("%10d %12.1f %12.3f" % (batch_size, best * 1000, best * 1000 / batch_size))
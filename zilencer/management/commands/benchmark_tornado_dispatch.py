@@ -0,0 +1,145 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from typing import Any, Dict, List, Mapping
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from zerver.lib import event_queue
+from zerver.lib.event_queue import allocate_client_descriptor, \
+    get_client_descriptors_for_realm_all_streams, process_notification
+import random
+import time
+import ujson
+from six.moves import range
+
+class Command(BaseCommand):
+    help = """Measure how long the Tornado event dispatcher takes to process
+notify_tornado notices.
+
+By default, this allocates a synthetic set of event queues (a mix of
+all_public_streams clients and clients narrowed to a single stream) and
+replays synthetic public stream messages against them.  With
+--notices-file, the notices are instead read from a file containing one
+JSON-encoded notify_tornado payload per line (lines may be prefixed with
+a timestamp and a tab, as in the queue error files).
+
+Nothing is sent to the queue server; missed message notifications
+triggered by the replay are dropped.
+
+Usage: python manage.py benchmark_tornado_dispatch --clients=5000 --streams=200"""
+
+    option_list = BaseCommand.option_list + (
+        make_option('--clients',
+                    dest='clients',
+                    type='int',
+                    default=5000,
+                    help='Number of synthetic event queues to allocate.'),
+        make_option('--streams',
+                    dest='streams',
+                    type='int',
+                    default=200,
+                    help='Number of synthetic streams narrowed clients are spread over.'),
+        make_option('--all-streams-fraction',
+                    dest='all_streams_fraction',
+                    type='float',
+                    default=0.05,
+                    help='Fraction of the synthetic clients with all_public_streams set.'),
+        make_option('--messages',
+                    dest='messages',
+                    type='int',
+                    default=1000,
+                    help='Number of synthetic messages to replay.'),
+        make_option('--realm-id',
+                    dest='realm_id',
+                    type='int',
+                    default=1,
+                    help='Realm id for the synthetic queues and messages.'),
+        make_option('--notices-file',
+                    dest='notices_file',
+                    default=None,
+                    help='Replay notify_tornado payloads from this file instead.'),
+        make_option('--no-index',
+                    dest='no_index',
+                    action='store_true',
+                    default=False,
+                    help='Scan every all-streams client in the realm, as before the stream index.'),
+        )
+
+    def make_message_notice(self, realm_id, stream_name, message_id):
+        # type: (int, str, int) -> Dict[str, Any]
+        message_dict = dict(id=message_id,
+                            sender_id=1,
+                            sender_email="benchmark@zulip.com",
+                            type="stream",
+                            display_recipient=stream_name,
+                            subject="benchmark",
+                            content="benchmark message",
+                            client="benchmark")
+        return dict(event=dict(type='message',
+                               message=message_id,
+                               message_dict_markdown=message_dict,
+                               message_dict_no_markdown=message_dict,
+                               stream_name=stream_name,
+                               realm_id=realm_id,
+                               presences={}),
+                    users=[])
+
+    def load_notices(self, filename):
+        # type: (str) -> List[Mapping[str, Any]]
+        notices = [] # type: List[Mapping[str, Any]]
+        with open(filename) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if '\t' in line:
+                    line = line.split('\t', 1)[1]
+                notices.append(ujson.loads(line))
+        return notices
+
+    def handle(self, *args, **options):
+        # type: (*Any, **Any) -> None
+        realm_id = options['realm_id']
+        stream_names = ["stream %d" % (i,) for i in range(options['streams'])]
+
+        for i in range(options['clients']):
+            if random.random() < options['all_streams_fraction']:
+                narrow = [] # type: List[List[str]]
+                all_public_streams = True
+            else:
+                narrow = [["stream", random.choice(stream_names)]]
+                all_public_streams = False
+            allocate_client_descriptor(
+                dict(user_profile_id=100000 + i,
+                     user_profile_email="benchmark%d@zulip.com" % (i,),
+                     realm_id=realm_id,
+                     event_types=None,
+                     client_type_name="website",
+                     apply_markdown=True,
+                     all_public_streams=all_public_streams,
+                     queue_timeout=600,
+                     last_connection_time=time.time(),
+                     narrow=narrow))
+
+        if options['notices_file'] is not None:
+            notices = self.load_notices(options['notices_file'])
+        else:
+            notices = [self.make_message_notice(realm_id, random.choice(stream_names), i)
+                       for i in range(options['messages'])]
+
+        # Keep the replay inside this process.
+        event_queue.queue_json_publish = lambda queue_name, event, processor: None
+        if options['no_index']:
+            event_queue.get_client_descriptors_for_realm_stream = \
+                lambda realm_id, stream_name: get_client_descriptors_for_realm_all_streams(realm_id)
+
+        start = time.time()
+        for notice in notices:
+            process_notification(notice)
+        elapsed = time.time() - start
+
+        print("Processed %d notices for %d queues in %.3fs (%.3f ms/notice)" %
+              (len(notices), options['clients'], elapsed,
+               elapsed * 1000 / max(len(notices), 1)))
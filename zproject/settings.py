@@ -120,10 +120,38 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'DEPLOYMENT_ROLE_NAME': "",
                     'RABBITMQ_HOST': 'localhost',
                     'RABBITMQ_USERNAME': 'zulip',
+                    # Minimum and maximum number of worker processes per queue
+                    # under `process_queue --supervise`, e.g.
+                    # {'user_activity': (1, 4)}; (1, 1) for unlisted queues.
+                    'QUEUE_WORKER_PROCESSES': {},
+                    # Publish queue events from a background thread, in bursts
+                    # (see BackgroundQueuePublisher), rather than in the request.
+                    'QUEUE_PUBLISH_IN_BACKGROUND': False,
                     'MEMCACHED_LOCATION': '127.0.0.1:11211',
+                    # Size of the optional process-local cache in front of
+                    # memcached (see zerver/lib/cache.py); 0 disables it.
+                    'LOCAL_CACHE_MAX_ENTRIES': 0,
+                    # Cache message renderings, keyed by content and the realm
+                    # data they depend on (see zerver/lib/bugdown/__init__.py).
+                    'BUGDOWN_RENDER_CACHE': True,
                     'RATE_LIMITING': True,
+                    # How the rate limiter stores each user's recent calls
+                    # (see zerver/lib/rate_limiter.py): 'sliding_window' keeps
+                    # their timestamps, 'gcra' a single time per rule.
+                    'RATE_LIMITING_ALGORITHM': 'sliding_window',
+                    # If more than 1, each process leases up to this many calls
+                    # at a time per user from redis and hands them out locally;
+                    # see LocalRateLimiter for the error this allows.
+                    'RATE_LIMITING_LEASE_SIZE': 1,
                     'REDIS_HOST': '127.0.0.1',
                     'REDIS_PORT': 6379,
+                    # Number of Tornado processes the event system is sharded
+                    # across, listening on consecutive ports from TORNADO_SERVER.
+                    'TORNADO_PROCESSES': 1,
+                    # If set, narrowed get_old_messages queries taking at least
+                    # this many seconds are re-run under EXPLAIN ANALYZE and the
+                    # plan sent to the slow_queries queue.
+                    'SLOW_NARROW_EXPLAIN_SECS': None,
                     # The following bots only exist in non-VOYAGER installs
                     'ERROR_BOT': None,
                     'NEW_USER_BOT': None,
@@ -138,6 +166,13 @@ DEFAULT_SETTINGS = {'TWITTER_CONSUMER_KEY': '',
                     'ADMINS': '',
                     'SHARE_THE_LOVE': False,
                     'INLINE_IMAGE_PREVIEW': True,
+                    # Render new and edited messages without waiting for link
+                    # previews fetched from other sites; the link_previews
+                    # queue worker fetches them and updates the message.
+                    'INLINE_PREVIEWS_IN_BACKGROUND': True,
+                    # How many link previews the workers fetch from one site
+                    # at a time.
+                    'LINK_PREVIEW_MAX_FETCHES_PER_HOST': 2,
                     'CAMO_URI': '',
                     'ENABLE_FEEDBACK': PRODUCTION,
                     'FEEDBACK_EMAIL': None,
@@ -797,6 +832,7 @@ ZULIP_PATHS = [
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.pickle"),
     ("JSON_PERSISTENT_QUEUE_FILENAME", "/home/zulip/tornado/event_queues.json"),
+    ("EVENT_QUEUE_JOURNAL_FILENAME", "/home/zulip/tornado/event_queues.journal"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email-mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),
     ("LDAP_SYNC_LOG_PATH", "/var/log/zulip/sync_ldap_user_data.log"),
@@ -816,8 +852,8 @@ for (var, path) in ZULIP_PATHS:
     if DEVELOPMENT:
         # if DEVELOPMENT, store these files in the Zulip checkout
         path = os.path.join(DEVELOPMENT_LOG_DIRECTORY, os.path.basename(path))
-        # only `JSON_PERSISTENT_QUEUE_FILENAME` will be stored in `var`
-        if var == 'JSON_PERSISTENT_QUEUE_FILENAME':
+        # only the persistent event queue files will be stored in `var`
+        if var in ('JSON_PERSISTENT_QUEUE_FILENAME', 'EVENT_QUEUE_JOURNAL_FILENAME'):
             path = os.path.join(os.path.join(DEPLOY_ROOT, 'var'), os.path.basename(path))
     vars()[var] = path
 
@@ -48,6 +48,10 @@ RATE_LIMITING = False
 # real app.
 USING_RABBITMQ = False
 
+# Most bugdown tests render the same content with different mocked
+# data (e.g. link previews); the render cache is tested separately.
+BUGDOWN_RENDER_CACHE = False
+
 # Disable the tutorial because it confuses the client tests.
 TUTORIAL_ENABLED = False
 